@@ -27,6 +27,9 @@ CSRF_TRUSTED_ORIGINS = ["http://localhost:5173"]
 # Applications
 # --------------------------------------------------------------------------------------
 INSTALLED_APPS = [
+    # ASGI runserver (HTTP + WebSockets); must come before staticfiles
+    "daphne",
+
     # Django
     "django.contrib.admin",
     "django.contrib.auth",
@@ -85,12 +88,144 @@ WSGI_APPLICATION = "core.wsgi.application"
 ASGI_APPLICATION = "core.asgi.application"
 
 # --------------------------------------------------------------------------------------
-# Channels (in-memory for dev; switch to Redis in prod)
+# Channels
+# Postgres LISTEN/NOTIFY on DATABASES["default"], so group messages reach every
+# worker process. CHANNEL_LAYER=memory switches to the single-process layer.
 # --------------------------------------------------------------------------------------
 CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-    }
+    "default": (
+        {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+        if os.getenv("CHANNEL_LAYER") == "memory"
+        else {
+            "BACKEND": "game.layers.PostgresChannelLayer",
+            "CONFIG": {"database": "default", "capacity": 100, "expiry": 60},
+        }
+    )
+}
+
+# --------------------------------------------------------------------------------------
+# Matchmaking
+# PostgresQueue is shared by every worker; InMemoryQueue only pairs players that
+# hit the same process (tests / single runserver).
+# --------------------------------------------------------------------------------------
+MATCHMAKING = {
+    "QUEUE_BACKEND": os.getenv("MATCHMAKING_QUEUE_BACKEND", "game.matchmaking.PostgresQueue"),
+    # Accepted rating gap = BASE + PER_SECOND * seconds waited, capped at MAX.
+    "ELO_WINDOW": {"BASE": 50, "PER_SECOND": 10, "MAX": 400},
+    # Pairs created per lane per tick (one bulk_create), and how many waiters
+    # of a lane a single tick locks and considers.
+    "BATCH_SIZE": 200,
+    "LANE_SCAN_LIMIT": 2000,
+    # Queued players whose client hasn't polled queue/check for this many
+    # seconds are evicted before pairing. The page polls every ~1.2s, but
+    # browsers throttle timers in background tabs to about once a minute;
+    # an evicted client is told "not_queued" and joins again.
+    "HEARTBEAT_TIMEOUT": 90,
+    # Pairing runs in `manage.py run_matchmaker`. Set this to also run a
+    # full tick inside every queue join/check request: only for a single
+    # development process with no matchmaker running.
+    "PAIR_IN_REQUEST": os.getenv("MATCHMAKING_PAIR_IN_REQUEST", "0") == "1",
+}
+
+# --------------------------------------------------------------------------------------
+# Question payload cache (per process, see game/questions.py)
+# Saves in this process invalidate through signals; TTL bounds how long an edit
+# made in another process can go unseen.
+# --------------------------------------------------------------------------------------
+QUESTION_CACHE = {
+    "MAX_ENTRIES": 5000,
+    "TTL": 300,
+    # Load the whole bank (up to MAX_ENTRIES) in one query on first use.
+    "WARM": True,
+    # Seconds between checks for questions added/changed/removed by other
+    # processes in the sampling pool.
+    "POOL_REFRESH": 30,
+}
+
+# --------------------------------------------------------------------------------------
+# Match state cache (see game/state_cache.py): per-process, write-through, kept
+# coherent across workers by a Postgres NOTIFY per state change.
+# MATCH_STATE_CACHE_BACKEND="" turns it off.
+# --------------------------------------------------------------------------------------
+MATCH_STATE_CACHE = {
+    "BACKEND": os.getenv("MATCH_STATE_CACHE_BACKEND", "game.state_cache.LocalMatchStateCache"),
+    "MAX_ENTRIES": 10000,
+}
+
+# --------------------------------------------------------------------------------------
+# Leaderboard rank index (per process, see game/leaderboard.py)
+# --------------------------------------------------------------------------------------
+LEADERBOARD = {
+    # Seconds a process may serve ranks before pulling in changed elo_ratings rows.
+    "REFRESH": 5,
+    "MAX_LIMIT": 200,
+}
+
+# --------------------------------------------------------------------------------------
+# Write-behind for game_results / match_events (see game/writebehind.py)
+# Queued rows live in worker memory until flushed, and are lost if the process is
+# killed: off by default, for answers and the match event log alike.
+# --------------------------------------------------------------------------------------
+WRITE_BEHIND = {
+    "ENABLED": os.getenv("WRITE_BEHIND", "0") == "1",
+    "EVENTS": os.getenv("WRITE_BEHIND_EVENTS", "0") == "1",
+    # Flush when this many rows are queued, or when the oldest is this old (seconds).
+    "MAX_ROWS": 500,
+    "MAX_DELAY": 0.5,
+}
+
+# --------------------------------------------------------------------------------------
+# Match ratings (see game/rating.py): expected-score ELO, applied once per finished match
+# --------------------------------------------------------------------------------------
+RATING = {
+    "K_FACTOR": int(os.getenv("ELO_K_FACTOR", "32")),
+    "BASE": 1000,  # rating of a player's first match
+}
+
+# --------------------------------------------------------------------------------------
+# Monthly partitions of game_results / match_events (see game/partitions.py)
+# --------------------------------------------------------------------------------------
+PARTITIONS = {
+    # Match ids set aside per month; each month's matches start at a multiple of this.
+    "MATCH_ID_BLOCK": 1_000_000_000,
+    # Partitions created ahead of the current month by manage.py maintain_partitions.
+    "AHEAD_MONTHS": 1,
+    # manage.py archive_partitions: months a partition's matches stay online, and
+    # where the exported files go.
+    "ARCHIVE_AFTER_MONTHS": 6,
+    "ARCHIVE_DIR": os.getenv("PARTITION_ARCHIVE_DIR", str(BASE_DIR / "archive")),
+}
+
+# --------------------------------------------------------------------------------------
+# Coding answer judge (see game/judge.py, game/sandbox.py)
+# --------------------------------------------------------------------------------------
+JUDGE = {
+    # "forkserver": submissions fork from warm sandbox parents; "cold": a fresh
+    # interpreter per submission.
+    "MODE": os.getenv("JUDGE_MODE", "forkserver"),
+    # Sandboxes running at once per process.
+    "WORKERS": int(os.getenv("JUDGE_WORKERS", "0")) or os.cpu_count() or 1,
+    # A submission's test cases are split over up to WORKERS sandboxes, at
+    # least this many cases each (forking and compiling again per shard
+    # isn't worth it for a few fast cases).
+    "SHARD_MIN_CASES": 8,
+    # Warm parents are replaced after this many submissions.
+    "RECYCLE_AFTER": 200,
+    # Limits when Coding.time_threshold / space_threshold are null.
+    "TIME_MS": 1000,   # per test case
+    "MEMORY_MB": 256,
+    # Wall-clock allowance on top of the time limits (compiling the submission etc.).
+    "GRACE_S": 1.0,
+    # A single case is stopped (and is "time_limit") after this many times
+    # its time limit of wall-clock time, so one that sleeps or waits can't
+    # hold a sandbox until the whole shard's budget runs out.
+    "CASE_WALL_FACTOR": 2,
+    # User sandboxes run as, e.g. "nobody": the server then needs CAP_SETUID
+    # and CAP_SETGID, and that user needs to read the Python install and
+    # game/sandbox.py. Empty: the server's own; see game/judge.py.
+    "USER": os.getenv("JUDGE_USER", ""),
+    "MAX_CODE_BYTES": 64 * 1024,
+    "MAX_OUTPUT_BYTES": 1 << 20,  # from one sandbox; it's killed past this
 }
 
 # --------------------------------------------------------------------------------------
@@ -0,0 +1,250 @@
+# game/answers.py
+"""
+The submit hot path: record an answer and update the match score in one statement.
+
+record_answer() upserts the game_results row with INSERT ... ON CONFLICT
+(match_id, player_id, question_id) DO UPDATE and, in the same statement,
+adds the change in that player's correct answers (+1, 0 or -1) to
+Match.p1_score/p2_score. Re-submitting a correct answer doesn't count twice,
+and changing it to a wrong one takes the point back. When the score moves,
+state_version is bumped and the state cache NOTIFY is sent too, so finishing
+a match doesn't recount anything. created_at keeps the first submit's time.
+
+The change is worked out from the row's previous is_correct, so that read
+must see the latest committed row. The upsert is therefore preceded, in the
+same round trip and transaction, by a FOR NO KEY UPDATE on the match row
+(the lock the score UPDATE takes anyway, and the one finish_matches waits
+on): submits to one match take turns, and the upsert's snapshot is taken
+after the previous one committed. The same snapshot decides whether the
+match is still open: an answer to a match that was finished meanwhile
+(the coding judge takes a while) is not recorded at all.
+
+Ratings are not touched here: they move once per finished match (game/rating.py).
+
+record_answers() is the same thing for a batch of rows (the write-behind
+buffer's flush): one statement however many rows there are, after locking
+every match in the batch in id order. Rows for matches finished meanwhile
+are dropped rather than move a final score.
+reconcile_scores() checks the counters against game_results
+(manage.py reconcile_scores).
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+import json
+
+from django.db import connection
+from django.utils import timezone
+
+from .models import GameResult, Match
+from .state_cache import CHANNEL as STATE_CHANNEL
+
+# Same columns/order as state_cache._FIELDS, so the row can be cached as is.
+_MATCH_COLUMNS = ", ".join(f"m.{f.column}" for f in Match._meta.concrete_fields)
+
+# Sent ahead of the upserts in the same query, so their snapshots are taken
+# once the lock is held. Batches lock their matches in id order.
+_LOCK_MATCH_SQL = f"""
+SELECT 1 FROM {Match._meta.db_table} WHERE id = %(match_id)s FOR NO KEY UPDATE;
+"""
+
+_LOCK_MATCHES_SQL = f"""
+SELECT 1 FROM {Match._meta.db_table} WHERE id = ANY(%(match_id)s::bigint[]) ORDER BY id FOR NO KEY UPDATE;
+"""
+
+_UPSERT_SQL = f"""
+WITH open AS (
+    -- A match finished (by the clock or a finish request) since the view
+    -- looked at it has a final score.
+    SELECT id FROM {Match._meta.db_table}
+    WHERE id = %(match_id)s AND status IN ('pending', 'active') AND NOT rated
+), prev AS (
+    SELECT is_correct FROM {GameResult._meta.db_table}
+    WHERE match_id = %(match_id)s AND player_id = %(player_id)s AND question_id = %(question_id)s
+), res AS (
+    INSERT INTO {GameResult._meta.db_table}
+        (match_id, player_id, question_id, question_kind, answer, is_correct, elapsed_ms, created_at)
+    SELECT id, %(player_id)s, %(question_id)s, %(question_kind)s, %(answer)s,
+           %(is_correct)s, %(elapsed_ms)s, %(now)s
+    FROM open
+    ON CONFLICT (match_id, player_id, question_id) DO UPDATE
+        SET question_kind = EXCLUDED.question_kind,
+            answer = EXCLUDED.answer,
+            is_correct = EXCLUDED.is_correct,
+            elapsed_ms = EXCLUDED.elapsed_ms
+    RETURNING is_correct
+), delta AS (
+    -- +1 / 0 / -1 correct answers
+    SELECT res.is_correct::int - COALESCE((SELECT is_correct FROM prev), false)::int AS c
+    FROM res
+), score AS (
+    UPDATE {Match._meta.db_table} m
+    SET p1_score = m.p1_score + CASE WHEN m.player1_id = %(player_id)s THEN delta.c ELSE 0 END,
+        p2_score = m.p2_score + CASE WHEN m.player2_id = %(player_id)s THEN delta.c ELSE 0 END,
+        state_version = m.state_version + 1
+    FROM delta
+    WHERE m.id = %(match_id)s AND delta.c <> 0
+    RETURNING {_MATCH_COLUMNS}
+)
+SELECT (SELECT COUNT(*) FROM res),
+       CASE WHEN m.id IS NOT NULL
+            THEN pg_notify(%(channel)s, m.id || ':' || m.state_version) END,
+       m.*
+FROM (SELECT 1) one LEFT JOIN score m ON true
+"""
+
+
+_BATCH_UPSERT_SQL = f"""
+WITH input AS (
+    SELECT * FROM unnest(%(match_id)s::bigint[], %(player_id)s::int[], %(question_id)s::bigint[],
+                         %(question_kind)s::text[], %(answer)s::jsonb[], %(is_correct)s::bool[],
+                         %(elapsed_ms)s::int[], %(created_at)s::timestamptz[])
+        AS t(match_id, player_id, question_id, question_kind, answer, is_correct, elapsed_ms, created_at)
+    -- Rows queued before a match ended but flushed after it was finished
+    -- (by another worker or the clock) would change a score that's final.
+    WHERE t.match_id IN (SELECT id FROM {Match._meta.db_table}
+                         WHERE id = ANY(%(match_id)s::bigint[]) AND status IN ('pending', 'active') AND NOT rated)
+), prev AS (
+    SELECT g.match_id, g.player_id, g.is_correct FROM {GameResult._meta.db_table} g
+    JOIN input i USING (match_id, player_id, question_id)
+), res AS (
+    INSERT INTO {GameResult._meta.db_table}
+        (match_id, player_id, question_id, question_kind, answer, is_correct, elapsed_ms, created_at)
+    SELECT * FROM input
+    ON CONFLICT (match_id, player_id, question_id) DO UPDATE
+        SET question_kind = EXCLUDED.question_kind,
+            answer = EXCLUDED.answer,
+            is_correct = EXCLUDED.is_correct,
+            elapsed_ms = EXCLUDED.elapsed_ms
+    RETURNING match_id, player_id, is_correct
+), delta AS (
+    -- change in correct answers per (match, player)
+    SELECT match_id, player_id, SUM(c)::int AS c FROM (
+        SELECT match_id, player_id, is_correct::int AS c FROM res
+        UNION ALL
+        SELECT match_id, player_id, -is_correct::int FROM prev
+    ) x GROUP BY match_id, player_id
+), score AS (
+    UPDATE {Match._meta.db_table} m
+    SET p1_score = m.p1_score + s.p1, p2_score = m.p2_score + s.p2, state_version = m.state_version + 1
+    FROM (
+        SELECT d.match_id,
+               SUM(CASE WHEN d.player_id = mm.player1_id THEN d.c ELSE 0 END) AS p1,
+               SUM(CASE WHEN d.player_id = mm.player2_id THEN d.c ELSE 0 END) AS p2
+        FROM delta d JOIN {Match._meta.db_table} mm ON mm.id = d.match_id
+        GROUP BY d.match_id
+    ) s
+    WHERE m.id = s.match_id AND (s.p1 <> 0 OR s.p2 <> 0)
+    RETURNING m.id, m.state_version
+)
+SELECT (SELECT COUNT(*) FROM res), COUNT(pg_notify(%(channel)s, id || ':' || state_version)) FROM score
+"""
+
+_RECONCILE_SQL = f"""
+WITH counted AS (
+    SELECT m.id,
+           COUNT(g.id) FILTER (WHERE g.is_correct AND g.player_id = m.player1_id) AS p1,
+           COUNT(g.id) FILTER (WHERE g.is_correct AND g.player_id = m.player2_id) AS p2
+    FROM {Match._meta.db_table} m
+    LEFT JOIN {GameResult._meta.db_table} g ON g.match_id = m.id
+    WHERE m.id BETWEEN %(first_id)s AND %(last_id)s
+    GROUP BY m.id
+), wrong AS (
+    SELECT m.id, m.p1_score, m.p2_score, c.p1, c.p2
+    FROM {Match._meta.db_table} m JOIN counted c USING (id)
+    WHERE (m.p1_score, m.p2_score) <> (c.p1, c.p2)
+), fixed AS (
+    -- Relative, so an answer recorded concurrently still counts once.
+    UPDATE {Match._meta.db_table} m
+    SET p1_score = m.p1_score + (w.p1 - w.p1_score),
+        p2_score = m.p2_score + (w.p2 - w.p2_score),
+        state_version = m.state_version + 1
+    FROM wrong w
+    WHERE m.id = w.id AND %(fix)s
+    RETURNING m.id, m.state_version
+)
+SELECT w.id, w.p1_score, w.p2_score, w.p1, w.p2,
+       (SELECT pg_notify(%(channel)s, f.id || ':' || f.state_version) FROM fixed f WHERE f.id = w.id)
+FROM wrong w
+ORDER BY w.id
+"""
+
+_BATCH_COLUMNS = ("match_id", "player_id", "question_id", "question_kind",
+                  "answer", "is_correct", "elapsed_ms", "created_at")
+
+@dataclass(frozen=True)
+class AnswerOutcome:
+    # The match row after its score changed (state_version bumped, NOTIFY sent);
+    # None when the score didn't move.
+    match: Match | None = None
+    # Nothing was recorded: the match was finished (or rated) by then.
+    match_finished: bool = False
+
+
+@dataclass(frozen=True)
+class ScoreMismatch:
+    match_id: int
+    stored: tuple[int, int]   # (p1_score, p2_score) on the match
+    counted: tuple[int, int]  # correct rows in game_results
+
+
+def _match_from_row(values) -> Match:
+    fields = Match._meta.concrete_fields
+    values = [f.from_db_value(v, None, connection) if hasattr(f, "from_db_value") else v
+              for f, v in zip(fields, values)]
+    return Match.from_db(connection.alias, [f.attname for f in fields], values)
+
+
+def record_answer(match_id: int, player_id: int, question_id: int, question_kind: str,
+                  answer: dict, is_correct: bool, elapsed_ms: int | None) -> AnswerOutcome:
+    """
+    Upsert the answer and apply the score change: one round trip, one
+    transaction. Nothing is written if the match is no longer pending or
+    active (or already rated); the outcome says match_finished then.
+    """
+    with connection.cursor() as cur:
+        cur.execute(_LOCK_MATCH_SQL + _UPSERT_SQL, {
+            "match_id": match_id,
+            "player_id": player_id,
+            "question_id": question_id,
+            "question_kind": question_kind,
+            "answer": json.dumps(answer),
+            "is_correct": bool(is_correct),
+            "elapsed_ms": elapsed_ms,
+            "now": timezone.now(),
+            "channel": STATE_CHANNEL,
+        })
+        written, _, *match_row = cur.fetchone()
+    if not written:
+        return AnswerOutcome(match_finished=True)
+    return AnswerOutcome(_match_from_row(match_row) if match_row[0] is not None else None)
+
+
+def record_answers(rows: list[dict]) -> int:
+    """
+    Batch form of record_answer(). rows are dicts with the _BATCH_COLUMNS keys
+    and must not repeat a (match_id, player_id, question_id) key. Rows for
+    matches that are no longer pending or active (or already rated) are
+    dropped. Returns how many rows were written.
+    """
+    if not rows:
+        return 0
+    params = {col: [row[col] for row in rows] for col in _BATCH_COLUMNS}
+    params["answer"] = [json.dumps(a) for a in params["answer"]]
+    params["channel"] = STATE_CHANNEL
+    with connection.cursor() as cur:
+        cur.execute(_LOCK_MATCHES_SQL + _BATCH_UPSERT_SQL, params)
+        return cur.fetchone()[0]
+
+
+def reconcile_scores(first_id: int, last_id: int, fix: bool = False) -> list[ScoreMismatch]:
+    """
+    Compare p1_score/p2_score of matches first_id..last_id with their correct
+    game_results rows, in one statement. With fix=True the scores are corrected
+    (and state_version bumped) in the same statement.
+    """
+    with connection.cursor() as cur:
+        cur.execute(_RECONCILE_SQL, {
+            "first_id": first_id, "last_id": last_id, "fix": fix, "channel": STATE_CHANNEL,
+        })
+        return [ScoreMismatch(row[0], (row[1], row[2]), (row[3], row[4])) for row in cur.fetchall()]
@@ -0,0 +1,96 @@
+# game/clock.py
+"""
+Server-side match clock.
+
+A min-heap of (due_at, match_id, action) with two entries per match: "activate"
+at begin_at and "finish" at begin_at + MATCH_DURATION_SECONDS (plus
+writebehind.finish_grace(), for answers still queued in the workers). Each
+tick pops everything that is due and hands it to lifecycle.activate_matches() /
+finish_matches() as one batch, so matches whose players walked away still get
+their timeout rows and final scores.
+
+New matches are picked up by an incremental scan on countdown_started_at (the
+moment begin_at gets set), with some overlap for transactions that committed
+late. A periodic full scan catches anything else, e.g. rows that were locked
+by another clock when their turn came.
+"""
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+import heapq
+import logging
+
+from django.utils import timezone
+
+from . import writebehind
+from .lifecycle import activate_matches, finish_matches
+from .models import Match, MATCH_DURATION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+ACTIVATE = "activate"
+FINISH = "finish"
+
+
+class MatchClock:
+    def __init__(self, scan_overlap: float = 5.0, full_scan_every: float = 30.0):
+        self.scan_overlap = timedelta(seconds=scan_overlap)
+        self.full_scan_every = timedelta(seconds=full_scan_every)
+        self._heap: list[tuple[float, int, str]] = []
+        self._scheduled: set[tuple[int, str]] = set()
+        self._scanned_at: datetime | None = None
+        self._full_scan_at: datetime | None = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, match_id: int, status: str, begin_at: datetime) -> None:
+        start = begin_at.timestamp()
+        due = [(start + MATCH_DURATION_SECONDS + writebehind.finish_grace(), FINISH)]
+        if status == "pending":
+            due.append((start, ACTIVATE))
+        for at, action in due:
+            if (match_id, action) not in self._scheduled:
+                self._scheduled.add((match_id, action))
+                heapq.heappush(self._heap, (at, match_id, action))
+
+    def scan(self, now: datetime | None = None) -> int:
+        """Schedule open matches with a begin_at; incremental unless a full scan is due."""
+        now = now or timezone.now()
+        qs = Match.objects.filter(status__in=["pending", "active"], begin_at__isnull=False)
+        if self._full_scan_at is not None and now - self._full_scan_at < self.full_scan_every:
+            qs = qs.filter(countdown_started_at__gte=self._scanned_at - self.scan_overlap)
+        else:
+            self._full_scan_at = now
+        before = len(self._heap)
+        for match_id, status, begin_at in qs.values_list("id", "status", "begin_at").iterator():
+            self.schedule(match_id, status, begin_at)
+        self._scanned_at = now
+        return len(self._heap) - before
+
+    def pop_due(self, now: datetime) -> tuple[list[int], list[int]]:
+        """Remove and return (match ids to activate, match ids to finish) due by now."""
+        ts = now.timestamp()
+        activate: list[int] = []
+        finish: list[int] = []
+        while self._heap and self._heap[0][0] <= ts:
+            _, match_id, action = heapq.heappop(self._heap)
+            self._scheduled.discard((match_id, action))
+            (activate if action == ACTIVATE else finish).append(match_id)
+        return activate, finish
+
+    def seconds_until_next(self, now: datetime | None = None) -> float | None:
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - (now or timezone.now()).timestamp())
+
+    def tick(self, now: datetime | None = None) -> tuple[int, int]:
+        """Scan, then apply every due transition. Returns (activated, finished)."""
+        now = now or timezone.now()
+        self.scan(now)
+        activate, finish = self.pop_due(now)
+        # A match that is also due to finish skips straight to finished.
+        activate = [mid for mid in activate if mid not in set(finish)]
+        activated = activate_matches(activate, now) if activate else []
+        finished = finish_matches(finish, now) if finish else []
+        return len(activated), len(finished)
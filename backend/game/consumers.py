@@ -0,0 +1,60 @@
+# game/consumers.py
+from __future__ import annotations
+
+from urllib.parse import parse_qs
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from .realtime import match_group
+
+
+class GameConsumer(AsyncJsonWebsocketConsumer):
+    """
+    ws/game/<match_id>/?user_id=<id>
+
+    Relays the match group's state broadcasts to one player. Each message only
+    carries the fields that changed since the last one this socket received:
+        {"type": "state", "delta": {...}}
+    The first message after connecting (or after {"type": "resync"}) is the
+    full state. Clients load the initial state over HTTP as before.
+    """
+
+    async def connect(self):
+        match_id = self.scope["url_route"]["kwargs"]["match_id"]
+        if not str(match_id).isdigit():
+            await self.close(code=4400)
+            return
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        user_id = (query.get("user_id") or [""])[0]
+        self.user_id = int(user_id) if user_id.isdigit() else None
+        self.group_name = match_group(int(match_id))
+        self.last_sent: dict = {}
+
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, code):
+        if hasattr(self, "group_name"):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        kind = content.get("type")
+        if kind == "ping":
+            await self.send_json({"type": "pong"})
+        elif kind == "resync":
+            self.last_sent = {}
+
+    async def match_state(self, event):
+        state = dict(event["state"])
+        # Broadcasts are player-neutral; fill in this socket's point of view.
+        if self.user_id is not None:
+            if state.get("player1_id") == self.user_id:
+                state["you_ready"], state["opponent_ready"] = state.get("p1_ready"), state.get("p2_ready")
+            elif state.get("player2_id") == self.user_id:
+                state["you_ready"], state["opponent_ready"] = state.get("p2_ready"), state.get("p1_ready")
+
+        delta = {k: v for k, v in state.items() if k not in self.last_sent or self.last_sent[k] != v}
+        if not delta:
+            return
+        self.last_sent.update(delta)
+        await self.send_json({"type": "state", "delta": delta})
@@ -0,0 +1,516 @@
+# game/judge.py
+"""
+Judge for coding answers: runs a Python submission against a Coding
+question's test_cases and returns a verdict per test case.
+
+A submission defines solve(); test case {"args": [...], "expected": ...}
+passes when solve(*args) returns expected (compared after a JSON round
+trip, so tuples equal lists). It runs in game/sandbox.py: a separate
+interpreter, resource-limited with setrlimit and unable to open sockets or
+files (see that module). The sandbox sends back solve()'s
+return values, with each case's CPU time and peak memory as measured by
+its supervisor rather than by the submission; expected values stay in this
+process.
+
+Thresholds (Coding.time_threshold / space_threshold, JUDGE defaults when null):
+  * time: milliseconds of CPU per test case. A case that takes longer is
+    "time_limit", and so is one still running after JUDGE["CASE_WALL_FACTOR"]
+    times that in wall-clock time. A sandbox gets that much CPU per case it
+    runs (+1 s), and that much wall-clock time (+ JUDGE["GRACE_S"]). Cases
+    still unfinished when either runs out are "time_limit" too;
+  * space: megabytes the submission may allocate. A MemoryError, or a case
+    whose peak resident memory grew by more than that, is "memory_limit".
+Each case's time and peak memory are kept in its CaseResult.
+
+A large suite is split into shards (see shards()) run in sandboxes at once,
+so its time to a verdict is that of the slowest shard rather than the sum.
+Each case is checked as its output arrives; with stop_on_failure
+(Coding.stop_on_failure) the first failing one kills every shard, and the
+cases that hadn't finished are "skipped".
+
+Two ways to run sandboxes (JUDGE["MODE"]), both running up to
+JUDGE["WORKERS"] at once, so throughput scales with cores:
+  * "cold", JudgePool: a fresh interpreter per sandbox. That many are
+    kept started, and each sandbox run takes one and starts its replacement.
+    That is tens of milliseconds of interpreter startup per run,
+    which adds to the time to a verdict once submissions arrive faster than
+    the spares boot;
+  * "forkserver" (the default), ForkServerPool: that many warm sandbox parents
+    with the harness imported and each question's test case args loaded.
+    A sandbox run is a fork() of one; a parent is replaced after
+    JUDGE["RECYCLE_AFTER"] submissions.
+manage.py bench_judge compares the two (submissions/s, p50/p99 time to verdict).
+
+Run the server as an unprivileged user: root isn't held to RLIMIT_NPROC.
+Sandboxes run as the server's user unless JUDGE["USER"] names another, so
+by default a submission can signal any process of that user, the web
+workers and other sandboxes included. In production set JUDGE["USER"] to a user of its
+own (and give the server CAP_SETUID/CAP_SETGID for it), or run the server
+in a container of its own.
+"""
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import atexit
+import hashlib
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from typing import Callable
+import pwd
+import queue
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import models
+
+logger = logging.getLogger(__name__)
+
+SANDBOX = Path(__file__).with_name("sandbox.py")
+# How often a shard waiting for a free sandbox checks whether it's still wanted.
+CANCEL_POLL_S = 0.02
+
+
+class Verdict(models.TextChoices):
+    ACCEPTED = "accepted", "Accepted"            # every test case passed
+    PASSED = "passed", "Passed"                  # (one test case)
+    WRONG_ANSWER = "wrong_answer", "Wrong answer"
+    RUNTIME_ERROR = "runtime_error", "Runtime error"
+    TIME_LIMIT = "time_limit", "Time limit exceeded"
+    MEMORY_LIMIT = "memory_limit", "Memory limit exceeded"
+    COMPILE_ERROR = "compile_error", "Compile error"  # syntax error, or no solve()
+    SKIPPED = "skipped", "Not run"               # (one test case) stopped at an earlier failure
+
+
+@dataclass(frozen=True)
+class CaseResult:
+    verdict: str
+    elapsed_ms: float | None  # CPU time, as measured by the sandbox; None if it never finished
+    error: str | None = None  # exception raised by solve()
+    memory_kb: int | None = None  # peak resident memory while it ran, as measured by the sandbox
+
+    def as_json(self) -> dict:
+        return {
+            "verdict": self.verdict,
+            "ms": None if self.elapsed_ms is None else round(self.elapsed_ms, 3),
+            "kb": self.memory_kb,
+        }
+
+
+@dataclass(frozen=True)
+class JudgeResult:
+    verdict: str  # ACCEPTED, COMPILE_ERROR or the first failing case's verdict
+    cases: tuple[CaseResult, ...]
+    elapsed_ms: float  # whole run, as seen from here
+    error: str | None = None  # compile error
+    time_ms: int | None = None  # the limits it was judged against
+    memory_mb: int | None = None
+
+    @property
+    def passed(self) -> bool:
+        return self.verdict == Verdict.ACCEPTED
+
+
+@dataclass(frozen=True)
+class SandboxRun:
+    lines: list[dict]  # the sandbox's output lines
+    status: int  # exit status; negative: killed by that signal
+    timed_out: bool = False  # killed for running past the timeout
+    cancelled: bool = False  # killed (or never started) because cancel was set
+
+
+class Cancel:
+    """
+    Set by one shard of a submission to stop the others. Backed by a pipe so
+    the pools can wait on it together with sandbox output (selectors).
+    """
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        self.is_set = False
+
+    def fileno(self) -> int:
+        return self._r
+
+    def set(self) -> None:
+        if not self.is_set:
+            self.is_set = True
+            os.write(self._w, b"x")
+
+    def close(self) -> None:
+        os.close(self._r)
+        os.close(self._w)
+
+
+def _acquire(slots: threading.Semaphore, cancel: Cancel | None) -> bool:
+    """Wait for a pool slot; False (and no slot) if cancel is set first."""
+    if cancel is None:
+        return slots.acquire()
+    while not slots.acquire(timeout=CANCEL_POLL_S):
+        if cancel.is_set:
+            return False
+    if cancel.is_set:
+        slots.release()
+        return False
+    return True
+
+
+def _parse(line: bytes) -> dict | None:
+    try:
+        obj = json.loads(line)
+    except ValueError:
+        return None
+    return obj if isinstance(obj, dict) else None
+
+
+def _spawn(args: list[str]) -> subprocess.Popen:
+    """A sandbox interpreter, as JUDGE["USER"] (and that user's group only) if set."""
+    user = settings.JUDGE["USER"] and pwd.getpwnam(settings.JUDGE["USER"])
+    return subprocess.Popen(
+        [sys.executable, "-I", "-S", str(SANDBOX), *args],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        env={}, cwd="/", start_new_session=True,
+        **({"user": user.pw_uid, "group": user.pw_gid, "extra_groups": []} if user else {}),
+    )
+
+
+class JudgePool:
+    """
+    Runs up to `workers` submissions at once, each in its own sandbox
+    interpreter. As many idle interpreters are kept started (imports done),
+    so a submission doesn't wait for one to boot.
+    """
+
+    def __init__(self, workers: int, max_output: int = 1 << 20):
+        self.workers = workers
+        self.max_output = max_output
+        self._slots = threading.BoundedSemaphore(workers)
+        self._idle: queue.SimpleQueue[subprocess.Popen] = queue.SimpleQueue()
+        self._closed = False
+        for _ in range(workers):
+            self._idle.put(self._start())
+
+    def _start(self) -> subprocess.Popen:
+        return _spawn([])
+
+    def run(self, job: dict, timeout: float, on_line: Callable[[dict], object] | None = None,
+            cancel: Cancel | None = None) -> SandboxRun:
+        """
+        Send job to a sandbox and collect its output lines, passing each to
+        on_line as it arrives. The sandbox is killed once cancel is set.
+        """
+        payload = json.dumps(job).encode()
+        if not _acquire(self._slots, cancel):
+            return SandboxRun([], 0, cancelled=True)
+        try:
+            proc = self._idle.get()
+            if not self._closed:
+                self._idle.put(self._start())
+            return self._communicate(proc, payload, timeout, on_line, cancel)
+        finally:
+            self._slots.release()
+
+    def _communicate(self, proc: subprocess.Popen, payload: bytes, timeout: float,
+                     on_line: Callable[[dict], object] | None, cancel: Cancel | None) -> SandboxRun:
+        deadline = time.monotonic() + timeout
+        try:
+            proc.stdin.write(payload)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass  # died at startup; the exit status says so
+        lines: list[dict] = []
+        buf, size, timed_out, cancelled = b"", 0, False, False
+        with selectors.DefaultSelector() as sel:
+            sel.register(proc.stdout, selectors.EVENT_READ)
+            if cancel is not None:
+                sel.register(cancel, selectors.EVENT_READ)
+            while True:
+                if cancel is not None and cancel.is_set:
+                    cancelled = True
+                    break
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    timed_out = True
+                    break
+                ready = {key.fd for key, _ in sel.select(left)}
+                if proc.stdout.fileno() not in ready:
+                    continue
+                chunk = os.read(proc.stdout.fileno(), 65536)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > self.max_output:
+                    logger.warning("Judge: sandbox output over %s bytes; killed", self.max_output)
+                    break
+                *complete, buf = (buf + chunk).split(b"\n")
+                for line in filter(None, map(_parse, complete)):
+                    lines.append(line)
+                    if on_line is not None:
+                        on_line(line)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)  # and anything it managed to start
+        except ProcessLookupError:
+            pass
+        status = proc.wait()
+        proc.stdout.close()
+        return SandboxRun(lines, status, timed_out, cancelled)
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                proc = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            proc.kill()
+            proc.wait()
+
+
+class _Server:
+    """One warm sandbox parent (sandbox.py --serve) and what it has loaded."""
+
+    def __init__(self, max_output: int):
+        self.proc = _spawn(["--serve", str(max_output)])
+        self.keys: set[str] = set()  # questions whose args it holds
+        self.jobs = 0
+        self._buf = bytearray()
+
+    def request(self, job: dict, timeout: float, on_line: Callable[[dict], object] | None = None,
+                cancel: Cancel | None = None) -> SandboxRun:
+        key = job["key"]
+        deadline = time.monotonic() + timeout
+        self._send({k: v for k, v in job.items() if k != "args" or key not in self.keys})
+        lines: list[dict] = []
+        cancelling = False
+        while True:
+            message = self._read(deadline, None if cancelling else cancel)
+            if message is None:  # cancel was set
+                self._send({"cancel": True})
+                cancelling = True
+            elif message.get("need_args"):
+                if cancelling:
+                    return SandboxRun([], 0, cancelled=True)
+                self._send(job)
+            elif "out" in message:
+                if isinstance(message["out"], dict):
+                    lines.append(message["out"])
+                    if on_line is not None:
+                        on_line(message["out"])
+            elif message.get("done"):
+                self.keys.add(key)
+                self.jobs += 1
+                return SandboxRun(lines, 0, message["timed_out"], message["cancelled"])
+
+    def _send(self, message: dict) -> None:
+        self.proc.stdin.write(json.dumps(message).encode() + b"\n")
+        self.proc.stdin.flush()
+
+    def _read(self, deadline: float, cancel: Cancel | None) -> dict | None:
+        """The parent's next line, or None as soon as cancel is set."""
+        fd = self.proc.stdout.fileno()
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            if cancel is not None:
+                sel.register(cancel, selectors.EVENT_READ)
+            while b"\n" not in self._buf:
+                if cancel is not None and cancel.is_set:
+                    return None
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError("sandbox parent didn't answer")
+                if fd in {key.fd for key, _ in sel.select(left)}:
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        raise EOFError("sandbox parent exited")
+                    self._buf += chunk
+        line, _, rest = bytes(self._buf).partition(b"\n")
+        self._buf = bytearray(rest)
+        return json.loads(line)
+
+    def close(self) -> None:
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+
+class ForkServerPool:
+    """
+    Runs up to `workers` submissions at once, each forked from one of as
+    many warm sandbox parents. A parent that served recycle_after
+    submissions, or misbehaved, is replaced.
+    """
+
+    def __init__(self, workers: int, max_output: int = 1 << 20, recycle_after: int = 200):
+        self.workers = workers
+        self.max_output = max_output
+        self.recycle_after = recycle_after
+        self._slots = threading.BoundedSemaphore(workers)
+        self._idle: queue.SimpleQueue[_Server] = queue.SimpleQueue()
+        self._closed = False
+        for _ in range(workers):
+            self._idle.put(_Server(max_output))
+
+    def run(self, job: dict, timeout: float, on_line: Callable[[dict], object] | None = None,
+            cancel: Cancel | None = None) -> SandboxRun:
+        """Same contract as JudgePool.run()."""
+        key = job.get("key") or hashlib.sha1(json.dumps(job["args"]).encode()).hexdigest()
+        job = {**job, "key": key}
+        if not _acquire(self._slots, cancel):
+            return SandboxRun([], 0, cancelled=True)
+        server = self._idle.get()
+        ok = False
+        try:
+            # The parent enforces job["timeout"]; the extra second covers the round trip.
+            result = server.request(job, timeout + 1, on_line, cancel)
+            ok = True
+            return result
+        except (OSError, EOFError, ValueError, KeyError) as e:  # TimeoutError is an OSError
+            logger.warning("Judge: sandbox parent failed (%s); replaced", e)
+            return SandboxRun([], -signal.SIGKILL, isinstance(e, TimeoutError))
+        finally:
+            if ok and server.jobs < self.recycle_after and not self._closed:
+                self._idle.put(server)
+            else:
+                server.close()
+                if not self._closed:
+                    self._idle.put(_Server(self.max_output))
+            self._slots.release()
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                server = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            server.close()
+
+
+_pool: JudgePool | ForkServerPool | None = None
+_pool_pid: int | None = None
+_pool_lock = threading.Lock()
+
+
+def make_pool(mode: str, workers: int) -> JudgePool | ForkServerPool:
+    if mode == "cold":
+        return JudgePool(workers, settings.JUDGE["MAX_OUTPUT_BYTES"])
+    if mode == "forkserver":
+        return ForkServerPool(workers, settings.JUDGE["MAX_OUTPUT_BYTES"], settings.JUDGE["RECYCLE_AFTER"])
+    raise ValueError(f"unknown judge mode {mode!r}")
+
+
+def get_pool() -> JudgePool | ForkServerPool:
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():  # not the parent's after a fork
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = make_pool(settings.JUDGE["MODE"], settings.JUDGE["WORKERS"])
+                _pool_pid = os.getpid()
+                atexit.register(_pool.close)
+    return _pool
+
+
+def shards(n: int, workers: int) -> list[list[int]]:
+    """
+    Test case indices per sandbox: up to `workers` shards of at least
+    JUDGE["SHARD_MIN_CASES"] cases, each taking every k-th case so the
+    (usually larger, slower) cases at the end are spread over all of them.
+    """
+    k = max(1, min(workers, n // settings.JUDGE["SHARD_MIN_CASES"]))
+    return [list(range(j, n, k)) for j in range(k)]
+
+
+def _check(case: dict, out: dict, time_ms: int, memory_mb: int) -> CaseResult:
+    ms, kb = out.get("ms"), out.get("kb")
+    if out.get("time_limit"):
+        return CaseResult(Verdict.TIME_LIMIT, ms, None, kb)
+    if "error" in out:
+        verdict = Verdict.MEMORY_LIMIT if out.get("memory") else Verdict.RUNTIME_ERROR
+        return CaseResult(verdict, ms, str(out["error"]), kb)
+    if ms is not None and ms > time_ms:
+        return CaseResult(Verdict.TIME_LIMIT, ms, None, kb)
+    if kb is not None and kb > memory_mb * 1024:
+        return CaseResult(Verdict.MEMORY_LIMIT, ms, None, kb)
+    if out.get("value") != json.loads(json.dumps(case.get("expected"))):
+        return CaseResult(Verdict.WRONG_ANSWER, ms, None, kb)
+    return CaseResult(Verdict.PASSED, ms, None, kb)
+
+
+def judge(code: str, test_cases: list[dict], time_ms: int | None = None, memory_mb: int | None = None,
+          key: str | None = None, stop_on_failure: bool = False,
+          pool: JudgePool | ForkServerPool | None = None) -> JudgeResult:
+    """
+    Run `code` against test_cases in sandboxes; blocks until the verdict.
+    key names test_cases (CodingSpec.key) so warm sandbox parents can keep them.
+    With stop_on_failure, the first failing case stops the others; the ones
+    that hadn't finished are "skipped".
+    """
+    time_ms = time_ms or settings.JUDGE["TIME_MS"]
+    memory_mb = memory_mb or settings.JUDGE["MEMORY_MB"]
+    pool = pool or get_pool()
+    parts = shards(len(test_cases), pool.workers)
+    results: list[CaseResult | None] = [None] * len(test_cases)
+    compile_errors: list[str] = []
+    cancel = Cancel()
+
+    def run_shard(j: int, indices: list[int]) -> None:
+        def on_line(line: dict) -> None:
+            if "compile_error" in line:
+                compile_errors.append(str(line["compile_error"]))
+                cancel.set()  # every shard will say the same
+                return
+            i = line.get("i")
+            if not isinstance(i, int) or not 0 <= i < len(indices) or results[indices[i]] is not None:
+                return
+            result = results[indices[i]] = _check(test_cases[indices[i]], line, time_ms, memory_mb)
+            if stop_on_failure and result.verdict != Verdict.PASSED:
+                cancel.set()
+
+        budget_s = len(indices) * time_ms / 1000
+        timeout = budget_s + settings.JUDGE["GRACE_S"]
+        job = {
+            "code": code,
+            "args": [test_cases[i].get("args", []) for i in indices],
+            "cpu_s": math.ceil(budget_s) + 1,
+            "memory_mb": memory_mb,
+            "case_timeout": settings.JUDGE["CASE_WALL_FACTOR"] * time_ms / 1000,
+            "timeout": timeout,
+            "key": key and f"{key}:{j}/{len(parts)}",
+        }
+        run = pool.run(job, timeout, on_line, cancel)
+        # Killed by the CPU limit or the wall clock: unfinished cases ran out of time.
+        out_of_time = run.timed_out or run.status in (-signal.SIGXCPU, -signal.SIGKILL)
+        for i in indices:
+            if results[i] is None:
+                verdict = (Verdict.SKIPPED if run.cancelled
+                           else Verdict.TIME_LIMIT if out_of_time else Verdict.RUNTIME_ERROR)
+                results[i] = CaseResult(verdict, None)
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max(1, len(parts) - 1)) as shard_threads:
+            others = [shard_threads.submit(run_shard, j, part) for j, part in enumerate(parts[1:], 1)]
+            run_shard(0, parts[0])
+            for future in others:
+                future.result()
+    finally:
+        cancel.close()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    if compile_errors:
+        return JudgeResult(Verdict.COMPILE_ERROR, (), elapsed_ms, compile_errors[0], time_ms, memory_mb)
+    cases = tuple(results)
+    failed = next((c.verdict for c in cases if c.verdict not in (Verdict.PASSED, Verdict.SKIPPED)), None)
+    return JudgeResult(failed or Verdict.ACCEPTED, cases, elapsed_ms, None, time_ms, memory_mb)
@@ -0,0 +1,331 @@
+# game/layers.py
+"""
+Channel layer on Postgres LISTEN/NOTIFY, so Channels can fan out across worker
+processes without adding Redis. It talks to DATABASES[<database>] directly with
+psycopg2 (not through the Django connection, which is per-thread and sync).
+
+How messages move:
+  * Every process (layer instance) LISTENs on its own inbox channel, plus one
+    Postgres channel per group that has a member in this process.
+  * group_send() is a single NOTIFY on the group's Postgres channel; each
+    listening process delivers it to its own members' queues.
+  * send() to a process-specific channel ("...!xyz") goes straight to the local
+    queue when the channel is ours, otherwise it is NOTIFYed to the owning
+    process's inbox.
+
+Semantics follow InMemoryChannelLayer: per-channel capacity (ChannelFull on
+local send; remote receivers drop and log), message expiry, and group
+membership expiry. Only process-specific channels exist (new_channel()), which
+is all consumers need: sending to a normal channel name raises ValueError. A
+NOTIFY payload is capped at 8000 bytes by Postgres, so larger messages raise
+ValueError too.
+
+Nothing blocks the event loop on the database: connecting, LISTEN and
+UNLISTEN run on one thread of the layer's own (in order), NOTIFYs in the
+default executor.
+"""
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+
+import psycopg2
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAX_PAYLOAD_BYTES = 7999
+
+
+def pg_connect(database: str = "default", application_name: str = "django"):
+    """A raw autocommit psycopg2 connection to DATABASES[database], for LISTEN/NOTIFY."""
+    db = settings.DATABASES[database]
+    conn = psycopg2.connect(
+        dbname=db["NAME"],
+        user=db.get("USER") or None,
+        password=db.get("PASSWORD") or None,
+        host=db.get("HOST") or None,
+        port=db.get("PORT") or None,
+        application_name=application_name,
+    )
+    conn.autocommit = True
+    return conn
+
+
+class PostgresChannelLayer(BaseChannelLayer):
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        database="default",
+        prefix="chl",
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.database = database
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.process_id = uuid.uuid4().hex[:12]
+        self.inbox = f"{prefix}_p_{self.process_id}"
+
+        self._queues: dict[str, asyncio.Queue] = {}
+        self._groups: dict[str, dict[str, float]] = {}  # local members only
+        self._listen_conn = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._opening: asyncio.Task | None = None
+        self._listen_busy = 0  # LISTEN/UNLISTENs queued on _listen_executor
+        self._listen_executor: ThreadPoolExecutor | None = None
+        self._send_conn = None
+        self._send_lock = threading.Lock()
+
+    # Connections ---------------------------------------------------------------
+
+    def _connect(self):
+        return pg_connect(self.database, f"channels-{self.process_id}")
+
+    def _pg_channel(self, group: str) -> str:
+        # Postgres identifiers are capped at 63 bytes; group names can be 100.
+        return f"{self.prefix}_g_{hashlib.sha1(group.encode()).hexdigest()[:24]}"
+
+    def _connect_listener(self, groups: list[str]):
+        conn = self._connect()
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{self.inbox}"')
+            for group in groups:
+                cur.execute(f'LISTEN "{self._pg_channel(group)}"')
+        return conn
+
+    def _in_listen_thread(self, fn, *args):
+        if self._listen_executor is None:
+            self._listen_executor = ThreadPoolExecutor(1, thread_name_prefix=f"channels-{self.process_id}")
+        return asyncio.get_running_loop().run_in_executor(self._listen_executor, fn, *args)
+
+    async def _open_listener(self):
+        try:
+            conn = await self._in_listen_thread(self._connect_listener, list(self._groups))
+            if self._loop is not asyncio.get_running_loop():  # superseded meanwhile
+                conn.close()
+                return
+            self._listen_conn = conn
+            self._loop.add_reader(conn.fileno(), self._on_readable)
+        finally:
+            self._opening = None
+
+    async def _ensure_listener(self):
+        """Open the LISTEN connection on the running loop (the consumers' loop)."""
+        loop = asyncio.get_running_loop()
+        if self._listen_conn is not None and self._loop is loop:
+            return
+        if self._opening is None or self._loop is not loop:
+            self._close_listener()
+            self._loop = loop
+            self._opening = loop.create_task(self._open_listener())
+        await asyncio.shield(self._opening)
+
+    def _close_listener(self):
+        if self._listen_conn is None:
+            return
+        try:
+            if self._loop is not None and not self._loop.is_closed() and not self._listen_busy:
+                self._loop.remove_reader(self._listen_conn.fileno())
+            self._listen_conn.close()
+        except Exception:
+            pass
+        self._listen_conn = None
+
+    def _execute(self, conn, sql: str):
+        with conn.cursor() as cur:
+            cur.execute(sql)
+
+    async def _listen(self, group: str, on: bool):
+        conn = self._listen_conn
+        if conn is None:
+            return
+        verb = "LISTEN" if on else "UNLISTEN"
+        # The connection belongs to the listen thread while commands run on it:
+        # the loop stops polling it until the last one is done, then catches up.
+        if not self._listen_busy:
+            self._loop.remove_reader(conn.fileno())
+        self._listen_busy += 1
+        try:
+            await self._in_listen_thread(self._execute, conn, f'{verb} "{self._pg_channel(group)}"')
+        except psycopg2.OperationalError:
+            pass  # polling it says so, and the reconnect LISTENs to every group again
+        finally:
+            self._listen_busy -= 1
+        if not self._listen_busy and conn is self._listen_conn:
+            self._loop.add_reader(conn.fileno(), self._on_readable)
+            self._on_readable()
+
+    def _notify(self, pg_channel: str, payload: str):
+        """Blocking NOTIFY on a dedicated connection; run in an executor."""
+        with self._send_lock:
+            for attempt in (1, 2):
+                try:
+                    if self._send_conn is None or self._send_conn.closed:
+                        self._send_conn = self._connect()
+                    with self._send_conn.cursor() as cur:
+                        cur.execute("SELECT pg_notify(%s, %s)", [pg_channel, payload])
+                    return
+                except psycopg2.OperationalError:
+                    self._send_conn = None
+                    if attempt == 2:
+                        raise
+
+    async def _publish(self, pg_channel: str, body: dict):
+        payload = json.dumps(body, separators=(",", ":"))
+        if len(payload.encode()) > MAX_PAYLOAD_BYTES:
+            raise ValueError(f"message is {len(payload)} bytes; NOTIFY payloads are limited to 8000")
+        await asyncio.get_running_loop().run_in_executor(None, self._notify, pg_channel, payload)
+
+    # Inbound -------------------------------------------------------------------
+
+    def _on_readable(self):
+        try:
+            self._listen_conn.poll()
+        except psycopg2.OperationalError:
+            logger.warning("Channel layer LISTEN connection lost; reconnecting")
+            self._close_listener()
+            self._loop.call_later(1.0, self._retry_listener)
+            return
+        self._drain()
+
+    def _retry_listener(self):
+        if self._listen_conn is None and self._opening is None:
+            self._loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        try:
+            await self._ensure_listener()
+        except psycopg2.OperationalError:
+            self._loop.call_later(1.0, self._retry_listener)
+
+    def _drain(self):
+        conn = self._listen_conn
+        while conn is not None and conn.notifies:
+            note = conn.notifies.pop(0)
+            try:
+                body = json.loads(note.payload)
+            except ValueError:
+                continue
+            if body["x"] < time.time():
+                continue  # expired in flight
+            if "g" in body:
+                members = self._groups.get(body["g"], {})
+                cutoff = time.time() - self.group_expiry
+                for channel, joined in list(members.items()):
+                    if joined < cutoff:
+                        members.pop(channel, None)
+                        continue
+                    self._deliver(channel, body["x"], body["m"])
+            else:
+                self._deliver(body["c"], body["x"], body["m"])
+
+    def _queue(self, channel: str) -> asyncio.Queue:
+        queue = self._queues.get(channel)
+        if queue is None:
+            queue = self._queues[channel] = asyncio.Queue(maxsize=self.get_capacity(channel))
+        return queue
+
+    def _deliver(self, channel: str, expires: float, message: dict) -> bool:
+        try:
+            self._queue(channel).put_nowait((expires, message))
+            return True
+        except asyncio.QueueFull:
+            logger.warning("Channel %s is full; dropping message", channel)
+            return False
+
+    def _is_local(self, channel: str) -> bool:
+        return "!" in channel and channel[: channel.index("!")].endswith(f".{self.process_id}")
+
+    # Channel layer API ------------------------------------------------------------
+
+    async def new_channel(self, prefix="specific"):
+        await self._ensure_listener()
+        return f"{prefix}.{self.process_id}!{uuid.uuid4().hex[:12]}"
+
+    async def send(self, channel, message):
+        """
+        Send to a process-specific channel from new_channel(), in this process
+        or another. Normal channel names (no "!") have no owner to deliver to
+        here and raise ValueError.
+        """
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        if "!" not in channel:
+            raise ValueError(f"PostgresChannelLayer only supports process-specific channels, not {channel!r}")
+        expires = time.time() + self.expiry
+        if self._is_local(channel) and self._loop is asyncio.get_running_loop():
+            if not self._deliver(channel, expires, dict(message)):
+                raise ChannelFull(channel)
+            return
+        owner = channel[: channel.index("!")].rsplit(".", 1)[-1]
+        await self._publish(f"{self.prefix}_p_{owner}", {"c": channel, "x": expires, "m": message})
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        await self._ensure_listener()
+        queue = self._queue(channel)
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        finally:
+            if queue.empty() and self._queues.get(channel) is queue:
+                del self._queues[channel]
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._ensure_listener()
+        members = self._groups.get(group)
+        if members is None:
+            members = self._groups[group] = {}
+            await self._listen(group, True)
+        members[channel] = time.time()
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        members = self._groups.get(group)
+        if not members:
+            return
+        members.pop(channel, None)
+        if not members:
+            del self._groups[group]
+            await self._listen(group, False)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        await self._publish(self._pg_channel(group), {"g": group, "x": time.time() + self.expiry, "m": message})
+
+    async def flush(self):
+        groups, self._groups = list(self._groups), {}
+        for group in groups:
+            await self._listen(group, False)
+        self._queues = {}
+
+    async def close(self):
+        self._close_listener()
+        if self._listen_executor is not None:
+            self._listen_executor.shutdown(wait=False)
+            self._listen_executor = None
+        with self._send_lock:
+            if self._send_conn is not None:
+                self._send_conn.close()
+                self._send_conn = None
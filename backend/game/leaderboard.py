@@ -0,0 +1,188 @@
+# game/leaderboard.py
+"""
+In-memory rank index over elo_ratings, for the leaderboard endpoints.
+
+Order is (elo DESC, user_id ASC), the same as the old ORDER BY. The index is
+a Fenwick tree of player counts per ELO value plus, per ELO value, a sorted
+list of user ids. That makes rank lookups, k-th lookups and rating changes
+O(log n) (plus a list insert for ties), with no OFFSET scans.
+
+Each process keeps one index, built from elo_ratings on first use. Every
+LEADERBOARD["REFRESH"] seconds it pulls in rows whose updated_at moved, and
+reloads in full if the row count drifts (deleted ratings).
+"""
+from __future__ import annotations
+
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+import threading
+from typing import Iterable
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import EloRating
+
+
+class RankIndex:
+    def __init__(self, lo: int = 0, hi: int = 4000):
+        self._elo: dict[int, int] = {}
+        self._buckets: dict[int, list[int]] = {}
+        self._reset_tree(lo, hi)
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._elo)
+
+    # Fenwick tree over ELO values lo..hi --------------------------------------
+
+    def _reset_tree(self, lo: int, hi: int) -> None:
+        self._lo, self._hi = lo, hi
+        size = hi - lo + 1
+        tree = [0] * (size + 1)
+        for elo, bucket in self._buckets.items():
+            tree[elo - lo + 1] += len(bucket)
+        for i in range(1, size + 1):  # O(size) build
+            j = i + (i & -i)
+            if j <= size:
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _fit(self, elo: int) -> None:
+        if not self._lo <= elo <= self._hi:
+            span = self._hi - self._lo
+            self._reset_tree(min(self._lo, elo - span // 2), max(self._hi, elo + span // 2))
+
+    def _add(self, elo: int, delta: int) -> None:
+        i = elo - self._lo + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _count_upto(self, elo: int) -> int:
+        """Players with rating <= elo."""
+        i = min(elo, self._hi) - self._lo + 1
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _count_above(self, elo: int) -> int:
+        return len(self._elo) - self._count_upto(elo)
+
+    def _elo_at(self, p: int) -> int:
+        """Smallest rating whose cumulative count (ascending) reaches p."""
+        i, step = 0, 1 << (len(self._tree) - 1).bit_length()
+        while step:
+            j = i + step
+            if j < len(self._tree) and self._tree[j] < p:
+                i = j
+                p -= self._tree[j]
+            step >>= 1
+        return i + self._lo  # index i + 1, minus the 1-based offset
+
+    # Updates -------------------------------------------------------------------
+
+    def load(self, rows: Iterable[tuple[int, int]]) -> None:
+        """Replace the contents with (user_id, elo) rows."""
+        elos: dict[int, int] = {}
+        buckets: dict[int, list[int]] = {}
+        for user_id, elo in rows:
+            elos[user_id] = elo
+            buckets.setdefault(elo, []).append(user_id)
+        for bucket in buckets.values():
+            bucket.sort()
+        with self._lock:
+            self._elo, self._buckets = elos, buckets
+            lo = min(buckets, default=self._lo)
+            hi = max(buckets, default=self._hi)
+            self._reset_tree(min(lo, self._lo), max(hi, self._hi))
+
+    def set(self, user_id: int, elo: int) -> None:
+        with self._lock:
+            old = self._elo.get(user_id)
+            if old == elo:
+                return
+            if old is not None:
+                self._remove(user_id, old)
+            self._fit(elo)
+            self._elo[user_id] = elo
+            insort(self._buckets.setdefault(elo, []), user_id)
+            self._add(elo, 1)
+
+    def remove(self, user_id: int) -> None:
+        with self._lock:
+            old = self._elo.get(user_id)
+            if old is not None:
+                self._remove(user_id, old)
+
+    def _remove(self, user_id: int, elo: int) -> None:
+        bucket = self._buckets[elo]
+        del bucket[bisect_left(bucket, user_id)]
+        if not bucket:
+            del self._buckets[elo]
+        del self._elo[user_id]
+        self._add(elo, -1)
+
+    # Queries -------------------------------------------------------------------
+
+    def elo_of(self, user_id: int) -> int | None:
+        return self._elo.get(user_id)
+
+    def rank(self, user_id: int) -> int | None:
+        """1-based rank, or None if the player has no rating."""
+        with self._lock:
+            elo = self._elo.get(user_id)
+            if elo is None:
+                return None
+            return self._count_above(elo) + bisect_left(self._buckets[elo], user_id) + 1
+
+    def position_after(self, elo: int, user_id: int) -> int:
+        """How many players sort at or before the key (elo, user_id); it need not exist."""
+        with self._lock:
+            bucket = self._buckets.get(elo, ())
+            return self._count_above(elo) + bisect_right(bucket, user_id)
+
+    def page(self, start_rank: int, limit: int) -> list[tuple[int, int, int]]:
+        """Up to `limit` (rank, user_id, elo) rows starting at start_rank (1-based)."""
+        out: list[tuple[int, int, int]] = []
+        with self._lock:
+            total = len(self._elo)
+            rank = max(1, start_rank)
+            while len(out) < limit and rank <= total:
+                # rank r from the top is position total - r + 1 from the bottom.
+                elo = self._elo_at(total - rank + 1)
+                bucket = self._buckets[elo]
+                i = rank - self._count_above(elo) - 1
+                for user_id in bucket[i: i + limit - len(out)]:
+                    out.append((rank, user_id, elo))
+                    rank += 1
+        return out
+
+
+_index = RankIndex()
+_refreshed_at: datetime | None = None
+_refresh_lock = threading.Lock()
+
+
+def rank_index() -> RankIndex:
+    """The process-wide index, loaded on first use and refreshed incrementally."""
+    global _refreshed_at
+    now = timezone.now()
+    every = timedelta(seconds=settings.LEADERBOARD["REFRESH"])
+    if _refreshed_at is not None and now - _refreshed_at < every:
+        return _index
+    with _refresh_lock:
+        if _refreshed_at is not None and now - _refreshed_at < every:
+            return _index
+        if _refreshed_at is None:
+            _index.load(EloRating.objects.values_list("user_id", "elo").iterator(chunk_size=10_000))
+        else:
+            changed = EloRating.objects.filter(updated_at__gte=_refreshed_at - every)
+            for user_id, elo in changed.values_list("user_id", "elo"):
+                _index.set(user_id, elo)
+            if EloRating.objects.count() != len(_index):
+                _index.load(EloRating.objects.values_list("user_id", "elo").iterator(chunk_size=10_000))
+        _refreshed_at = now
+    return _index
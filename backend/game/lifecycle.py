@@ -0,0 +1,228 @@
+# game/lifecycle.py
+"""
+Match lifecycle shared by the views and the match clock (game.clock).
+
+    pending --(begin_at)--> active --(begin_at + MATCH_DURATION_SECONDS)--> finished
+
+The clock applies both transitions in batches. Until it gets to a match,
+readers use Match.effective_status(), so GET endpoints never write.
+"""
+from __future__ import annotations
+
+from datetime import timedelta
+import json
+import logging
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import writebehind
+from .models import Match, MatchEvent, Question, GameResult, MATCH_DURATION_SECONDS
+from .questions import deal_deck
+from .rating import rate_matches
+from .realtime import publish_match_state
+from .state_cache import write_through
+from .usernames import resolve_usernames
+
+logger = logging.getLogger(__name__)
+
+
+def match_state(m: Match, user_id: int | None = None) -> dict:
+    now = timezone.now()
+    countdown_seconds: int | None = None
+    if m.begin_at:
+        delta = (m.begin_at - now).total_seconds()
+        countdown_seconds = int(delta) if delta > 0 else 0
+
+    you_ready = None
+    opponent_ready = None
+    if user_id is not None:
+        if m.player1_id == user_id:
+            you_ready, opponent_ready = m.p1_ready, m.p2_ready
+        elif m.player2_id == user_id:
+            you_ready, opponent_ready = m.p2_ready, m.p1_ready
+
+    names = resolve_usernames([m.player1_id, m.player2_id])
+    return {
+        "id": m.id,
+        "state_version": m.state_version,
+        "status": m.effective_status(now),
+        "kind": m.kind,
+        "player1_id": m.player1_id,
+        "player2_id": m.player2_id,
+        "player1_username": names.get(m.player1_id) or "Player1",
+        "player2_username": names.get(m.player2_id) or "Player2",
+        "p1_ready": m.p1_ready,
+        "p2_ready": m.p2_ready,
+        "you_ready": you_ready,
+        "opponent_ready": opponent_ready,
+        "countdown_started_at": m.countdown_started_at.isoformat() if m.countdown_started_at else None,
+        "begin_at": m.begin_at.isoformat() if m.begin_at else None,
+        "ends_at": (m.begin_at + timedelta(seconds=MATCH_DURATION_SECONDS)).isoformat() if m.begin_at else None,
+        "countdown_seconds": countdown_seconds,
+        "time_left_seconds": m.time_left_seconds(),
+        "question_id": m.first_question_id,
+        "p1_score": m.p1_score,
+        "p2_score": m.p2_score,
+        "now": now.isoformat(),
+    }
+
+
+def publish(m: Match, notified: bool = False) -> None:
+    """
+    Announce a state change: refresh the state caches of every worker and push
+    the new state to both players' sockets. Call it after every state_version
+    bump (notified: that statement already sent the cache NOTIFY).
+    """
+    write_through(m, notified)
+    publish_match_state(m.id, match_state(m))
+
+
+def ensure_question_assigned(m: Match, kind: str | None = None) -> bool:
+    """
+    Ensure match has a deck in question_ids (matches are normally dealt one
+    when the matchmaker creates them). Returns True if we dealt one now.
+    """
+    if (m.question_ids or []):
+        return False
+    k = (kind or m.kind or "mcq").lower()
+    qids = deal_deck(k, m.difficulty)
+    if not qids:
+        logger.warning("No questions available for kind=%s; match=%s", k, m.id)
+        return False
+    m.question_ids = qids
+    m.save_state(["question_ids"])
+    publish(m)
+    logger.info("Dealt %s questions to match %s", len(qids), m.id)
+    return True
+
+
+def finalize_scores(match: Match) -> None:
+    """
+    Mark the match finished and apply it to the ratings (once). p1_score and
+    p2_score are already current: the submit statement maintains them
+    (answers.record_answer).
+    """
+    if match.status != "finished":
+        match.status = "finished"
+        match.save_state(["status"])
+        logger.info("Match %s finalized: p1_score=%s p2_score=%s", match.id, match.p1_score, match.p2_score)
+    if not match.rated:
+        match.rated = bool(rate_matches([match.id]))
+
+
+_TIMEOUT_ROWS_SQL = f"""
+INSERT INTO {GameResult._meta.db_table}
+    (match_id, player_id, question_id, question_kind, answer, is_correct, elapsed_ms, created_at)
+SELECT s.match_id, s.player_id, q.id, q.question_kind, %(answer)s::jsonb, false, NULL, %(now)s
+FROM unnest(%(match_id)s::bigint[], %(player_id)s::int[], %(question_id)s::bigint[])
+    AS s(match_id, player_id, question_id)
+JOIN {Question._meta.db_table} q ON q.id = s.question_id
+ON CONFLICT (match_id, player_id, question_id) DO NOTHING
+"""
+
+
+def ensure_unanswered_rows(*matches: Match) -> int:
+    """
+    For every question a player was shown (their part of the deck), ensure
+    they have a row. If missing, insert a 'timeout' incorrect row so
+    game_results reflects the game.
+
+    One INSERT ... SELECT ... ON CONFLICT DO NOTHING for all the given
+    matches: existing answers win, questions deleted since are skipped.
+    Returns the number of rows inserted.
+    """
+    cols: dict[str, list[int]] = {"match_id": [], "player_id": [], "question_id": []}
+    for m in matches:
+        if not m.question_ids:
+            logger.info("Match %s has no questions; no unanswered rows to insert", m.id)
+            continue
+        for pid in (m.player1_id, m.player2_id):
+            for qid in m.served_question_ids(pid):
+                cols["match_id"].append(m.id)
+                cols["player_id"].append(pid)
+                cols["question_id"].append(qid)
+    if not cols["match_id"]:
+        return 0
+    with connection.cursor() as cur:
+        cur.execute(_TIMEOUT_ROWS_SQL, {**cols, "answer": json.dumps({"timeout": True}), "now": timezone.now()})
+        inserted = cur.rowcount
+    if inserted:
+        logger.info("Inserted %s timeout rows for %s matches", inserted, len(matches))
+    return inserted
+
+
+# Batched transitions (driven by the match clock) ------------------------------
+
+def activate_matches(match_ids: list[int], now=None) -> list[Match]:
+    """
+    Flip every pending match in match_ids whose begin_at has passed to active,
+    with one UPDATE. Rows locked by someone else are skipped; the caller
+    retries them later. Returns the matches that were activated.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        matches = list(
+            Match.objects.select_for_update(skip_locked=True)
+            .filter(id__in=match_ids, status="pending", begin_at__lte=now)
+        )
+        if not matches:
+            return []
+        Match.objects.filter(id__in=[m.id for m in matches]).update(
+            status="active", state_version=F("state_version") + 1,
+        )
+        for m in matches:
+            m.status = "active"
+            m.state_version += 1
+            ensure_question_assigned(m)
+            publish(m)
+        # Logged at the moment they took effect, not when the clock got to them.
+        writebehind.add_events([
+            MatchEvent(match_id=m.id, event=MatchEvent.Kind.ACTIVATED, created_at=m.begin_at) for m in matches
+        ])
+    logger.info("Activated %s matches", len(matches))
+    return matches
+
+
+def finish_matches(match_ids: list[int], now=None, source: str = "clock") -> list[Match]:
+    """
+    Finish every match in match_ids whose clock has run out (and whose
+    write-behind grace period has passed; writebehind.finish_grace()): fill
+    in timeout rows for unanswered questions (one INSERT), flip them to
+    finished (one UPDATE; scores are already maintained by the submits) and
+    rate the whole batch (rating.rate_matches). source goes into the
+    FINISHED events ("clock", or "finish" for a player's finish request).
+    Returns the finished matches.
+    """
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=MATCH_DURATION_SECONDS + writebehind.finish_grace())
+    with transaction.atomic():
+        matches = list(
+            Match.objects.select_for_update(skip_locked=True)
+            .filter(id__in=match_ids, status__in=["pending", "active"], begin_at__lte=cutoff)
+        )
+        if not matches:
+            return []
+        for m in matches:
+            ensure_question_assigned(m)
+        ensure_unanswered_rows(*matches)
+
+        Match.objects.filter(id__in=[m.id for m in matches]).update(
+            status="finished", state_version=F("state_version") + 1,
+        )
+        for m in matches:
+            m.status = "finished"
+            m.state_version += 1  # rows are locked
+        rate_matches([m.id for m in matches])
+        for m in matches:
+            m.rated = True
+            publish(m)
+        writebehind.add_events([
+            MatchEvent(match_id=m.id, event=MatchEvent.Kind.FINISHED,
+                       created_at=m.begin_at + timedelta(seconds=MATCH_DURATION_SECONDS),
+                       payload={"p1_score": m.p1_score, "p2_score": m.p2_score, "source": source})
+            for m in matches
+        ])
+    logger.info("Finished %s matches", len(matches))
+    return matches
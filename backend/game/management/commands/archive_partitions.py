@@ -0,0 +1,52 @@
+"""
+Export old monthly partitions of game_results/match_events to compressed
+files, then detach and drop them (game/partitions.py).
+
+    python manage.py archive_partitions --dry-run
+    python manage.py archive_partitions
+    python manage.py archive_partitions --months 3 --dir /srv/archive --keep-detached
+
+A partition qualifies once its block of match ids is used up and all of its
+matches are finished (or cancelled) and older than --months. For each one,
+<dir>/<partition>/ gets game_match.csv.gz, game_results.csv.gz and
+match_events.csv.gz (CSV with a header row). The game_match rows themselves
+stay in the database.
+"""
+from __future__ import annotations
+
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from game.partitions import archive_candidates, archive_partition
+
+
+class Command(BaseCommand):
+    help = "Export finished matches of old partitions to gzipped CSV and detach the partitions."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months", type=int, default=None,
+                            help="keep partitions with matches newer than this (default PARTITIONS['ARCHIVE_AFTER_MONTHS'])")
+        parser.add_argument("--dir", default=None, help="output directory (default PARTITIONS['ARCHIVE_DIR'])")
+        parser.add_argument("--keep-detached", action="store_true",
+                            help="leave the detached partitions as plain tables instead of dropping them")
+        parser.add_argument("--dry-run", action="store_true", help="list what would be archived")
+
+    def handle(self, *args, **opts):
+        months = settings.PARTITIONS["ARCHIVE_AFTER_MONTHS"] if opts["months"] is None else opts["months"]
+        directory = Path(opts["dir"] or settings.PARTITIONS["ARCHIVE_DIR"])
+        candidates = archive_candidates(timezone.now() - timedelta(days=31 * months))
+        if not candidates:
+            self.stdout.write("Nothing to archive.")
+            return
+        for c in candidates:
+            newest = c.newest.isoformat(timespec="seconds") if c.newest else "-"
+            self.stdout.write(f"{c.partition.suffix}: {c.matches} matches, newest {newest}")
+            if opts["dry_run"]:
+                continue
+            files = archive_partition(c.partition, directory, drop=not opts["keep_detached"])
+            for path in files:
+                self.stdout.write(f"  {path} ({path.stat().st_size:,} bytes)")
@@ -0,0 +1,93 @@
+"""
+Channel layer throughput and fan-out latency.
+
+    python manage.py bench_channel_layer
+    python manage.py bench_channel_layer --messages 5000 --fanout 2 50 --rounds 200
+
+For each layer (in-memory vs Postgres LISTEN/NOTIFY):
+  throughput - group_send N messages to a 2-member group (one match) back to
+               back and wait until both members received all of them
+  fan-out    - one group_send to F members, time until the last one has it
+"""
+from __future__ import annotations
+
+import asyncio
+import statistics
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from game.layers import PostgresChannelLayer
+
+
+def _pct(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Command(BaseCommand):
+    help = "Benchmark the Postgres channel layer against the in-memory layer."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--fanout", type=int, nargs="+", default=[2, 20, 100])
+        parser.add_argument("--rounds", type=int, default=100)
+
+    def handle(self, *args, **opts):
+        asyncio.run(self._run(opts))
+
+    async def _run(self, opts):
+        layers = [
+            ("memory", InMemoryChannelLayer(capacity=opts["messages"] + 10)),
+            ("postgres", PostgresChannelLayer(capacity=opts["messages"] + 10)),
+        ]
+        self.stdout.write(f"{'layer':<10}{'test':<14}{'msgs/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for name, layer in layers:
+            rate = await self._throughput(layer, opts["messages"])
+            self.stdout.write(f"{name:<10}{'throughput':<14}{rate:>10.0f}{'':>10}{'':>10}")
+            for fanout in opts["fanout"]:
+                lat = await self._fanout(layer, fanout, opts["rounds"])
+                self.stdout.write(
+                    f"{name:<10}{f'fan-out x{fanout}':<14}{'':>10}"
+                    f"{statistics.median(lat) * 1000:>10.2f}{_pct(lat, 99) * 1000:>10.2f}"
+                )
+            await layer.flush()
+            if hasattr(layer, "close"):
+                await layer.close()
+
+    async def _members(self, layer, group: str, n: int) -> list[str]:
+        channels = [await layer.new_channel() for _ in range(n)]
+        for ch in channels:
+            await layer.group_add(group, ch)
+        return channels
+
+    async def _throughput(self, layer, n: int) -> float:
+        channels = await self._members(layer, "bench_tp", 2)
+
+        async def drain(ch):
+            for _ in range(n):
+                await layer.receive(ch)
+
+        receivers = [asyncio.create_task(drain(ch)) for ch in channels]
+        start = time.perf_counter()
+        for i in range(n):
+            await layer.group_send("bench_tp", {"type": "bench.msg", "i": i})
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+        for ch in channels:
+            await layer.group_discard("bench_tp", ch)
+        return n / elapsed
+
+    async def _fanout(self, layer, fanout: int, rounds: int) -> list[float]:
+        group = f"bench_fan_{fanout}"
+        channels = await self._members(layer, group, fanout)
+        latencies = []
+        for i in range(rounds):
+            start = time.perf_counter()
+            await layer.group_send(group, {"type": "bench.msg", "i": i})
+            await asyncio.gather(*(layer.receive(ch) for ch in channels))
+            latencies.append(time.perf_counter() - start)
+        for ch in channels:
+            await layer.group_discard(group, ch)
+        return latencies
@@ -0,0 +1,86 @@
+"""
+Coding judge throughput and time to verdict, cold vs warm (fork-server) sandboxes.
+
+    python manage.py bench_judge
+    python manage.py bench_judge --cases 50 --submissions 400 --workers 1 2 4 8
+    python manage.py bench_judge --modes forkserver --work 0
+    python manage.py bench_judge --cases 200 --workers 4 --shard-min-cases 8 1000 --fail-at 0 --clients 1
+
+For each mode, pool size and JUDGE["SHARD_MIN_CASES"], --submissions copies
+of a solution are judged by --clients threads at once (what concurrent
+submit requests do; default: as many as the pool size), each against
+--cases test cases. Each case does about --work loop iterations. With
+--fail-at the solution is wrong from that case on and is judged with
+stop_on_failure. p50/p99 are time to verdict as judge() sees it. Warm
+parents recycle per JUDGE["RECYCLE_AFTER"]. Nothing touches the database.
+"""
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from game.judge import Verdict, judge, make_pool
+
+SOLUTION = """
+def solve(n, work, fail_at):
+    total = 0
+    for i in range(work):
+        total += i % 7
+    return n * 2 + total - total + (0 <= fail_at <= n)
+"""
+
+
+class Command(BaseCommand):
+    help = "Benchmark coding-answer judging: throughput and time to verdict by mode, pool size and sharding."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cases", type=int, default=20)
+        parser.add_argument("--submissions", type=int, default=200)
+        parser.add_argument("--work", type=int, default=10_000, help="loop iterations per test case")
+        parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, os.cpu_count() or 1}))
+        parser.add_argument("--modes", nargs="+", default=["cold", "forkserver"], choices=["cold", "forkserver"])
+        parser.add_argument("--shard-min-cases", type=int, nargs="+", default=[settings.JUDGE["SHARD_MIN_CASES"]])
+        parser.add_argument("--clients", type=int, help="submissions judged at once (default: pool size)")
+        parser.add_argument("--fail-at", type=int, default=-1, help="first test case the solution gets wrong")
+
+    def handle(self, *args, **opts):
+        cases = [{"args": [i, opts["work"], opts["fail_at"]], "expected": i * 2} for i in range(opts["cases"])]
+        self.stdout.write(f"{opts['cases']} test cases per submission, {os.cpu_count()} cores")
+        self.stdout.write(f"{'mode':<12}{'workers':>8}{'min/shard':>10}{'subs/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for mode in opts["modes"]:
+            for workers in opts["workers"]:
+                for min_cases in opts["shard_min_cases"]:
+                    with override_settings(JUDGE={**settings.JUDGE, "SHARD_MIN_CASES": min_cases}):
+                        self._run(mode, workers, min_cases, cases, opts)
+
+    def _run(self, mode: str, workers: int, min_cases: int, cases: list[dict], opts: dict) -> None:
+        submissions = opts["submissions"]
+        expected = Verdict.ACCEPTED if opts["fail_at"] < 0 else Verdict.WRONG_ANSWER
+        pool = make_pool(mode, workers)
+        try:
+            judge(SOLUTION, cases[:1], pool=pool)  # sandboxes booted
+            latencies = []
+
+            def one(_):
+                result = judge(SOLUTION, cases, key="bench", stop_on_failure=True, pool=pool)
+                if result.verdict != expected:
+                    raise RuntimeError(f"benchmark solution judged {result.verdict}")
+                latencies.append(result.elapsed_ms)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(opts["clients"] or workers) as clients:
+                list(clients.map(one, range(submissions)))
+            elapsed = time.perf_counter() - started
+        finally:
+            pool.close()
+        latencies.sort()
+        self.stdout.write(
+            f"{mode:<12}{workers:>8}{min_cases:>10}{submissions / elapsed:>10.1f}"
+            f"{statistics.median(latencies):>10.1f}{latencies[int(len(latencies) * 0.99) - 1]:>10.1f}"
+        )
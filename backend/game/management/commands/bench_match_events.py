@@ -0,0 +1,70 @@
+"""
+Cost of recording a match event on the request path.
+
+    python manage.py bench_match_events
+    python manage.py bench_match_events --events 20000
+
+Times writebehind.add_event() as the views call it (batched: queued on
+commit, written by the flusher) against a synchronous INSERT per event, and
+the flush itself. Uses a throwaway match that is deleted afterwards.
+"""
+from __future__ import annotations
+
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from game import writebehind
+from game.models import Match, MatchEvent
+
+
+def _percentiles(samples: list[float]) -> tuple[float, float]:
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+class Command(BaseCommand):
+    help = "Benchmark per-request overhead of match event recording."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=5000)
+
+    def handle(self, *args, **opts):
+        n = opts["events"]
+        match = Match.objects.create(player1_id=2_000_000_001, player2_id=2_000_000_002, status="active")
+        payload = {"question_id": 1, "correct": True, "elapsed_ms": 1234}
+        try:
+            self.stdout.write(f"{'mode':<22}{'p50 us':>10}{'p99 us':>10}")
+            buffer = writebehind.get_buffer()
+            buffer.flush_now()
+            samples = []
+            for _ in range(n):
+                start = time.perf_counter()
+                writebehind.add_event(match.id, MatchEvent.Kind.ANSWER, 1, payload)
+                samples.append((time.perf_counter() - start) * 1e6)
+            self._report("batched (add_event)", samples)
+
+            start = time.perf_counter()
+            written = buffer.flush_now()[1]
+            elapsed = time.perf_counter() - start
+            # The flusher thread may have written part of the queue already.
+            self.stdout.write(f"  flush: {written} events in {elapsed * 1000:.1f} ms "
+                              f"({written / elapsed if elapsed else 0:,.0f} events/s)")
+
+            samples = []
+            with override_settings(WRITE_BEHIND={**settings.WRITE_BEHIND, "ENABLED": False, "EVENTS": False}):
+                for _ in range(n):
+                    start = time.perf_counter()
+                    writebehind.add_event(match.id, MatchEvent.Kind.ANSWER, 1, payload)
+                    samples.append((time.perf_counter() - start) * 1e6)
+            self._report("synchronous INSERT", samples)
+        finally:
+            writebehind.flush_now()
+            match.delete()
+
+    def _report(self, label: str, samples: list[float]) -> None:
+        p50, p99 = _percentiles(samples)
+        self.stdout.write(f"{label:<22}{p50:>10.1f}{p99:>10.1f}")
@@ -0,0 +1,151 @@
+"""
+Pairing cost per join at large queue sizes.
+
+    python manage.py bench_matchmaking --sizes 1000 10000 50000 --joins 2000
+    python manage.py bench_matchmaking --sizes 10000 --postgres
+
+Each join adds one player and immediately looks for an opponent inside the
+base ELO window; matched players are replaced so the queue stays at the
+requested size. Strategies:
+
+  fifo    - old behaviour: pair with whoever is at the head of the queue
+  linear  - scan every waiting player for the closest rating
+  banded  - RatingBuckets (bisect over ELO buckets), what InMemoryQueue uses
+  postgres- PostgresQueue joins plus a pop_pairs() tick every TICK_EVERY joins,
+            against the real DB (its rows are removed afterwards)
+"""
+from __future__ import annotations
+
+import itertools
+import random
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from game.matchmaking import PostgresQueue, RatingBuckets
+from game.models import QueueEntry
+
+
+TICK_EVERY = 50
+
+
+def _rating(rng: random.Random) -> int:
+    return max(100, int(rng.gauss(1200, 250)))
+
+
+class Command(BaseCommand):
+    help = "Benchmark matchmaking pairing cost per join (FIFO vs linear scan vs ELO buckets)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+        parser.add_argument("--joins", type=int, default=2000)
+        parser.add_argument("--seed", type=int, default=13)
+        parser.add_argument("--postgres", action="store_true", help="also benchmark PostgresQueue")
+
+    def handle(self, *args, **opts):
+        window = settings.MATCHMAKING["ELO_WINDOW"]["BASE"]
+        self.stdout.write(f"window=±{window}  joins={opts['joins']}")
+        self.stdout.write(f"{'strategy':<10}{'queued':>9}{'us/join':>11}{'paired':>9}{'mean gap':>10}")
+        for size in opts["sizes"]:
+            runs = [("fifo", self._fifo), ("linear", self._linear), ("banded", self._banded)]
+            if opts["postgres"]:
+                runs.append(("postgres", self._postgres))
+            for name, fn in runs:
+                rng = random.Random(opts["seed"])
+                elapsed, gaps = fn(rng, size, opts["joins"], window)
+                mean_gap = sum(gaps) / len(gaps) if gaps else 0.0
+                self.stdout.write(
+                    f"{name:<10}{size:>9}{elapsed / opts['joins'] * 1e6:>11.1f}{len(gaps):>9}{mean_gap:>10.1f}"
+                )
+
+    def _fifo(self, rng, size, joins, window):
+        queue = deque((uid, _rating(rng)) for uid in range(size))
+        next_id = itertools.count(size)
+        gaps = []
+        start = time.perf_counter()
+        for _ in range(joins):
+            elo = _rating(rng)
+            _, opp_elo = queue.popleft()
+            gaps.append(abs(elo - opp_elo))
+            queue.append((next(next_id), _rating(rng)))
+        return time.perf_counter() - start, gaps
+
+    def _linear(self, rng, size, joins, window):
+        queue = {uid: _rating(rng) for uid in range(size)}
+        next_id = itertools.count(size)
+        gaps = []
+        start = time.perf_counter()
+        for _ in range(joins):
+            elo = _rating(rng)
+            best, best_gap = None, None
+            for uid, other in queue.items():
+                gap = abs(other - elo)
+                if gap <= window and (best_gap is None or gap < best_gap):
+                    best, best_gap = uid, gap
+            if best is None:
+                queue[next(next_id)] = elo
+                continue
+            del queue[best]
+            gaps.append(best_gap)
+            queue[next(next_id)] = _rating(rng)
+        return time.perf_counter() - start, gaps
+
+    def _banded(self, rng, size, joins, window):
+        players = RatingBuckets()
+        for uid in range(size):
+            players.add(uid, _rating(rng))
+        next_id = itertools.count(size)
+        gaps = []
+        start = time.perf_counter()
+        for _ in range(joins):
+            uid, elo = next(next_id), _rating(rng)
+            players.add(uid, elo)
+            opp = players.nearest(elo, window, exclude=uid)
+            if opp is None:
+                continue
+            gaps.append(abs(players.elo_of(opp) - elo))
+            players.remove(uid)
+            players.remove(opp)
+            players.add(next(next_id), _rating(rng))
+        return time.perf_counter() - start, gaps
+
+    def _postgres(self, rng, size, joins, window):
+        # Joins are paired by a pop_pairs() tick every TICK_EVERY joins, as
+        # run_matchmaker does; the per-join figure includes the amortised tick.
+        # Rows are committed (and deleted afterwards) rather than rolled back:
+        # inside one long transaction every popped row stays in the index scans.
+        queue = PostgresQueue()
+        lane = ("mcq", None)
+        base = 10_000_000  # keep clear of real user ids
+        elos = {base + i: _rating(rng) for i in range(size)}
+        gaps = []
+        try:
+            QueueEntry.objects.bulk_create(
+                [QueueEntry(user_id=uid, elo=elo, kind=lane[0]) for uid, elo in elos.items()],
+                batch_size=5000,
+            )
+            with connection.cursor() as cur:
+                cur.execute("ANALYZE matchmaking_queue")
+            next_id = itertools.count(base + size)
+            start = time.perf_counter()
+            for n in range(1, joins + 1):
+                uid = next(next_id)
+                elos[uid] = _rating(rng)
+                queue.join(uid, elos[uid], *lane)
+                if n % TICK_EVERY and n != joins:
+                    continue
+                with transaction.atomic():
+                    pairs = queue.pop_pairs(lane, TICK_EVERY)
+                for a, b in pairs:
+                    gaps.append(abs(elos[a] - elos[b]))
+                    for _ in range(2):
+                        refill = next(next_id)
+                        elos[refill] = _rating(rng)
+                        queue.join(refill, elos[refill], *lane)
+            elapsed = time.perf_counter() - start
+        finally:
+            QueueEntry.objects.filter(user_id__gte=base).delete()
+        return elapsed, gaps
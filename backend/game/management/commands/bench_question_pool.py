@@ -0,0 +1,95 @@
+"""
+Question selection: in-memory QuestionPool vs ORDER BY random().
+
+    python manage.py bench_question_pool
+    python manage.py bench_question_pool --sizes 100000 1000000 --db
+
+Pool timings use synthetic ids. With --db, the largest size is also inserted
+into the questions table (inside a transaction that is rolled back) and the old
+query, ORDER BY random() with exclude(id__in=used), is timed against it.
+"""
+from __future__ import annotations
+
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import Random
+
+from game.models import Question
+from game.questions import QuestionPool
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _time_us(fn, repeat: int) -> tuple[float, float]:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+
+class Command(BaseCommand):
+    help = "Benchmark question sampling at large bank sizes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000])
+        parser.add_argument("--used", type=int, default=20, help="questions already used by the match")
+        parser.add_argument("--repeat", type=int, default=2000)
+        parser.add_argument("--db", action="store_true", help="also time ORDER BY random() on the real table")
+
+    def handle(self, *args, **opts):
+        self.stdout.write(f"{'questions':>10}  {'method':<22}{'p50 us':>10}{'p99 us':>10}")
+        for n in opts["sizes"]:
+            pool = QuestionPool()
+            start = time.perf_counter()
+            pool.load((i, "mcq", ("easy", "medium", "hard")[i % 3]) for i in range(1, n + 1))
+            load_ms = (time.perf_counter() - start) * 1000
+            used = random.sample(range(1, n + 1), min(opts["used"], n))
+
+            p50, p99 = _time_us(lambda: pool.sample("mcq", 1, exclude=used), opts["repeat"])
+            self.stdout.write(f"{n:>10}  {'pool.sample(k=1)':<22}{p50:>10.1f}{p99:>10.1f}   (load {load_ms:.0f} ms)")
+            p50, p99 = _time_us(lambda: pool.sample("mcq", 30, "hard", exclude=used), opts["repeat"])
+            self.stdout.write(f"{n:>10}  {'pool.sample(k=30,hard)':<22}{p50:>10.1f}{p99:>10.1f}")
+            start = time.perf_counter()
+            for i in range(1000):
+                pool.remove(i + 1)
+                pool.add(i + 1, "mcq", "easy")
+            self.stdout.write(f"{n:>10}  {'remove+add':<22}{(time.perf_counter() - start) * 1000:>10.1f}")
+
+        if opts["db"]:
+            self._bench_db(max(opts["sizes"]), opts["used"], max(20, opts["repeat"] // 100))
+
+    def _bench_db(self, n: int, used_count: int, repeat: int):
+        try:
+            with transaction.atomic():
+                existing = Question.objects.count()
+                batch = 10_000
+                for start in range(0, max(0, n - existing), batch):
+                    Question.objects.bulk_create(
+                        Question(title=f"bench {start + i}", question_kind="mcq")
+                        for i in range(min(batch, n - existing - start))
+                    )
+                ids = list(Question.objects.filter(question_kind="mcq").values_list("id", flat=True))
+                used = random.sample(ids, min(used_count, len(ids)))
+                pool = QuestionPool()
+                pool.load(Question.objects.values_list("id", "question_kind", "difficulty").iterator())
+
+                def order_by_random():
+                    return (Question.objects.filter(question_kind="mcq").exclude(id__in=used)
+                            .order_by(Random()).values_list("id", flat=True).first())
+
+                p50, p99 = _time_us(order_by_random, repeat)
+                self.stdout.write(f"{len(ids):>10}  {'ORDER BY random()':<22}{p50:>10.1f}{p99:>10.1f}")
+                p50, p99 = _time_us(lambda: pool.sample("mcq", 1, exclude=used), repeat)
+                self.stdout.write(f"{len(ids):>10}  {'pool (same table)':<22}{p50:>10.1f}{p99:>10.1f}")
+                raise _Rollback
+        except _Rollback:
+            pass
@@ -0,0 +1,88 @@
+"""
+Answer inserts: one record_answer() per submit vs write-behind batches.
+
+    python manage.py bench_write_behind
+    python manage.py bench_write_behind --rows 20000 --batch-sizes 1 50 500 2000
+
+Rows go into game_results, with the match scores they move, for synthetic
+active matches and players inside a transaction that is rolled back. "per-request" is what a submit does with
+write-behind off (one statement per answer); the batch rows time
+WriteBehindBuffer.flush_now() at each MAX_ROWS.
+"""
+from __future__ import annotations
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from game.answers import record_answer
+from game.models import Match, MatchEvent, Question
+from game.writebehind import WriteBehindBuffer
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Benchmark answer insert throughput with and without write-behind batching."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=5000)
+        parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 500, 2000])
+        parser.add_argument("--questions-per-match", type=int, default=30)
+
+    def handle(self, *args, **opts):
+        question_ids = list(Question.objects.values_list("id", flat=True)[: opts["questions_per_match"]])
+        if not question_ids:
+            self.stderr.write("No questions in the database; seed some first.")
+            return
+        self.stdout.write(f"{'mode':<16}{'rows':>8}{'seconds':>10}{'rows/s':>12}")
+        self._run("per-request", opts["rows"], question_ids, batch=None)
+        for batch in opts["batch_sizes"]:
+            self._run(f"batch {batch}", opts["rows"], question_ids, batch=batch)
+
+    def _answers(self, rows: int, question_ids: list[int]):
+        per_match = len(question_ids) * 2
+        matches = Match.objects.bulk_create(
+            Match(player1_id=1_000_000 + 2 * i, player2_id=1_000_001 + 2 * i, status="active",
+                  question_ids=question_ids)
+            for i in range((rows + per_match - 1) // per_match)
+        )
+        for n in range(rows):
+            m = matches[n // per_match]
+            player = m.player1_id if n % 2 == 0 else m.player2_id
+            yield m.id, player, question_ids[(n % per_match) // 2], n % 3 == 0
+
+    def _run(self, label: str, rows: int, question_ids: list[int], batch: int | None):
+        try:
+            with transaction.atomic():
+                answers = list(self._answers(rows, question_ids))
+                start = time.perf_counter()
+                if batch is None:
+                    for match_id, player_id, question_id, correct in answers:
+                        record_answer(match_id, player_id, question_id, "mcq",
+                                      {"answer_index": 0}, correct, 1000)
+                        MatchEvent(match_id=match_id, actor_id=player_id,
+                                   event=MatchEvent.Kind.ANSWER, payload={}).save()
+                else:
+                    # A long MAX_DELAY keeps the background thread out of the way.
+                    buffer = WriteBehindBuffer(max_rows=batch, max_delay=3600)
+                    for match_id, player_id, question_id, correct in answers:
+                        buffer.add_result({
+                            "match_id": match_id, "player_id": player_id, "question_id": question_id,
+                            "question_kind": "mcq", "answer": {"answer_index": 0},
+                            "is_correct": correct, "elapsed_ms": 1000, "created_at": timezone.now(),
+                        })
+                        buffer.add_events([MatchEvent(match_id=match_id, actor_id=player_id,
+                                                      event=MatchEvent.Kind.ANSWER, payload={})])
+                        if len(buffer) >= batch:
+                            buffer.flush_now()
+                    buffer.flush_now()
+                elapsed = time.perf_counter() - start
+                self.stdout.write(f"{label:<16}{rows:>8}{elapsed:>10.2f}{rows / elapsed:>12.0f}")
+                raise _Rollback
+        except _Rollback:
+            pass
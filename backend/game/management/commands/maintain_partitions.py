@@ -0,0 +1,30 @@
+"""
+Create the upcoming monthly partitions of game_results/match_events and move
+match ids into the current month's block (game/partitions.py).
+
+    python manage.py maintain_partitions
+    python manage.py maintain_partitions --ahead 3
+
+Idempotent: run it daily from cron (at least once early in each month).
+"""
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+
+from game.partitions import ensure_partitions, list_partitions, next_match_id
+
+
+class Command(BaseCommand):
+    help = "Create this month's and upcoming partitions of game_results and match_events."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ahead", type=int, default=None,
+                            help="months past this one (default PARTITIONS['AHEAD_MONTHS'])")
+
+    def handle(self, *args, **opts):
+        created = ensure_partitions(ahead=opts["ahead"])
+        self.stdout.write(f"created: {', '.join(created) or 'none'}; next match id {next_match_id()}")
+        for p in list_partitions():
+            lower = "MINVALUE" if p.lower is None else p.lower
+            upper = "MAXVALUE" if p.upper is None else p.upper
+            self.stdout.write(f"  {p.suffix:<10} match ids {lower} .. {upper}")
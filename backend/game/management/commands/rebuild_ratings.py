@@ -0,0 +1,140 @@
+"""
+Recompute elo_ratings from the full history of rated matches (after changing
+RATING settings, or to repair ratings).
+
+    python manage.py rebuild_ratings
+    python manage.py rebuild_ratings --k 24 --dry-run
+    python manage.py rebuild_ratings --fetch 200000 --window 8192
+
+Rated matches are streamed in created_at order through a server-side cursor
+and replayed with the rules of game/rating.py (same rounding, so a rebuild
+with unchanged settings reproduces the live ratings). Ratings are held in a
+NumPy array indexed by user id. Each window of matches is applied in waves: a
+wave is every match whose two players have no earlier match left in the
+window, so its players are distinct and it is one vectorized update.
+
+The result goes back with COPY into a temporary table and one INSERT ... ON
+CONFLICT; players left without a rated match return to RATING["BASE"].
+elo_ratings is locked against writes for the run. Matches that finish
+meanwhile are rated (game.rating.rate_matches) on top of the rebuilt values
+once it commits.
+
+Needs numpy.
+"""
+from __future__ import annotations
+
+import io
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from game.models import EloRating, Match
+
+_MATCHES_SQL = f"""
+SELECT player1_id, player2_id, p1_score, p2_score FROM {Match._meta.db_table}
+WHERE status = 'finished' AND rated
+ORDER BY created_at, id
+"""
+
+
+def replay_window(p1: np.ndarray, p2: np.ndarray, score: np.ndarray, ratings: np.ndarray, k: float) -> int:
+    """
+    Apply consecutive matches (player index arrays, p1's score in {0, 0.5, 1})
+    to `ratings` in order. Returns the number of waves it took.
+    """
+    pending = np.arange(len(p1))
+    waves = 0
+    while pending.size:
+        a, b = p1[pending], p2[pending]
+        # Position of each player's first remaining match (a/b interleaved, so index // 2).
+        _, first, inverse = np.unique(np.column_stack((a, b)).ravel(), return_index=True, return_inverse=True)
+        first_pos = (first // 2)[inverse].reshape(-1, 2)
+        pos = np.arange(pending.size)
+        ready = (first_pos[:, 0] == pos) & (first_pos[:, 1] == pos)
+        ra, rb = ratings[a[ready]], ratings[b[ready]]
+        d = np.rint(k * (score[pending[ready]] - 1.0 / (1.0 + 10.0 ** ((rb - ra) / 400.0))))
+        ratings[a[ready]] = ra + d
+        ratings[b[ready]] = rb - d
+        pending = pending[~ready]
+        waves += 1
+    return waves
+
+
+class Command(BaseCommand):
+    help = "Replay all rated matches into elo_ratings with the current (or given) rating settings."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--k", type=float, default=None, help="K-factor (default RATING['K_FACTOR'])")
+        parser.add_argument("--base", type=int, default=None, help="starting rating (default RATING['BASE'])")
+        parser.add_argument("--fetch", type=int, default=100_000, help="matches per cursor round trip")
+        parser.add_argument("--window", type=int, default=4096, help="matches scheduled into waves together")
+        parser.add_argument("--dry-run", action="store_true", help="replay and report, don't write")
+
+    def handle(self, *args, **opts):
+        k = settings.RATING["K_FACTOR"] if opts["k"] is None else opts["k"]
+        base = settings.RATING["BASE"] if opts["base"] is None else opts["base"]
+        table = EloRating._meta.db_table
+
+        with transaction.atomic():  # also required by the server-side cursor
+            with connection.cursor() as cur:
+                if not opts["dry_run"]:
+                    cur.execute(f"LOCK TABLE {table} IN EXCLUSIVE MODE")  # readers still welcome
+                cur.execute(
+                    f"SELECT COALESCE(MAX(GREATEST(player1_id, player2_id)), 0) "
+                    f"FROM {Match._meta.db_table} WHERE status = 'finished' AND rated"
+                )
+                max_uid = cur.fetchone()[0]
+            ratings = np.full(max_uid + 1, base, dtype=np.float64)
+            played = np.zeros(max_uid + 1, dtype=bool)
+
+            started = time.perf_counter()
+            matches = waves = 0
+            with connection.chunked_cursor() as cur:
+                cur.execute(_MATCHES_SQL)
+                while rows := cur.fetchmany(opts["fetch"]):
+                    batch = np.array(rows, dtype=np.int64)
+                    p1, p2 = batch[:, 0], batch[:, 1]
+                    score = 0.5 * (np.sign(batch[:, 2] - batch[:, 3]) + 1.0)
+                    played[p1] = played[p2] = True
+                    for i in range(0, len(batch), opts["window"]):
+                        window = slice(i, i + opts["window"])
+                        waves += replay_window(p1[window], p2[window], score[window], ratings, k)
+                    matches += len(batch)
+            replay_s = time.perf_counter() - started
+            users = np.flatnonzero(played)
+            self.stdout.write(
+                f"replayed {matches} matches ({len(users)} players, {waves} waves) in {replay_s:.2f}s: "
+                f"{matches / replay_s if replay_s else 0:,.0f} matches/s (K={k:g}, base={base})"
+            )
+            if opts["dry_run"]:
+                return
+
+            started = time.perf_counter()
+            now = timezone.now()
+            buf = io.StringIO()
+            np.savetxt(buf, np.column_stack((users, ratings[users])), fmt="%d", delimiter="\t")
+            buf.seek(0)
+            with connection.cursor() as cur:
+                cur.execute("CREATE TEMP TABLE rebuilt_ratings (user_id integer PRIMARY KEY, elo integer) "
+                            "ON COMMIT DROP")
+                cur.copy_expert("COPY rebuilt_ratings (user_id, elo) FROM STDIN", buf)
+                cur.execute(f"""
+                    INSERT INTO {table} AS r (user_id, elo, updated_at)
+                    SELECT user_id, elo, %s FROM rebuilt_ratings
+                    ON CONFLICT (user_id) DO UPDATE
+                        SET elo = EXCLUDED.elo, updated_at = EXCLUDED.updated_at
+                        WHERE r.elo <> EXCLUDED.elo
+                """, [now])
+                changed = cur.rowcount
+                cur.execute(f"""
+                    UPDATE {table} r SET elo = %s, updated_at = %s
+                    WHERE r.elo <> %s AND NOT EXISTS (SELECT 1 FROM rebuilt_ratings t WHERE t.user_id = r.user_id)
+                """, [base, now, base])
+                reset = cur.rowcount
+        self.stdout.write(
+            f"wrote {changed} changed ratings, reset {reset} to {base} in {time.perf_counter() - started:.2f}s"
+        )
@@ -0,0 +1,59 @@
+"""
+Check the incrementally maintained match scores against game_results.
+
+    python manage.py reconcile_scores
+    python manage.py reconcile_scores --fix
+    python manage.py reconcile_scores --since-id 120000 --batch 50000
+
+Matches are compared --batch at a time, one statement per batch. Batches
+follow the ids that exist (keyset on id), so the gaps between monthly
+partition blocks (game/partitions.py) cost nothing. Run
+it with --fix once after deploying incremental scores, so matches that were
+in play at the time get their counters set.
+"""
+from __future__ import annotations
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from game.answers import reconcile_scores
+from game.models import Match
+
+
+class Command(BaseCommand):
+    help = "Verify (and with --fix, correct) Match.p1_score/p2_score against game_results."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="write the counted scores back")
+        parser.add_argument("--since-id", type=int, default=None, help="first match id to check")
+        parser.add_argument("--batch", type=int, default=10_000, help="matches per statement")
+
+    def handle(self, *args, **opts):
+        first = opts["since_id"] or 0
+        started = time.monotonic()
+        checked = wrong = 0
+        start = last = None
+        while True:
+            ids = list(Match.objects.filter(id__gte=first).order_by("id").values_list("id", flat=True)
+                       [:opts["batch"]])
+            if not ids:
+                break
+            start = ids[0] if start is None else start
+            last = ids[-1]
+            for mismatch in reconcile_scores(ids[0], last, fix=opts["fix"]):
+                wrong += 1
+                self.stdout.write(
+                    f"match {mismatch.match_id}: stored {mismatch.stored[0]}-{mismatch.stored[1]}, "
+                    f"counted {mismatch.counted[0]}-{mismatch.counted[1]}"
+                    + (" (fixed)" if opts["fix"] else "")
+                )
+            checked += len(ids)
+            first = last + 1
+        if start is None:
+            self.stdout.write("No matches.")
+            return
+        self.stdout.write(
+            f"{wrong} mismatched scores in match ids {start}..{last} "
+            f"({checked} matches) in {time.monotonic() - started:.2f}s"
+        )
@@ -0,0 +1,45 @@
+"""
+Match clock loop: activates matches at begin_at and finalizes them when their
+time is up, whether or not anyone is still polling.
+
+    python manage.py run_match_clock
+    python manage.py run_match_clock --max-sleep 0.5
+    python manage.py run_match_clock --once
+
+Transitions use SKIP LOCKED, so a second copy is harmless (it just shares the work).
+"""
+from __future__ import annotations
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from game.clock import MatchClock
+
+
+class Command(BaseCommand):
+    help = "Drive match activation/expiry from a heap of due times, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-sleep", type=float, default=1.0,
+                            help="longest wait between ticks (new matches are found on the next tick)")
+        parser.add_argument("--full-scan-every", type=float, default=30.0,
+                            help="seconds between full rescans of open matches")
+        parser.add_argument("--once", action="store_true", help="run a single tick and exit")
+
+    def handle(self, *args, **opts):
+        clock = MatchClock(full_scan_every=opts["full_scan_every"])
+        while True:
+            close_old_connections()
+            started = time.monotonic()
+            activated, finished = clock.tick()
+            if activated or finished or opts["once"]:
+                self.stdout.write(
+                    f"tick: {activated} activated, {finished} finished, {len(clock)} scheduled "
+                    f"in {(time.monotonic() - started) * 1000:.1f} ms"
+                )
+            if opts["once"]:
+                return
+            wait = clock.seconds_until_next()
+            time.sleep(opts["max_sleep"] if wait is None else min(wait, opts["max_sleep"]))
@@ -0,0 +1,38 @@
+"""
+Background pairing loop.
+
+    python manage.py run_matchmaker --interval 0.5
+    python manage.py run_matchmaker --once
+
+Needs a shared queue backend (PostgresQueue). Several copies can run side by
+side; SKIP LOCKED gives each of them different players. Without it nobody
+is paired, unless MATCHMAKING_PAIR_IN_REQUEST=1 (single-process development).
+"""
+from __future__ import annotations
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from game.matchmaking import pair_tick
+
+
+class Command(BaseCommand):
+    help = "Pair queued players in batches, one bulk insert per lane per tick."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0.5, help="seconds between ticks")
+        parser.add_argument("--batch-size", type=int, default=None, help="max pairs per lane per tick")
+        parser.add_argument("--once", action="store_true", help="run a single tick and exit")
+
+    def handle(self, *args, **opts):
+        while True:
+            close_old_connections()
+            started = time.monotonic()
+            matches = pair_tick(batch_size=opts["batch_size"])
+            if matches or opts["once"]:
+                self.stdout.write(f"tick: {len(matches)} matches in {(time.monotonic() - started) * 1000:.1f} ms")
+            if opts["once"]:
+                return
+            time.sleep(max(0.0, opts["interval"] - (time.monotonic() - started)))
@@ -1,21 +1,491 @@
-# DEMO-ONLY in-memory queue (one Django process)
-from collections import deque
-
-_queue = deque()  # holds user_ids
-
-def enqueue(user_id: int):
-    if user_id in _queue:
-        return None  # already queued
-    _queue.append(user_id)
-    if len(_queue) >= 2:
-        a = _queue.popleft()
-        b = _queue.popleft()
-        return (a, b)  # a pair is ready
-    return None
-
-def leave(user_id: int):
-    try:
-        _queue.remove(user_id)
+# game/matchmaking.py
+"""
+Matchmaking queue backends and the pairing tick.
+
+Views never touch queue storage directly; they go through ``get_queue()`` which
+returns the backend configured in settings.MATCHMAKING["QUEUE_BACKEND"]:
+
+  * InMemoryQueue  - process-local, for tests and a single `runserver`.
+  * PostgresQueue  - shared by every worker through the matchmaking_queue table;
+                     pairing uses SELECT ... FOR UPDATE SKIP LOCKED so workers
+                     never block each other or hand out the same player twice.
+
+Players wait in one lane per (question kind, difficulty); difficulty None means
+"any". ``pair_tick()`` drains every lane in batches: each waiter, oldest first,
+is paired with the nearest-rated opponent inside an ELO window that widens the
+longer they have waited (see elo_window()), and the whole batch of matches is
+inserted with a single bulk_create. The tick runs in `manage.py run_matchmaker`,
+or inline in the queue views when MATCHMAKING["PAIR_IN_REQUEST"] is set
+(off by default: a full tick per poll is for single-process development).
+
+Queued clients heartbeat through QueueCheckView polls (``touch()``). Every tick
+first sweeps out players not seen for MATCHMAKING["HEARTBEAT_TIMEOUT"] seconds,
+so a closed tab is never paired with a live player. A client that was swept
+but is still polling gets "not_queued" back and joins again.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Iterable
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import writebehind
+from .models import Match, MatchEvent, QueueEntry
+from .questions import deal_deck
+
+logger = logging.getLogger(__name__)
+
+LaneKey = tuple[str, str | None]  # (kind, difficulty)
+
+
+def elo_window(waited_seconds: float) -> int:
+    """Largest rating gap we accept after waiting this long."""
+    cfg = settings.MATCHMAKING["ELO_WINDOW"]
+    widened = cfg["BASE"] + cfg["PER_SECOND"] * max(0.0, waited_seconds)
+    return int(min(widened, cfg["MAX"]))
+
+
+class QueueBackend:
+    """Interface shared by all queue implementations."""
+
+    def join(self, user_id: int, elo: int, kind: str, difficulty: str | None = None) -> bool:
+        """
+        Queue user_id in the (kind, difficulty) lane. False if already queued;
+        that re-join still counts as a heartbeat and updates their rating, and
+        keeps their lane and place in it.
+        """
+        raise NotImplementedError
+
+    def leave(self, user_id: int) -> bool:
+        """Remove user_id. Returns True if they were queued."""
+        raise NotImplementedError
+
+    def is_queued(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    def touch(self, user_id: int) -> bool:
+        """Record a heartbeat. Returns False if user_id is not queued."""
+        raise NotImplementedError
+
+    def sweep(self, timeout: float) -> list[int]:
+        """Evict and return players not seen for `timeout` seconds."""
+        raise NotImplementedError
+
+    def lanes(self) -> list[LaneKey]:
+        """Lanes that currently have someone waiting."""
+        raise NotImplementedError
+
+    def pop_pairs(self, lane: LaneKey, limit: int) -> list[tuple[int, int]]:
+        """
+        Pair up to `limit` couples from one lane and remove them. Call inside
+        transaction.atomic() together with the Match insert, and restore() the
+        pairs if that fails, so every player is put back.
+        """
+        raise NotImplementedError
+
+    def restore(self, pairs: list[tuple[int, int]]) -> None:
+        """
+        Put back the players of pairs from pop_pairs() whose transaction rolled
+        back. Backends that queue in the database get them back with the
+        rollback itself; the default does nothing.
+        """
+
+
+class RatingBuckets:
+    """
+    Waiting players bucketed by exact ELO. Each bucket is insertion-ordered, so
+    equally-rated players are served FIFO, and ``_elos`` is the sorted list of
+    non-empty buckets, so the nearest opponent is one bisect away:
+    O(log distinct ratings) per lookup, O(1) per bucket insert/remove.
+    """
+
+    def __init__(self):
+        self._buckets: dict[int, OrderedDict[int, None]] = {}
+        self._elos: list[int] = []
+        self._elo_of: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._elo_of)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._elo_of
+
+    def elo_of(self, user_id: int) -> int | None:
+        return self._elo_of.get(user_id)
+
+    def add(self, user_id: int, elo: int) -> None:
+        bucket = self._buckets.get(elo)
+        if bucket is None:
+            bucket = self._buckets[elo] = OrderedDict()
+            insort(self._elos, elo)
+        bucket[user_id] = None
+        self._elo_of[user_id] = elo
+
+    def remove(self, user_id: int) -> bool:
+        elo = self._elo_of.pop(user_id, None)
+        if elo is None:
+            return False
+        bucket = self._buckets[elo]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[elo]
+            del self._elos[bisect_left(self._elos, elo)]
         return True
-    except ValueError:
-        return False
+
+    def _first_other(self, elo: int, exclude: int) -> int | None:
+        for uid in self._buckets[elo]:
+            if uid != exclude:
+                return uid
+        return None
+
+    def nearest(self, elo: int, max_gap: int, exclude: int) -> int | None:
+        """Oldest player in the closest non-empty bucket within max_gap of elo."""
+        right = bisect_left(self._elos, elo)
+        left = right - 1
+        while True:
+            gap_r = self._elos[right] - elo if right < len(self._elos) else None
+            gap_l = elo - self._elos[left] if left >= 0 else None
+            if gap_r is not None and gap_r > max_gap:
+                gap_r = None
+            if gap_l is not None and gap_l > max_gap:
+                gap_l = None
+            if gap_r is None and gap_l is None:
+                return None
+            if gap_l is None or (gap_r is not None and gap_r <= gap_l):
+                found = self._first_other(self._elos[right], exclude)
+                right += 1
+            else:
+                found = self._first_other(self._elos[left], exclude)
+                left -= 1
+            # Only the searcher's own bucket can come back empty-handed.
+            if found is not None:
+                return found
+
+
+def _greedy_pairs(
+    players: RatingBuckets,
+    waiters: Iterable[tuple[int, float]],
+    limit: int,
+) -> list[tuple[int, int]]:
+    """
+    Walk (user_id, seconds_waited) oldest first and pair each one still in
+    `players` with their nearest opponent inside elo_window(seconds_waited).
+    Paired players are removed from `players`.
+    """
+    pairs: list[tuple[int, int]] = []
+    for uid, waited in waiters:
+        if len(pairs) >= limit:
+            break
+        elo = players.elo_of(uid)
+        if elo is None:
+            continue  # already taken as someone's opponent this tick
+        opp = players.nearest(elo, elo_window(waited), exclude=uid)
+        if opp is None:
+            continue
+        players.remove(uid)
+        players.remove(opp)
+        pairs.append((uid, opp))
+    return pairs
+
+
+class OrderedSet:
+    """
+    Insertion-ordered set of user ids with a timestamp per member.
+    Membership, add, discard, move-to-back and pop-front are all O(1).
+    """
+
+    def __init__(self):
+        self._items: OrderedDict[int, float] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._items
+
+    def __iter__(self):
+        return iter(self._items.items())
+
+    def add(self, user_id: int, ts: float) -> None:
+        self._items[user_id] = ts
+
+    def discard(self, user_id: int) -> bool:
+        return self._items.pop(user_id, None) is not None
+
+    def touch(self, user_id: int, ts: float) -> bool:
+        if user_id not in self._items:
+            return False
+        self._items[user_id] = ts
+        self._items.move_to_end(user_id)
+        return True
+
+    def peek(self) -> tuple[int, float] | None:
+        return next(iter(self._items.items()), None)
+
+    def pop(self) -> tuple[int, float]:
+        return self._items.popitem(last=False)
+
+
+class _Lane:
+    def __init__(self):
+        self.players = RatingBuckets()
+        self.joined = OrderedSet()  # oldest first
+
+
+class InMemoryQueue(QueueBackend):
+    """Single-process queue. Players in other workers are invisible to it."""
+
+    def __init__(self):
+        self._lanes: dict[LaneKey, _Lane] = {}
+        self._lane_of: dict[int, LaneKey] = {}
+        self._seen = OrderedSet()  # least recently seen first
+        # Popped players until their transaction commits: user_id -> (lane, elo, joined)
+        self._popped: dict[int, tuple[LaneKey, int, float]] = {}
+        self._lock = threading.Lock()
+
+    def join(self, user_id: int, elo: int, kind: str, difficulty: str | None = None) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if user_id in self._lane_of:
+                self._seen.touch(user_id, now)
+                players = self._lanes[self._lane_of[user_id]].players
+                if players.elo_of(user_id) != elo:
+                    players.remove(user_id)
+                    players.add(user_id, elo)
+                return False
+            key = (kind, difficulty)
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = _Lane()
+            lane.players.add(user_id, elo)
+            lane.joined.add(user_id, now)
+            self._seen.add(user_id, now)
+            self._lane_of[user_id] = key
+            return True
+
+    def _remove(self, user_id: int) -> bool:
+        key = self._lane_of.pop(user_id, None)
+        if key is None:
+            return False
+        lane = self._lanes[key]
+        lane.players.remove(user_id)
+        lane.joined.discard(user_id)
+        self._seen.discard(user_id)
+        return True
+
+    def leave(self, user_id: int) -> bool:
+        with self._lock:
+            return self._remove(user_id)
+
+    def is_queued(self, user_id: int) -> bool:
+        with self._lock:
+            return user_id in self._lane_of
+
+    def touch(self, user_id: int) -> bool:
+        with self._lock:
+            return self._seen.touch(user_id, time.monotonic())
+
+    def sweep(self, timeout: float) -> list[int]:
+        cutoff = time.monotonic() - timeout
+        evicted: list[int] = []
+        with self._lock:
+            # _seen is ordered by last heartbeat, so stop at the first live one.
+            while (head := self._seen.peek()) is not None and head[1] < cutoff:
+                evicted.append(head[0])
+                self._remove(head[0])
+        return evicted
+
+    def lanes(self) -> list[LaneKey]:
+        with self._lock:
+            return [key for key, lane in self._lanes.items() if len(lane.players) >= 2]
+
+    def pop_pairs(self, lane: LaneKey, limit: int) -> list[tuple[int, int]]:
+        with self._lock:
+            q = self._lanes.get(lane)
+            if q is None:
+                return []
+            now = time.monotonic()
+            joined = dict(q.joined)
+            elos = {uid: q.players.elo_of(uid) for uid in joined}
+            pairs = _greedy_pairs(q.players, [(uid, now - ts) for uid, ts in joined.items()], limit)
+            popped = [uid for pair in pairs for uid in pair]
+            for uid in popped:
+                q.joined.discard(uid)
+                self._seen.discard(uid)
+                del self._lane_of[uid]
+                self._popped[uid] = (lane, elos[uid], joined[uid])
+        if popped:
+            transaction.on_commit(lambda: self._forget(popped))
+        return pairs
+
+    def _forget(self, user_ids: list[int]) -> None:
+        with self._lock:
+            for uid in user_ids:
+                self._popped.pop(uid, None)
+
+    def restore(self, pairs: list[tuple[int, int]]) -> None:
+        with self._lock:
+            now = time.monotonic()
+            for uid in (uid for pair in pairs for uid in pair):
+                entry = self._popped.pop(uid, None)
+                if entry is None or uid in self._lane_of:
+                    continue  # committed, or queued again meanwhile
+                key, elo, joined = entry
+                lane = self._lanes.get(key)
+                if lane is None:
+                    lane = self._lanes[key] = _Lane()
+                # Back of the line, but with their waiting time (and ELO window) kept.
+                lane.players.add(uid, elo)
+                lane.joined.add(uid, joined)
+                self._seen.add(uid, now)
+                self._lane_of[uid] = key
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lanes.clear()
+            self._lane_of.clear()
+            self._seen = OrderedSet()
+            self._popped.clear()
+
+
+class PostgresQueue(QueueBackend):
+    """
+    Queue rows live in matchmaking_queue, so every gunicorn/uvicorn worker sees
+    the same waiting players. A tick locks up to MATCHMAKING["LANE_SCAN_LIMIT"]
+    of a lane's oldest waiters with SKIP LOCKED, so several matchmakers work on
+    disjoint players, pairs them in memory and deletes the paired rows in one
+    statement. Heartbeats are single-row UPDATEs of last_seen; the sweep is one
+    DELETE over the last_seen index.
+    """
+
+    def join(self, user_id: int, elo: int, kind: str, difficulty: str | None = None) -> bool:
+        now = timezone.now()
+        with connection.cursor() as cur:
+            # One upsert: a stale row (from a tab that went quiet) is refreshed, not kept as is.
+            cur.execute(
+                f"INSERT INTO {QueueEntry._meta.db_table} (user_id, elo, kind, difficulty, enqueued_at, last_seen) "
+                f"VALUES (%s, %s, %s, %s, %s, %s) "
+                f"ON CONFLICT (user_id) DO UPDATE SET elo = EXCLUDED.elo, last_seen = EXCLUDED.last_seen "
+                f"RETURNING xmax = 0",  # inserted, not updated
+                [user_id, elo, kind, difficulty, now, now],
+            )
+            return cur.fetchone()[0]
+
+    def leave(self, user_id: int) -> bool:
+        deleted, _ = QueueEntry.objects.filter(user_id=user_id).delete()
+        return deleted > 0
+
+    def is_queued(self, user_id: int) -> bool:
+        return QueueEntry.objects.filter(user_id=user_id).exists()
+
+    def touch(self, user_id: int) -> bool:
+        return QueueEntry.objects.filter(user_id=user_id).update(last_seen=timezone.now()) > 0
+
+    def sweep(self, timeout: float) -> list[int]:
+        cutoff = timezone.now() - timedelta(seconds=timeout)
+        table = QueueEntry._meta.db_table
+        with connection.cursor() as cur:
+            # Rows a concurrent tick has locked are being paired right now; skip them.
+            cur.execute(
+                f"DELETE FROM {table} WHERE id IN ("
+                f"  SELECT id FROM {table} WHERE last_seen < %s FOR UPDATE SKIP LOCKED"
+                f") RETURNING user_id",
+                [cutoff],
+            )
+            return [row[0] for row in cur.fetchall()]
+
+    def lanes(self) -> list[LaneKey]:
+        return list(QueueEntry.objects.order_by().values_list("kind", "difficulty").distinct())
+
+    def pop_pairs(self, lane: LaneKey, limit: int) -> list[tuple[int, int]]:
+        kind, difficulty = lane
+        now = timezone.now()
+        alive_since = now - timedelta(seconds=settings.MATCHMAKING["HEARTBEAT_TIMEOUT"])
+        with transaction.atomic():
+            rows = list(
+                QueueEntry.objects
+                .select_for_update(skip_locked=True)
+                .filter(kind=kind, difficulty=difficulty, last_seen__gte=alive_since)
+                .order_by("enqueued_at", "id")
+                .values_list("user_id", "elo", "enqueued_at")[:settings.MATCHMAKING["LANE_SCAN_LIMIT"]]
+            )
+            players = RatingBuckets()
+            for uid, elo, _ in rows:
+                players.add(uid, elo)
+            waiters = [(uid, (now - joined).total_seconds()) for uid, _, joined in rows]
+            pairs = _greedy_pairs(players, waiters, limit)
+            if pairs:
+                QueueEntry.objects.filter(user_id__in=[uid for pair in pairs for uid in pair]).delete()
+            return pairs
+
+
+_backends: dict[str, QueueBackend] = {}
+_backends_lock = threading.Lock()
+
+
+def get_queue() -> QueueBackend:
+    """Process-wide instance of the configured queue backend."""
+    path = settings.MATCHMAKING["QUEUE_BACKEND"]
+    backend = _backends.get(path)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(path)
+            if backend is None:
+                backend = _backends[path] = import_string(path)()
+    return backend
+
+
+def pair_tick(queue: QueueBackend | None = None, batch_size: int | None = None) -> list[Match]:
+    """
+    Evict stale waiters, then drain every lane once: pop up to batch_size pairs
+    per lane and create all of that lane's matches with a single bulk_create, in
+    the same transaction as the pop (a lane whose insert fails gets its players
+    back, and the error is raised). Returns the new matches.
+    """
+    queue = queue or get_queue()
+    batch_size = batch_size or settings.MATCHMAKING["BATCH_SIZE"]
+    evicted = queue.sweep(settings.MATCHMAKING["HEARTBEAT_TIMEOUT"])
+    if evicted:
+        logger.info("Evicted %s stale queue entries: %s", len(evicted), evicted[:20])
+    created: list[Match] = []
+    for kind, difficulty in queue.lanes():
+        pairs: list[tuple[int, int]] = []
+        try:
+            with transaction.atomic():
+                pairs = queue.pop_pairs((kind, difficulty), batch_size)
+                if not pairs:
+                    continue
+                matches = [
+                    Match(
+                        player1_id=a,
+                        player2_id=b,
+                        kind=kind,
+                        difficulty=difficulty,
+                        status="pending",
+                        question_ids=deal_deck(kind, difficulty),
+                    )
+                    for a, b in pairs
+                ]
+                Match.objects.bulk_create(matches)
+                writebehind.add_events([
+                    MatchEvent(match_id=m.id, event=MatchEvent.Kind.MATCHED, payload={
+                        "player1_id": m.player1_id, "player2_id": m.player2_id,
+                        "kind": kind, "difficulty": difficulty, "question_ids": m.question_ids,
+                    })
+                    for m in matches
+                ])
+        except Exception:
+            queue.restore(pairs)
+            raise
+        logger.info("Paired %s matches in lane kind=%s difficulty=%s", len(matches), kind, difficulty)
+        created.extend(matches)
+    return created
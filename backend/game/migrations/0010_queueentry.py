@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0009_elorating'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField(unique=True)),
+                ('enqueued_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'matchmaking_queue',
+                'indexes': [models.Index(fields=['enqueued_at', 'id'], name='idx_queue_enqueued')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0010_queueentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queueentry',
+            name='elo',
+            field=models.IntegerField(default=1000),
+        ),
+        migrations.AddIndex(
+            model_name='queueentry',
+            index=models.Index(fields=['elo', 'enqueued_at'], name='idx_queue_elo'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0011_queueentry_elo'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='queueentry',
+            name='idx_queue_enqueued',
+        ),
+        migrations.RemoveIndex(
+            model_name='queueentry',
+            name='idx_queue_elo',
+        ),
+        migrations.AddField(
+            model_name='match',
+            name='difficulty',
+            field=models.CharField(blank=True, choices=[('easy', 'Easy'), ('medium', 'Medium'), ('hard', 'Hard')], max_length=8, null=True),
+        ),
+        migrations.AddField(
+            model_name='queueentry',
+            name='difficulty',
+            field=models.CharField(blank=True, choices=[('easy', 'Easy'), ('medium', 'Medium'), ('hard', 'Hard')], max_length=8, null=True),
+        ),
+        migrations.AddField(
+            model_name='queueentry',
+            name='kind',
+            field=models.CharField(choices=[('mcq', 'Multiple Choice'), ('coding', 'Coding')], default='mcq', max_length=6),
+        ),
+        migrations.AddIndex(
+            model_name='queueentry',
+            index=models.Index(fields=['kind', 'difficulty', 'enqueued_at'], name='idx_queue_lane'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:32
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0012_per_kind_queues'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queueentry',
+            name='last_seen',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='queueentry',
+            index=models.Index(fields=['last_seen'], name='idx_queue_last_seen'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0013_queueentry_last_seen'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='state_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0014_match_state_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='p1_cursor',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='match',
+            name='p2_cursor',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0015_match_deck_cursors'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='elorating',
+            index=models.Index(fields=['updated_at'], name='idx_elo_updated'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:51
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0016_elo_updated_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='matchevent',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
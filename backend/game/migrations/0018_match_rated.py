@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0017_match_event_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='match',
+            name='rated',
+            field=models.BooleanField(default=False),
+        ),
+        # Finished matches already moved ratings under the old per-answer points.
+        migrations.RunSQL(
+            "UPDATE game_match SET rated = true WHERE status = 'finished'",
+            migrations.RunSQL.noop,
+        ),
+    ]
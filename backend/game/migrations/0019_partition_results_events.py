@@ -0,0 +1,139 @@
+# Range-partition game_results and match_events on match_id, one partition a
+# month (see game/partitions.py).
+#
+# The existing rows become the partition <table>_legacy, for match ids below
+# the first block; this month's partition starts at the next multiple of
+# MATCH_ID_BLOCK and the game_match id sequence moves there. Match ids jump
+# a block a month, past what an integer holds, so game_match.id and every
+# column referencing it are made bigint first where they aren't (a rewrite
+# of that table). An id column that is serial rather than identity loses its
+# sequence to the new parent's identity.
+# Constraints and indexes are recreated on the new tables under their old
+# names; the primary key becomes (id, match_id), since a partitioned table's
+# unique keys must contain match_id. (match_id, player_id, question_id) is
+# unchanged. Both tables are locked for the duration (one pass over each to
+# attach it). Not reversible.
+
+from django.db import migrations
+from django.utils import timezone
+
+TABLES = ("game_results", "match_events")
+
+# PARTITIONS["MATCH_ID_BLOCK"] when this was written; the monthly partitions
+# made later (game/partitions.py) follow the setting.
+MATCH_ID_BLOCK = 1_000_000_000
+
+
+def _legacy_name(name: str) -> str:
+    return f"{name[:56]}_legacy"
+
+
+def _widen_match_ids(cur) -> None:
+    """Make game_match.id, its sequence and the columns referencing it bigint."""
+    cur.execute("""
+        SELECT c.conrelid::regclass::text, a.attname FROM pg_constraint c
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+        WHERE c.confrelid = 'game_match'::regclass AND c.contype = 'f'
+          AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.conrelid)
+        UNION ALL
+        SELECT 'game_match', 'id'
+    """)
+    for table, column in cur.fetchall():
+        cur.execute("""
+            SELECT 1 FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s
+            AND atttypid = 'integer'::regtype
+        """, [table, column])
+        if cur.fetchone():
+            cur.execute(f'ALTER TABLE {table} ALTER COLUMN "{column}" TYPE bigint')
+    cur.execute("""
+        SELECT seqrelid::regclass::text FROM pg_sequence
+        WHERE seqrelid = pg_get_serial_sequence('game_match', 'id')::regclass AND seqtypid <> 'bigint'::regtype
+    """)
+    for (sequence,) in cur.fetchall():
+        cur.execute(f"ALTER SEQUENCE {sequence} AS bigint")
+
+
+def _partition_table(cur, table: str, start: int, month: str) -> None:
+    legacy = f"{table}_legacy"
+    cur.execute("""
+        SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f')
+        ORDER BY contype DESC
+    """, [table])
+    constraints = cur.fetchall()
+    # Index definitions still name the current table, so they can be replayed as is.
+    cur.execute("""
+        SELECT c.relname, pg_get_indexdef(x.indexrelid)
+        FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+        WHERE x.indrelid = %s::regclass AND NOT EXISTS (
+            SELECT 1 FROM pg_constraint k WHERE k.conrelid = x.indrelid AND k.conindid = x.indexrelid
+        )
+    """, [table])
+    indexes = cur.fetchall()
+    cur.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}")
+    next_id = cur.fetchone()[0]
+
+    cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+    for name, kind, _ in constraints:
+        if kind == "p":  # ATTACH builds the partition's share of the new (id, match_id) key
+            cur.execute(f"ALTER TABLE {legacy} DROP CONSTRAINT {name}")
+        elif kind == "u":  # (foreign key names are per table: no clash)
+            cur.execute(f"ALTER TABLE {legacy} RENAME CONSTRAINT {name} TO {_legacy_name(name)}")
+    for name, _ in indexes:
+        cur.execute(f"ALTER INDEX {name} RENAME TO {_legacy_name(name)}")
+    # A partition can't have its own identity column or id sequence; the new
+    # parent's identity takes over. (Drop a serial's default before LIKE copies it.)
+    cur.execute(f"ALTER TABLE {legacy} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+    cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", [legacy])
+    sequence = cur.fetchone()[0]
+    cur.execute(f"ALTER TABLE {legacy} ALTER COLUMN id DROP DEFAULT")
+    if sequence:
+        cur.execute(f"DROP SEQUENCE {sequence}")
+
+    cur.execute(f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING STORAGE INCLUDING COMMENTS) "
+                f"PARTITION BY RANGE (match_id)")
+    cur.execute(f"ALTER TABLE {table} ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY "
+                f"(START WITH {int(next_id)})")
+    for name, kind, definition in constraints:
+        if kind == "p":
+            definition = "PRIMARY KEY (id, match_id)"
+        elif kind == "u" and "match_id" not in definition:
+            raise RuntimeError(f"{table}.{name} ({definition}) doesn't include match_id")
+        cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+    for _, definition in indexes:
+        cur.execute(definition)
+
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ({int(start)})")
+    cur.execute(f"CREATE TABLE {table}_{month} PARTITION OF {table} "
+                f"FOR VALUES FROM ({int(start)}) TO ({int(start + MATCH_ID_BLOCK)})")
+
+
+def partition_tables(apps, schema_editor):
+    now = timezone.now()
+    with schema_editor.connection.cursor() as cur:
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM game_match")
+        start = (cur.fetchone()[0] // MATCH_ID_BLOCK + 1) * MATCH_ID_BLOCK
+        todo = []
+        for table in TABLES:
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [table])
+            row = cur.fetchone()
+            # game_results is unmanaged: absent from databases Django built
+            if row is not None and row[0] != "p":
+                todo.append(table)
+        if todo:
+            _widen_match_ids(cur)
+        for table in todo:
+            _partition_table(cur, table, start, f"y{now.year:04d}m{now.month:02d}")
+        if todo:
+            cur.execute("SELECT setval(pg_get_serial_sequence('game_match', 'id'), %s, false)", [start])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0018_match_rated'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_tables),
+    ]
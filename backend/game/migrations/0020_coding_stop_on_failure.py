@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('game', '0019_partition_results_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coding',
+            name='stop_on_failure',
+            field=models.BooleanField(default=True),
+        ),
+    ]
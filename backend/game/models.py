@@ -64,6 +64,9 @@ class Coding(models.Model):
     test_cases = models.JSONField()
     time_threshold = models.IntegerField(blank=True, null=True)
     space_threshold = models.IntegerField(blank=True, null=True)
+    # Stop judging a submission at its first failing test case (the rest are
+    # "skipped"); off to always report every case.
+    stop_on_failure = models.BooleanField(default=True)
 
     class Meta:
         db_table = "coding"
@@ -85,6 +88,10 @@ class Coding(models.Model):
 # Hard limit for each match after it becomes active
 MATCH_DURATION_SECONDS = 60
 
+# Questions dealt to a match up front (Match.question_ids): enough for an
+# answer every 2 seconds, so nobody runs out before the clock does.
+MATCH_DECK_SIZE = MATCH_DURATION_SECONDS // 2
+
 
 class Match(models.Model):
     STATUS_CHOICES = (
@@ -100,6 +107,7 @@ class Match(models.Model):
 
     # mode
     kind = models.CharField(max_length=6, choices=Question.Kind.choices, default=Question.Kind.MCQ)
+    difficulty = models.CharField(max_length=8, choices=Question.Difficulty.choices, null=True, blank=True)
 
     # status/timestamps
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
@@ -109,13 +117,23 @@ class Match(models.Model):
     countdown_started_at = models.DateTimeField(null=True, blank=True)
     begin_at = models.DateTimeField(null=True, blank=True)  # set after both Ready (+3s)
 
-    # JSONB list of question ids (matches DB)
+    # JSONB list of question ids (matches DB): the deck dealt at creation.
+    # Each player walks it with their own cursor (index of their current question).
     question_ids = models.JSONField(default=list)
+    p1_cursor = models.PositiveIntegerField(default=0)
+    p2_cursor = models.PositiveIntegerField(default=0)
 
     # Scores (match DB: NOT NULL)
     p1_score = models.IntegerField(default=0)
     p2_score = models.IntegerField(default=0)
 
+    # Bumped on every change a client can see (ready, countdown, activation,
+    # questions, scores, finish); drives ETag / ?since_version= on the state view.
+    state_version = models.PositiveIntegerField(default=0)
+
+    # Set when the finished match has been applied to elo_ratings (game/rating.py).
+    rated = models.BooleanField(default=False)
+
     class Meta:
         constraints = [
             models.CheckConstraint(check=~models.Q(player1_id=models.F("player2_id")), name="match_not_self"),
@@ -135,6 +153,11 @@ class Match(models.Model):
             return 2
         return None
 
+    def served_question_ids(self, user_id: int) -> list[int]:
+        """The part of the deck this player has been shown."""
+        cursor = self.p1_cursor if self.player1_id == user_id else self.p2_cursor
+        return (self.question_ids or [])[: cursor + 1]
+
     def both_ready(self) -> bool:
         return self.p1_ready and self.p2_ready
 
@@ -153,32 +176,48 @@ class Match(models.Model):
         remain = int((self.begin_at + timedelta(seconds=duration) - timezone.now()).total_seconds())
         return max(0, remain)
 
+    def save_state(self, fields: list[str]) -> None:
+        """
+        Save `fields` and bump state_version (F() expression, so no row lock needed).
+        The scores are re-read with the version: submits change them concurrently.
+        """
+        self.state_version = models.F("state_version") + 1
+        self.save(update_fields=[*fields, "state_version"])
+        self.refresh_from_db(fields=["state_version", "p1_score", "p2_score"])
+
+    def effective_status(self, now=None) -> str:
+        """
+        Status as of `now`, without waiting for the match clock to write it:
+        a pending match is active once begin_at passes and finished once the
+        duration is up. Lets read paths stay read-only.
+        """
+        if self.status in ("pending", "active") and self.begin_at:
+            now = now or timezone.now()
+            if now >= self.begin_at + timedelta(seconds=MATCH_DURATION_SECONDS):
+                return "finished"
+            if now >= self.begin_at:
+                return "active"
+        return self.status
+
     def maybe_promote_to_active(self) -> bool:
-        if self.begin_at and self.status != "active" and timezone.now() >= self.begin_at:
+        if self.begin_at and self.status == "pending" and timezone.now() >= self.begin_at:
             self.status = "active"
-            self.save(update_fields=["status"])
+            self.save_state(["status"])
             return True
         return False
 
     def maybe_finish_if_expired(self, duration: int = MATCH_DURATION_SECONDS) -> bool:
         """
-        When time is up, compute p1/p2 scores from game_results and finish the match.
-        Safe to call repeatedly (idempotent).
+        When time is up, finish the match (p1/p2 scores are kept current as
+        answers come in). Safe to call repeatedly (idempotent).
         """
         if not self.begin_at or self.status == "finished":
             return False
         if timezone.now() < self.begin_at + timedelta(seconds=duration):
             return False
 
-        from .models import GameResult  # local import to avoid ordering issues
-
-        p1 = GameResult.objects.filter(match_id=self.id, player_id=self.player1_id, is_correct=True).count()
-        p2 = GameResult.objects.filter(match_id=self.id, player_id=self.player2_id, is_correct=True).count()
-
-        self.p1_score = p1
-        self.p2_score = p2
         self.status = "finished"
-        self.save(update_fields=["p1_score", "p2_score", "status"])
+        self.save_state(["status"])
         return True
 
     # Back-compat helper: first question id from the list
@@ -248,7 +287,7 @@ class MatchEvent(models.Model):
     actor_id = models.IntegerField(null=True, blank=True)   # user who caused it (if any)
     event = models.CharField(max_length=32, choices=Kind.choices)
     payload = models.JSONField(null=True, blank=True)       # any extra context
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now)  # when it happened, not when it was written
 
     class Meta:
         db_table = "match_events"
@@ -259,10 +298,31 @@ from django.db import models
 class EloRating(models.Model):
     user_id = models.IntegerField(unique=True, db_index=True)
     elo = models.IntegerField(default=1000, db_index=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)  # set it explicitly in .update() calls
 
     class Meta:
         db_table = "elo_ratings"
+        # The leaderboard rank index refreshes from rows changed since its last pass.
+        indexes = [models.Index(fields=["updated_at"], name="idx_elo_updated")]
+
+    def __str__(self):
+        return f"user {self.user_id} — {self.elo}"
+
+class QueueEntry(models.Model):
+    """A player waiting for an opponent (shared across worker processes)."""
+    user_id = models.IntegerField(unique=True)
+    elo = models.IntegerField(default=1000)
+    kind = models.CharField(max_length=6, choices=Question.Kind.choices, default=Question.Kind.MCQ)
+    difficulty = models.CharField(max_length=8, choices=Question.Difficulty.choices, null=True, blank=True)
+    enqueued_at = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField(default=timezone.now)  # refreshed by queue/check polls
+
+    class Meta:
+        db_table = "matchmaking_queue"
+        indexes = [
+            models.Index(fields=["kind", "difficulty", "enqueued_at"], name="idx_queue_lane"),
+            models.Index(fields=["last_seen"], name="idx_queue_last_seen"),
+        ]
 
     def __str__(self):
-        return f"user {self.user_id} — {self.elo}"
\ No newline at end of file
+        return f"queued user {self.user_id}"
@@ -0,0 +1,207 @@
+# game/partitions.py
+"""
+Monthly partitions of game_results and match_events.
+
+Both tables are range-partitioned on match_id (migration 0019), not on a
+timestamp: the partition key has to be part of every unique key, and keying
+on match_id leaves game_results' (match_id, player_id, question_id) as it
+was, so the ON CONFLICT upserts in answers.py/lifecycle.py don't change. It
+also keeps a whole match in one partition, and every read here filters on
+match_id, so the planner only touches that partition.
+
+Months map to match ids through the game_match id sequence. Each month gets
+a block of PARTITIONS["MATCH_ID_BLOCK"] ids, with the same bounds in both
+tables. ensure_partitions() (manage.py maintain_partitions, run it daily)
+creates the partitions for this month and the next AHEAD_MONTHS. On its first
+run in a new month it moves the sequence up to the start of that month's
+block, so the month's matches land in its partition. Until then, new matches
+keep filling the previous block, which only makes that month a little longer.
+Rows from before partitioning are in one partition, <table>_legacy.
+
+archive_partition() exports a partition's matches, answers and events to
+gzipped CSV, then detaches and drops the partitions (manage.py
+archive_partitions). game_match rows stay: rebuild_ratings replays them.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from datetime import date, datetime
+import gzip
+import logging
+import os
+from pathlib import Path
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import GameResult, Match, MatchEvent
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_TABLES = (GameResult._meta.db_table, MatchEvent._meta.db_table)
+
+_BOUND_RE = re.compile(r"FROM \((MINVALUE|'?(-?\d+)'?)\) TO \((MAXVALUE|'?(-?\d+)'?)\)")
+
+
+@dataclass(frozen=True)
+class Partition:
+    suffix: str         # "y2026m10" or "legacy"; the partition of table T is T_<suffix>
+    lower: int | None   # first match id (None: MINVALUE)
+    upper: int | None   # first match id of the next partition (None: MAXVALUE)
+
+    def table(self, parent: str) -> str:
+        return f"{parent}_{self.suffix}"
+
+
+def month_suffix(d: date) -> str:
+    return f"y{d.year:04d}m{d.month:02d}"
+
+
+def _add_months(d: date, n: int) -> date:
+    months = d.year * 12 + d.month - 1 + n
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def list_partitions(table: str = PARTITIONED_TABLES[0]) -> list[Partition]:
+    """The partitions of table, ordered by match id."""
+    with connection.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+        """, [table])
+        rows = cur.fetchall()
+    parts = []
+    for name, bound in rows:
+        m = _BOUND_RE.search(bound)
+        if m is None or not name.startswith(f"{table}_"):
+            logger.warning("Ignoring partition %s of %s (%s)", name, table, bound)
+            continue
+        parts.append(Partition(
+            name[len(table) + 1:],
+            None if m.group(2) is None else int(m.group(2)),
+            None if m.group(4) is None else int(m.group(4)),
+        ))
+    return sorted(parts, key=lambda p: -2**63 if p.lower is None else p.lower)
+
+
+def next_match_id() -> int:
+    """The id the next Match will get (ignoring concurrent inserts)."""
+    with connection.cursor() as cur:
+        cur.execute(f"SELECT pg_get_serial_sequence('{Match._meta.db_table}', 'id')")
+        seq = cur.fetchone()[0]
+        cur.execute(f"SELECT last_value, is_called FROM {seq}")
+        last, called = cur.fetchone()
+    return last + 1 if called else last
+
+
+def ensure_partitions(now: datetime | None = None, ahead: int | None = None) -> list[str]:
+    """
+    Create the missing month partitions (this month and `ahead` more) in all
+    PARTITIONED_TABLES, and move the match id sequence to this month's block
+    if it is still below it. Idempotent. Returns the partitions created.
+    """
+    now = now or timezone.now()
+    ahead = settings.PARTITIONS["AHEAD_MONTHS"] if ahead is None else ahead
+    block = settings.PARTITIONS["MATCH_ID_BLOCK"]
+    this_month = now.date().replace(day=1)
+    created = []
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            # One maintenance run at a time (the lock conflicts with itself, not with writes).
+            cur.execute(f"LOCK TABLE {', '.join(PARTITIONED_TABLES)} IN SHARE UPDATE EXCLUSIVE MODE")
+        parts = {p.suffix: p for p in list_partitions()}
+        top = max((p.upper for p in parts.values() if p.upper is not None), default=None)
+        if top is None:
+            raise RuntimeError(f"{PARTITIONED_TABLES[0]} has no bounded partition; run migrate first")
+        # Never go back to a month before the newest partition (say, one archived early).
+        latest = max((s for s in parts if s.startswith("y")), default="")
+        for n in range(ahead + 1):
+            suffix = month_suffix(_add_months(this_month, n))
+            if suffix <= latest:
+                continue
+            latest = suffix
+            parts[suffix] = Partition(suffix, top, top + block)
+            top += block
+            with connection.cursor() as cur:
+                for table in PARTITIONED_TABLES:
+                    cur.execute(
+                        f"CREATE TABLE {parts[suffix].table(table)} PARTITION OF {table} "
+                        f"FOR VALUES FROM (%s) TO (%s)", [parts[suffix].lower, parts[suffix].upper],
+                    )
+            created.append(suffix)
+            logger.info("Created partitions %s for match ids %s..%s",
+                        suffix, parts[suffix].lower, parts[suffix].upper - 1)
+
+        current = parts.get(month_suffix(this_month))
+        if current is not None and next_match_id() < current.lower:
+            with connection.cursor() as cur:
+                cur.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{Match._meta.db_table}', 'id'), %s, false)",
+                    [current.lower],
+                )
+            logger.info("Match ids continue from %s (%s)", current.lower, current.suffix)
+    return created
+
+
+@dataclass(frozen=True)
+class ArchiveCandidate:
+    partition: Partition
+    matches: int
+    newest: datetime | None  # created_at of the partition's newest match
+
+
+def archive_candidates(older_than: datetime) -> list[ArchiveCandidate]:
+    """
+    Closed partitions (their id block is used up) whose matches are all
+    finished or cancelled and were all created before older_than.
+    """
+    first_open = next_match_id()
+    found = []
+    for p in list_partitions():
+        if p.upper is None or p.upper > first_open:
+            continue
+        with connection.cursor() as cur:
+            cur.execute(f"""
+                SELECT COUNT(*), COUNT(*) FILTER (WHERE status NOT IN ('finished', 'cancelled')),
+                       MAX(created_at)
+                FROM {Match._meta.db_table}
+                WHERE id >= COALESCE(%s, id) AND id < %s
+            """, [p.lower, p.upper])
+            matches, unfinished, newest = cur.fetchone()
+        if unfinished == 0 and (newest is None or newest < older_than):
+            found.append(ArchiveCandidate(p, matches, newest))
+    return found
+
+
+def _export(cur, query: str, path: Path) -> None:
+    tmp = path.with_name(path.name + ".part")
+    with gzip.open(tmp, "wb") as f:
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+    os.replace(tmp, path)
+
+
+def archive_partition(p: Partition, directory: Path, drop: bool = True) -> list[Path]:
+    """
+    Write <directory>/<suffix>/{game_match,<table>...}.csv.gz for partition
+    p, then detach its partitions (and drop them unless drop=False). Returns
+    the files written. The files are complete before anything is detached.
+    """
+    out = Path(directory) / p.suffix
+    out.mkdir(parents=True, exist_ok=True)
+    id_range = f"id < {int(p.upper)}" + ("" if p.lower is None else f" AND id >= {int(p.lower)}")
+    files = [out / f"{Match._meta.db_table}.csv.gz"]
+    with connection.cursor() as cur:
+        _export(cur, f"SELECT * FROM {Match._meta.db_table} WHERE {id_range} ORDER BY id", files[0])
+        for table in PARTITIONED_TABLES:
+            files.append(out / f"{table}.csv.gz")
+            _export(cur, f"SELECT * FROM {p.table(table)} ORDER BY match_id, id", files[-1])
+        for table in PARTITIONED_TABLES:
+            # CONCURRENTLY: inserts into the other partitions aren't blocked meanwhile.
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {p.table(table)} CONCURRENTLY")
+            if drop:
+                cur.execute(f"DROP TABLE {p.table(table)}")
+    logger.info("Archived partition %s to %s%s", p.suffix, out, "" if drop else " (kept detached)")
+    return files
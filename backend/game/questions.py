@@ -0,0 +1,316 @@
+# game/questions.py
+"""
+Question selection shared by the match views and the matchmaker, and the
+per-process cache of question payloads the match endpoints serve and grade from.
+
+Selection samples from an in-memory pool of ids (QuestionPool) instead of
+running ORDER BY random() over the questions table.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import hashlib
+import json
+import random
+import threading
+import time
+from types import MappingProxyType
+from typing import Iterable, Mapping
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Question, MCQ, Coding, MATCH_DECK_SIZE
+
+
+LaneKey = tuple[str, str | None]  # (kind, difficulty); difficulty None = any
+
+
+class _IdSet:
+    """Ids in a list plus their positions: O(1) add/remove, O(1) random pick."""
+
+    def __init__(self):
+        self.ids: list[int] = []
+        self.pos: dict[int, int] = {}
+
+    def add(self, qid: int) -> None:
+        if qid not in self.pos:
+            self.pos[qid] = len(self.ids)
+            self.ids.append(qid)
+
+    def discard(self, qid: int) -> None:
+        i = self.pos.pop(qid, None)
+        if i is None:
+            return
+        last = self.ids.pop()
+        if last != qid:
+            self.ids[i] = last
+            self.pos[last] = i
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class QuestionPool:
+    """
+    Question ids per (kind, difficulty) and per (kind, any difficulty), for
+    sampling without ORDER BY random(). sample() is O(k) expected while the
+    excluded ids are a small part of the lane (the usual case: a match has
+    used a handful of questions), and falls back to one O(n) pass otherwise.
+    """
+
+    def __init__(self):
+        self._lanes: dict[LaneKey, _IdSet] = {}
+        self._where: dict[int, tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def load(self, rows: Iterable[tuple[int, str, str]]) -> None:
+        """Replace the contents with (id, kind, difficulty) rows."""
+        lanes: dict[LaneKey, _IdSet] = {}
+        where: dict[int, tuple[str, str]] = {}
+        for qid, kind, difficulty in rows:
+            where[qid] = (kind, difficulty)
+            for key in ((kind, difficulty), (kind, None)):
+                lanes.setdefault(key, _IdSet()).add(qid)
+        with self._lock:
+            self._lanes, self._where = lanes, where
+
+    def add(self, qid: int, kind: str, difficulty: str) -> None:
+        """Add a question, or move it if its kind/difficulty changed."""
+        with self._lock:
+            if self._where.get(qid) == (kind, difficulty):
+                return
+            self._discard(qid)
+            self._where[qid] = (kind, difficulty)
+            for key in ((kind, difficulty), (kind, None)):
+                self._lanes.setdefault(key, _IdSet()).add(qid)
+
+    def remove(self, qid: int) -> None:
+        with self._lock:
+            self._discard(qid)
+
+    def _discard(self, qid: int) -> None:
+        old = self._where.pop(qid, None)
+        if old is not None:
+            for key in (old, (old[0], None)):
+                self._lanes[key].discard(qid)
+
+    def size(self, kind: str, difficulty: str | None = None) -> int:
+        lane = self._lanes.get((kind, difficulty))
+        return len(lane) if lane else 0
+
+    def sample(self, kind: str, k: int, difficulty: str | None = None,
+               exclude: Iterable[int] = ()) -> list[int]:
+        """Up to k distinct ids from the lane, none of them in exclude."""
+        exclude = set(exclude)
+        with self._lock:
+            lane = self._lanes.get((kind, difficulty))
+            if not lane or k <= 0:
+                return []
+            ids = lane.ids
+            chosen: list[int] = []
+            seen = set(exclude)
+            # Rejection sampling; give up after a few misses per pick and fall back.
+            tries = 4 * k + len(exclude)
+            while len(chosen) < k and tries > 0:
+                qid = ids[random.randrange(len(ids))]
+                tries -= 1
+                if qid not in seen:
+                    seen.add(qid)
+                    chosen.append(qid)
+            if len(chosen) < k:
+                rest = [qid for qid in ids if qid not in seen]
+                chosen += random.sample(rest, min(k - len(chosen), len(rest)))
+            return chosen
+
+
+_pool = QuestionPool()
+_pool_refreshed_at: datetime | None = None
+_pool_refresh_lock = threading.Lock()
+
+
+def question_pool() -> QuestionPool:
+    """
+    The process-wide pool, loaded on first use. Saves/deletes in this process
+    update it through signals; every QUESTION_CACHE["POOL_REFRESH"] seconds it
+    also picks up rows other processes changed (by updated_at) and reloads in
+    full if the row count no longer matches (deletions).
+    """
+    global _pool_refreshed_at
+    now = timezone.now()
+    every = timedelta(seconds=settings.QUESTION_CACHE["POOL_REFRESH"])
+    if _pool_refreshed_at is not None and now - _pool_refreshed_at < every:
+        return _pool
+    with _pool_refresh_lock:
+        if _pool_refreshed_at is not None and now - _pool_refreshed_at < every:
+            return _pool
+        columns = ("id", "question_kind", "difficulty")
+        if _pool_refreshed_at is None:
+            _pool.load(Question.objects.values_list(*columns).iterator())
+        else:
+            for row in Question.objects.filter(updated_at__gte=_pool_refreshed_at - every).values_list(*columns):
+                _pool.add(*row)
+            if Question.objects.count() != len(_pool):
+                _pool.load(Question.objects.values_list(*columns).iterator())
+        _pool_refreshed_at = now
+    return _pool
+
+
+def sample_question_ids(kind: str, k: int, difficulty: str | None = None,
+                        exclude: Iterable[int] = ()) -> list[int]:
+    """Up to k distinct random question ids of this kind, skipping exclude."""
+    return question_pool().sample((kind or "mcq").lower(), k, difficulty, exclude)
+
+
+def deal_deck(kind: str, difficulty: str | None = None, size: int = MATCH_DECK_SIZE) -> list[int]:
+    """A match's question deck: up to `size` distinct random ids, [] if the bank is empty."""
+    return sample_question_ids(kind, size, difficulty)
+
+
+# Payload cache -----------------------------------------------------------------
+
+@dataclass(frozen=True)
+class CodingSpec:
+    """What the judge needs for a coding question (never sent to clients)."""
+    test_cases: tuple[Mapping, ...]  # {"args": [...], "expected": ...}
+    time_threshold: int | None       # ms per test case
+    space_threshold: int | None      # MB
+    key: str                         # question id + test case digest (judge.judge(key=))
+    stop_on_failure: bool = True
+
+
+@dataclass(frozen=True)
+class QuestionPayload:
+    id: int
+    kind: str
+    difficulty: str
+    data: Mapping  # what the client gets; read-only
+    answer_index: int | None  # MCQ only; None if the MCQ row is missing
+    coding: CodingSpec | None = None  # coding only; None if the Coding row is missing
+
+    def client_data(self) -> dict:
+        return dict(self.data)
+
+
+def _build_payload(q: Question) -> QuestionPayload:
+    data = {
+        "id": q.id,
+        "title": q.title,
+        "descriptor": q.descriptor,
+        "kind": q.question_kind,
+    }
+    answer_index = coding = None
+    if q.question_kind == "mcq":
+        try:
+            data["choices"] = list(q.mcq.choices)
+            answer_index = q.mcq.answer_index
+        except MCQ.DoesNotExist:
+            data["choices"] = []
+    else:
+        try:
+            data["prompt"] = q.coding.prompt
+            data["template_code"] = q.coding.template_code
+            digest = hashlib.sha1(json.dumps(q.coding.test_cases, sort_keys=True).encode()).hexdigest()[:16]
+            coding = CodingSpec(tuple(q.coding.test_cases), q.coding.time_threshold, q.coding.space_threshold,
+                                f"{q.id}:{digest}", q.coding.stop_on_failure)
+        except Coding.DoesNotExist:
+            data["prompt"] = ""
+            data["template_code"] = ""
+    return QuestionPayload(q.id, q.question_kind, q.difficulty, MappingProxyType(data), answer_index, coding)
+
+
+class QuestionCache:
+    """Bounded LRU of QuestionPayload by question id, with a TTL."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[float, QuestionPayload]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, question_ids: Iterable[int]) -> dict[int, QuestionPayload]:
+        found: dict[int, QuestionPayload] = {}
+        missing: list[int] = []
+        now = time.monotonic()
+        with self._lock:
+            for qid in question_ids:
+                entry = self._entries.get(qid)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(qid)
+                    found[qid] = entry[1]
+                else:
+                    missing.append(qid)
+        if missing:
+            loaded = self.load(Question.objects.filter(id__in=missing))
+            found.update({qid: loaded[qid] for qid in missing if qid in loaded})
+        return found
+
+    def load(self, queryset) -> dict[int, QuestionPayload]:
+        """Fetch questions (with their MCQ/Coding row, one query) and cache them."""
+        payloads = {q.id: _build_payload(q) for q in queryset.select_related("mcq", "coding")}
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for qid, payload in payloads.items():
+                self._entries[qid] = (expires, payload)
+                self._entries.move_to_end(qid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payloads
+
+    def invalidate(self, question_id: int) -> None:
+        with self._lock:
+            self._entries.pop(question_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_cache = QuestionCache(settings.QUESTION_CACHE["MAX_ENTRIES"], settings.QUESTION_CACHE["TTL"])
+_warmed = False
+
+
+def warm_question_cache() -> int:
+    """Load the newest MAX_ENTRIES questions in one query. Returns how many."""
+    global _warmed
+    _warmed = True
+    return len(_cache.load(Question.objects.order_by("-id")[: _cache.max_entries]))
+
+
+def question_payloads(question_ids: Iterable[int]) -> dict[int, QuestionPayload]:
+    if settings.QUESTION_CACHE["WARM"] and not _warmed:
+        warm_question_cache()
+    return _cache.get_many(question_ids)
+
+
+def question_payload(question_id: int) -> QuestionPayload | None:
+    return question_payloads([question_id]).get(question_id)
+
+
+@receiver([post_save, post_delete], sender=Question)
+@receiver([post_save, post_delete], sender=MCQ)
+@receiver([post_save, post_delete], sender=Coding)
+def _invalidate_question(sender, instance, **kwargs):
+    # MCQ and Coding use the question id as their primary key.
+    _cache.invalidate(instance.pk)
+
+
+@receiver(post_save, sender=Question)
+def _pool_add_question(sender, instance, **kwargs):
+    if _pool_refreshed_at is not None:
+        _pool.add(instance.pk, instance.question_kind, instance.difficulty)
+
+
+@receiver(post_delete, sender=Question)
+def _pool_remove_question(sender, instance, **kwargs):
+    _pool.remove(instance.pk)
@@ -0,0 +1,94 @@
+# game/rating.py
+"""
+Match ratings: expected-score ELO, applied once per finished match.
+
+For players rated Ra and Rb, A's expected score is
+
+    Ea = 1 / (1 + 10 ** ((Rb - Ra) / 400))
+
+and after the match A moves by K * (Sa - Ea), where Sa is 1 for a win (more
+correct answers: p1_score vs p2_score), 0.5 for a draw and 0 for a loss. B
+moves by the same rounded amount the other way, so rating points are neither
+created nor lost. K is RATING["K_FACTOR"]; a player's first match starts
+from RATING["BASE"].
+
+rate_matches() rates a batch of finished matches with a fixed number of
+statements, however big the batch:
+  1. claim the unrated ones (UPDATE ... SET rated = true ... RETURNING), so
+     each match is applied exactly once even with several finishers running;
+  2. make sure every player has an elo_ratings row, then lock those rows
+     (in user_id order);
+  3. play the matches through in id order in Python (a player in two matches
+     of the batch takes the first result into the second);
+  4. write every changed rating with one upsert.
+"""
+from __future__ import annotations
+
+from typing import Iterable
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import EloRating, Match
+
+logger = logging.getLogger(__name__)
+
+
+def expected_score(rating: float, opponent: float) -> float:
+    return 1.0 / (1.0 + 10.0 ** ((opponent - rating) / 400.0))
+
+
+def match_score(own: int, other: int) -> float:
+    """1 for a win, 0.5 for a draw, 0 for a loss."""
+    return 1.0 if own > other else 0.5 if own == other else 0.0
+
+
+def elo_delta(rating: int, opponent: int, score: float, k: float | None = None) -> int:
+    """The player's rating change; the opponent's is the negation."""
+    k = settings.RATING["K_FACTOR"] if k is None else k
+    return round(k * (score - expected_score(rating, opponent)))
+
+
+_CLAIM_SQL = f"""
+UPDATE {Match._meta.db_table} SET rated = true
+WHERE id = ANY(%s) AND status = 'finished' AND NOT rated
+RETURNING id, player1_id, player2_id, p1_score, p2_score
+"""
+
+
+def rate_matches(match_ids: Iterable[int]) -> int:
+    """
+    Apply the finished, not yet rated matches among match_ids to elo_ratings.
+    Returns how many were rated. Runs in (or as) one transaction.
+    """
+    match_ids = list(match_ids)
+    if not match_ids:
+        return 0
+    base = settings.RATING["BASE"]
+    now = timezone.now()
+    with transaction.atomic():
+        with connection.cursor() as cur:
+            cur.execute(_CLAIM_SQL, [match_ids])
+            rows = sorted(cur.fetchall())
+        if not rows:
+            return 0
+        players = sorted({uid for row in rows for uid in row[1:3]})
+        EloRating.objects.bulk_create(
+            [EloRating(user_id=uid, elo=base, updated_at=now) for uid in players], ignore_conflicts=True,
+        )
+        elo = dict(
+            EloRating.objects.select_for_update()
+            .filter(user_id__in=players).order_by("user_id").values_list("user_id", "elo")
+        )
+        for _, p1, p2, p1_score, p2_score in rows:
+            d = elo_delta(elo[p1], elo[p2], match_score(p1_score, p2_score))
+            elo[p1] += d
+            elo[p2] -= d
+        EloRating.objects.bulk_create(
+            [EloRating(user_id=uid, elo=elo[uid], updated_at=now) for uid in players],
+            update_conflicts=True, unique_fields=["user_id"], update_fields=["elo", "updated_at"],
+        )
+    logger.info("Rated %s matches (%s players)", len(rows), len(players))
+    return len(rows)
@@ -0,0 +1,37 @@
+# game/realtime.py
+"""
+Push match state to the players' WebSockets (see consumers.GameConsumer).
+
+Views call publish_match_state() after every lifecycle transition; the message
+goes to the match's channel group once the surrounding transaction commits, so
+clients never see state that was rolled back.
+"""
+from __future__ import annotations
+
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def match_group(match_id: int) -> str:
+    return f"match_{match_id}"
+
+
+def publish_match_state(match_id: int, state: dict) -> None:
+    """Broadcast a (neutral, not per-player) _state() dict to the match group."""
+    layer = get_channel_layer()
+    if layer is None:
+        return
+
+    def send():
+        try:
+            async_to_sync(layer.group_send)(match_group(match_id), {"type": "match.state", "state": state})
+        except Exception:
+            # Clients fall back to polling; never fail the request over a push.
+            logger.exception("Failed to publish state for match %s", match_id)
+
+    transaction.on_commit(send)
@@ -0,0 +1,366 @@
+# game/sandbox.py
+"""
+Runs coding submissions for game/judge.py, which starts this file with
+`python -I -S sandbox.py [--serve]` and an empty environment. Either way
+the interpreter imports PRELOAD before it gets any work.
+
+This process (the supervisor) never runs submitted code. For each job it
+forks a child that limits itself, compiles the submission and then runs one
+test case at a time, as the supervisor hands them out:
+    supervisor -> child's stdin:   [...args of case i...]
+    child's stdout -> supervisor:  {"value": ...} or {"error": "...", "memory": true}
+A case's args only reach the child once the previous case's result is in,
+and the supervisor measures every case itself, from the kernel's accounting
+of the child: CPU time from /proc/<child>/schedstat, and peak resident
+memory from VmHWM in /proc/<child>/status, reset through clear_refs before
+each case. Nothing the submission does can touch those or the supervisor's
+own stdout; output beyond one line per case ends the child. A case still
+running after its wall-clock allowance ("case_timeout" seconds) kills the
+child, and so does a crash; the remaining cases go to a fresh child.
+
+Cold mode (no argument): one job per interpreter, as one JSON document on stdin:
+    {"code": "...", "args": [[1], [3]], "cpu_s": 3, "memory_mb": 256,
+     "case_timeout": 0.3, "timeout": 1.6}
+
+Warm mode (--serve): a long-lived supervisor taking one job per line on
+stdin, with "key" (the question) added. It keeps each key's args, so "args"
+is only sent the first time; a job for an unknown key gets
+{"need_args": true} back. Each job's results are relayed as they come, and
+then how it ended:
+    {"out": {...result line...}}
+    ...
+    {"done": true, "timed_out": false, "cancelled": false}
+A {"cancel": true} line sent while a job runs kills its child (and is
+ignored otherwise). judge.py recycles the supervisor after
+JUDGE["RECYCLE_AFTER"] jobs, which also bounds the args it holds.
+
+Result lines, one per test case:
+    {"i": 0, "value": 2, "ms": 0.01, "kb": 12}
+    {"i": 1, "error": "ZeroDivisionError: division by zero", "ms": 0.02, "kb": 0}
+    {"i": 2, "time_limit": true, "ms": 300.4, "kb": 0}
+    ("memory": true is added for a MemoryError)
+or a single {"compile_error": "..."} line. "ms" is CPU time, "kb" the peak
+resident memory over what the child used when the case started; "kb" is
+left out where /proc doesn't offer it. The judge compares values with the
+expected ones, which never reach the sandbox. Whatever the submission
+prints is discarded.
+
+Before the submission's code is compiled, the child limits itself:
+  * RLIMIT_CPU cpu_s: SIGXCPU past it (SIGKILL a second later);
+  * RLIMIT_AS: its current size + memory_mb, so allocations past that raise MemoryError;
+  * RLIMIT_NOFILE 0: stdin/stdout/stderr stay open and no descriptor can be
+    created, not even in place of a closed one, so no sockets (no network),
+    no files, and no way into the supervisor's /proc view of it;
+  * RLIMIT_NPROC 0 (no fork, no threads), RLIMIT_FSIZE 0, RLIMIT_CORE 0.
+Modules a submission can import are the ones already loaded (PRELOAD and
+the interpreter's own), since opening a module file isn't possible anymore.
+The child keeps the supervisor's uid, though: see judge.py on JUDGE["USER"].
+
+Standard library only: this is not imported by Django.
+"""
+import io
+import json
+import os
+import resource
+import selectors
+import signal
+import sys
+import time
+
+PRELOAD = ("bisect", "collections", "functools", "heapq", "itertools", "math",
+           "operator", "re", "string")
+
+for _name in PRELOAD:
+    __import__(_name)
+
+
+def _emit(obj) -> None:
+    data = (json.dumps(obj, separators=(",", ":")) + "\n").encode()
+    while data:
+        data = data[os.write(1, data):]
+
+
+class _Stdin:
+    """Lines on fd 0, unbuffered so a pending one is seen by select()."""
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.eof = False
+
+    def fill(self) -> None:
+        chunk = os.read(0, 65536)
+        self.eof = not chunk
+        self.buf += chunk
+
+    def pending(self) -> bool:
+        return self.eof or b"\n" in self.buf
+
+    def readline(self) -> bytes | None:
+        while b"\n" not in self.buf:
+            if self.eof:
+                return None
+            self.fill()
+        line, _, rest = bytes(self.buf).partition(b"\n")
+        self.buf = bytearray(rest)
+        return line
+
+
+# The child ---------------------------------------------------------------------
+
+def _limit(cpu_s: int, memory_mb: int) -> None:
+    with open("/proc/self/statm") as f:
+        size = int(f.read().split()[0]) * resource.getpagesize()
+    os.closerange(3, 1024)
+    for res, value in (
+        (resource.RLIMIT_CPU, (cpu_s, cpu_s + 1)),
+        (resource.RLIMIT_AS, (size + memory_mb * 2**20,) * 2),
+        (resource.RLIMIT_NOFILE, (0, 0)),
+        (resource.RLIMIT_NPROC, (0, 0)),
+        (resource.RLIMIT_FSIZE, (0, 0)),
+        (resource.RLIMIT_CORE, (0, 0)),
+    ):
+        resource.setrlimit(res, value)
+
+
+def _error(e: BaseException) -> str:
+    return f"{type(e).__name__}: {e}"[:500]
+
+
+def _child(job: dict) -> None:
+    """Limit this process, load the submission, then run cases as their args arrive."""
+    _limit(int(job["cpu_s"]), int(job["memory_mb"]))
+    stdin = _Stdin()
+    sys.stdout = sys.stderr = io.StringIO()
+    namespace = {"__name__": "__submission__"}
+    try:
+        exec(compile(job["code"], "<submission>", "exec"), namespace)
+        solve = namespace["solve"]
+        if not callable(solve):
+            raise TypeError("solve is not a function")
+    except BaseException as e:
+        _emit({"compile_error": _error(e)})
+        return
+    _emit({"ready": True})
+    while (line := stdin.readline()) is not None:
+        sys.stdout.seek(0)
+        sys.stdout.truncate()
+        try:
+            _emit({"value": solve(*json.loads(line))})
+        except MemoryError:
+            _emit({"error": "MemoryError", "memory": True})
+        except BaseException as e:
+            _emit({"error": _error(e)})
+
+
+# The supervisor ----------------------------------------------------------------
+
+class _Child:
+    """A forked child running the submission, and the supervisor's /proc view of it."""
+
+    def __init__(self, job: dict, devnull: int):
+        cases_r, self.cases = os.pipe()
+        self.results, results_w = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                os.dup2(cases_r, 0)
+                os.dup2(results_w, 1)
+                os.dup2(devnull, 2)
+                _child(job)
+            finally:
+                os._exit(0)
+        os.close(cases_r)
+        os.close(results_w)
+        self.buf = b""
+        self.status: int | None = None
+        self.usage = None
+        try:
+            self.proc = (os.open(f"/proc/{self.pid}/schedstat", os.O_RDONLY),
+                         os.open(f"/proc/{self.pid}/status", os.O_RDONLY),
+                         os.open(f"/proc/{self.pid}/clear_refs", os.O_WRONLY))
+        except OSError:
+            self.proc = None
+
+    def cpu_ns(self) -> int:
+        """CPU time the child has used; wall-clock time where /proc doesn't say."""
+        if self.usage is not None:
+            return int((self.usage.ru_utime + self.usage.ru_stime) * 1e9)
+        if self.proc is None:
+            return time.perf_counter_ns()
+        return int(os.pread(self.proc[0], 256, 0).split()[0])
+
+    def _status_kb(self, field: bytes) -> int:
+        status = os.pread(self.proc[1], 8192, 0)
+        start = status.index(field) + len(field)
+        return int(status[start:status.index(b"\n", start)].split()[0])
+
+    def start_case(self) -> int | None:
+        """Reset the peak resident memory to the current one, and return that (kB)."""
+        if self.proc is None:
+            return None
+        try:
+            os.write(self.proc[2], b"5")
+            return self._status_kb(b"VmRSS:")
+        except (OSError, ValueError):
+            return None
+
+    def peak_kb(self, rss: int | None) -> dict:
+        if rss is None or self.usage is not None:
+            return {}
+        try:
+            return {"kb": max(0, self._status_kb(b"VmHWM:") - rss)}
+        except (OSError, ValueError):
+            return {}
+
+    def send(self, args) -> None:
+        try:
+            os.write(self.cases, (json.dumps(args) + "\n").encode())
+        except BrokenPipeError:
+            pass  # it died; read() says how
+
+    def read(self, until: float, stdin: _Stdin | None, max_output: int):
+        """
+        The child's next line: ("line", dict), or ("exit", status) once it's
+        gone, ("timeout",), ("cancel",) when a line came in on stdin, or
+        ("garbage",) for anything but one JSON object per line.
+        """
+        with selectors.DefaultSelector() as sel:
+            sel.register(self.results, selectors.EVENT_READ)
+            if stdin is not None:
+                sel.register(0, selectors.EVENT_READ)
+            while b"\n" not in self.buf:
+                if stdin is not None and stdin.pending():
+                    return ("cancel",)
+                left = until - time.monotonic()
+                if left <= 0:
+                    return ("timeout",)
+                ready = {key.fd for key, _ in sel.select(left)}
+                if 0 in ready:
+                    stdin.fill()
+                if self.results not in ready:
+                    continue
+                chunk = os.read(self.results, 65536)
+                if not chunk:
+                    return ("exit", self.wait(until))
+                self.buf += chunk
+                if len(self.buf) > max_output:
+                    return ("garbage",)
+        line, _, self.buf = self.buf.partition(b"\n")
+        if self.buf:  # ahead of the next case's args
+            return ("garbage",)
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            return ("garbage",)
+        return ("line", obj) if isinstance(obj, dict) else ("garbage",)
+
+    def wait(self, until: float) -> int:
+        """Reap the child, killing it if it's still there at `until`."""
+        while self.status is None:
+            pid, status, usage = os.wait4(self.pid, os.WNOHANG)
+            if not pid and time.monotonic() < until:
+                time.sleep(0.001)
+                continue
+            if not pid:
+                self.kill()
+                pid, status, usage = os.wait4(self.pid, 0)
+            self.status, self.usage = os.waitstatus_to_exitcode(status), usage
+        return self.status
+
+    def kill(self) -> None:
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def close(self) -> None:
+        if self.status is None:
+            self.kill()
+            self.wait(0)
+        for fd in (self.cases, self.results, *(self.proc or ())):
+            os.close(fd)
+
+
+def _case_result(reply: tuple) -> dict:
+    """A result line for what the child did with a case (no "i", "ms", "kb" yet)."""
+    if reply[0] == "line" and "value" in reply[1]:
+        return {"value": reply[1]["value"]}
+    if reply[0] == "line" and "error" in reply[1]:
+        return {"error": str(reply[1]["error"])[:500], **({"memory": True} if reply[1].get("memory") else {})}
+    if reply[0] == "timeout":
+        return {"time_limit": True}
+    if reply[0] == "exit":
+        if reply[1] in (-signal.SIGXCPU, -signal.SIGKILL):
+            return {"time_limit": True}
+        return {"error": f"SystemExit: exited with status {reply[1]}"}
+    return {"error": "RuntimeError: unexpected output on the judge's channel"}
+
+
+def run(job: dict, args: list, emit, stdin: _Stdin | None = None,
+        max_output: int = 1 << 20) -> tuple[bool, bool]:
+    """
+    Run the job's cases in children, emit()ting a result line per case.
+    Returns (timed_out, cancelled); a cancel is a line arriving on stdin.
+    """
+    deadline = time.monotonic() + float(job["timeout"])
+    case_timeout = float(job["case_timeout"])
+    devnull = os.open(os.devnull, os.O_RDWR)
+    i = 0
+    try:
+        while i < len(args):
+            child = _Child(job, devnull)
+            try:
+                reply = child.read(deadline, stdin, max_output)
+                if reply[0] in ("timeout", "cancel"):
+                    return reply[0] == "timeout", reply[0] == "cancel"
+                if reply[0] == "line" and "compile_error" in reply[1]:
+                    emit({"compile_error": str(reply[1]["compile_error"])[:500]})
+                    return False, False
+                if reply != ("line", {"ready": True}):
+                    emit({"i": i, **_case_result(reply)})  # died loading
+                    i += 1
+                    continue
+                while i < len(args):
+                    rss = child.start_case()
+                    cpu = child.cpu_ns()
+                    child.send(args[i])
+                    reply = child.read(min(deadline, time.monotonic() + case_timeout), stdin, max_output)
+                    if reply[0] == "cancel" or (reply[0] == "timeout" and time.monotonic() >= deadline):
+                        return reply[0] == "timeout", reply[0] == "cancel"
+                    measured = {"ms": (child.cpu_ns() - cpu) / 1e6, **child.peak_kb(rss)}
+                    emit({"i": i, **_case_result(reply), **measured})
+                    i += 1
+                    if reply[0] != "line" or not reply[1].keys() & {"value", "error"}:
+                        break  # a fresh child for the rest
+            finally:
+                child.close()
+    finally:
+        os.close(devnull)
+    return False, False
+
+
+def main() -> None:
+    job = json.loads(sys.stdin.buffer.read())
+    run(job, job["args"], _emit)
+
+
+def serve() -> None:
+    args_by_key: dict = {}
+    stdin = _Stdin()
+    max_output = int(sys.argv[2]) if len(sys.argv) > 2 else 1 << 20
+    while (line := stdin.readline()) is not None:
+        job = json.loads(line)
+        if job.get("cancel"):
+            continue  # for a job that had already finished
+        if "args" in job:
+            args_by_key[job["key"]] = job["args"]
+        args = args_by_key.get(job["key"])
+        if args is None:
+            _emit({"need_args": True})
+            continue
+        timed_out, cancelled = run(job, args, lambda obj: _emit({"out": obj}), stdin, max_output)
+        _emit({"done": True, "timed_out": timed_out, "cancelled": cancelled})
+
+
+if __name__ == "__main__":
+    serve() if sys.argv[1:2] == ["--serve"] else main()
@@ -0,0 +1,174 @@
+# game/state_cache.py
+"""
+Write-through cache of Match rows for MatchStateView, so polls don't hit Postgres.
+
+Every state change already goes through lifecycle.publish(); that now also
+  * NOTIFYs "match_state" with "<match_id>:<state_version>" inside the writing
+    transaction, so other workers hear about it exactly when it commits, and
+  * writes the new row into this process's cache once the transaction commits.
+
+Each process runs one listener thread. On a notification it drops any cached
+copy older than the announced version and remembers the version, so a slow
+reader can't put an older row back afterwards. The cache is only served while
+the listener is connected. If the connection drops, the cache is cleared and
+reads go to the database until it is back.
+
+Cached rows are for rendering state. Fields that don't bump state_version
+(the deck cursors) may be stale in them.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+from .layers import pg_connect
+from .models import Match
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "match_state"
+
+_FIELDS = [f.attname for f in Match._meta.concrete_fields]
+
+
+class MatchStateCache:
+    """Backend interface; see LocalMatchStateCache."""
+
+    def get(self, match_id: int) -> Match | None:
+        raise NotImplementedError
+
+    def set(self, match: Match) -> None:
+        """Store a row unless a newer state_version is already known."""
+        raise NotImplementedError
+
+    def invalidate(self, match_id: int, version: int) -> None:
+        """Drop copies older than `version`; later set()s below it are ignored."""
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class LocalMatchStateCache(MatchStateCache):
+    """Per-process LRU of match rows (as tuples), bounded by MAX_ENTRIES."""
+
+    def __init__(self, max_entries: int = 10_000, **kwargs):
+        self.max_entries = max_entries
+        # match_id -> (state_version, row values or None when only the version is known)
+        self._entries: OrderedDict[int, tuple[int, tuple | None]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, match_id):
+        with self._lock:
+            entry = self._entries.get(match_id)
+            if entry is None or entry[1] is None:
+                return None
+            self._entries.move_to_end(match_id)
+        return Match.from_db(connection.alias, _FIELDS, entry[1])
+
+    def set(self, match):
+        values = tuple(getattr(match, name) for name in _FIELDS)
+        self._put(match.id, match.state_version, values)
+
+    def invalidate(self, match_id, version):
+        self._put(match_id, version, None)
+
+    def _put(self, match_id: int, version: int, values: tuple | None) -> None:
+        with self._lock:
+            entry = self._entries.get(match_id)
+            if entry is not None and (entry[0] > version or (entry[0] == version and values is None)):
+                return
+            self._entries[match_id] = (version, values)
+            self._entries.move_to_end(match_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _InvalidationListener(threading.Thread):
+    """LISTENs on CHANNEL and applies invalidations to the cache."""
+
+    def __init__(self, cache: MatchStateCache):
+        super().__init__(name="match-state-cache", daemon=True)
+        self.cache = cache
+        self.connected = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                conn = pg_connect(application_name="match-state-cache")
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{CHANNEL}"')
+                self.connected.set()
+                while True:
+                    if select.select([conn], [], [], 30.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        match_id, _, version = conn.notifies.pop(0).payload.partition(":")
+                        self.cache.invalidate(int(match_id), int(version))
+            except Exception:
+                logger.warning("Match state cache listener disconnected; serving from the database", exc_info=True)
+            # Invalidations may have been missed while down.
+            self.connected.clear()
+            self.cache.clear()
+            time.sleep(1.0)
+
+
+_cache: MatchStateCache | None = None
+_listener: _InvalidationListener | None = None
+_init_lock = threading.Lock()
+
+
+def _get_cache() -> MatchStateCache | None:
+    global _cache, _listener
+    if _listener is None:
+        with _init_lock:
+            if _listener is None:
+                config = dict(settings.MATCH_STATE_CACHE)
+                backend = config.pop("BACKEND")
+                if not backend:
+                    return None
+                _cache = import_string(backend)(**{k.lower(): v for k, v in config.items()})
+                _listener = _InvalidationListener(_cache)
+                _listener.start()
+    return _cache if _listener.connected.is_set() else None
+
+
+def cached_match(match_id: int) -> Match | None:
+    """The match, from the cache when possible; None if it doesn't exist."""
+    cache = _get_cache()
+    if cache is not None:
+        m = cache.get(match_id)
+        if m is not None:
+            return m
+    m = Match.objects.filter(id=match_id).first()
+    if m is not None and cache is not None:
+        cache.set(m)
+    return m
+
+
+def write_through(m: Match, notified: bool = False) -> None:
+    """
+    Announce m's new state to every worker (delivered when the current
+    transaction commits) and store it in this process's cache after commit.
+    notified: the statement that bumped state_version already sent the NOTIFY.
+    """
+    if not notified:
+        with connection.cursor() as cur:
+            cur.execute("SELECT pg_notify(%s, %s)", [CHANNEL, f"{m.id}:{m.state_version}"])
+    cache = _get_cache()
+    if cache is None or m.get_deferred_fields():
+        return
+    snapshot = Match.from_db(connection.alias, _FIELDS, [getattr(m, name) for name in _FIELDS])
+    transaction.on_commit(lambda: cache.set(snapshot))
@@ -1,3 +1,1101 @@
-from django.test import TestCase
+import asyncio
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import importlib
+import io
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from authapp.models import Users
+
+from .answers import reconcile_scores, record_answer, record_answers
+from .clock import MatchClock
+from .judge import ForkServerPool, JudgePool, JudgeResult, Verdict, judge, shards
+from .layers import PostgresChannelLayer
+from .leaderboard import RankIndex
+from .lifecycle import activate_matches, ensure_unanswered_rows, finish_matches
+from .matchmaking import (InMemoryQueue, PostgresQueue, RatingBuckets, _greedy_pairs, elo_window, get_queue,
+                          pair_tick)
+from .models import (MATCH_DURATION_SECONDS, MCQ, Coding, EloRating, GameResult, Match, MatchEvent, Question,
+                     QueueEntry)
+from .partitions import ensure_partitions, list_partitions, month_suffix
+from .questions import QuestionCache, QuestionPool, deal_deck, question_payload
+from .rating import elo_delta, rate_matches
+from .realtime import match_group
+from .routing import websocket_urlpatterns
+from .state_cache import LocalMatchStateCache, cached_match, write_through
+from .usernames import UsernameCache
+from .writebehind import WriteBehindBuffer
+
+# The cache's LISTEN thread would hold a connection to the test database.
+no_state_cache = override_settings(MATCH_STATE_CACHE={"BACKEND": ""})
+
+
+class UnmanagedTablesMixin:
+    """game_results (and "User") are managed=False; create them for the test database."""
+
+    unmanaged_models = (GameResult, Users)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        existing = connection.introspection.table_names()
+        with connection.schema_editor() as editor:
+            for model in cls.unmanaged_models:
+                if model._meta.db_table.strip('"') not in existing:
+                    editor.create_model(model)
+
+    @contextmanager
+    def assertMaxQueries(self, n):
+        with CaptureQueriesContext(connection) as ctx:
+            yield ctx
+        sql = "\n".join(q["sql"] for q in ctx.captured_queries)
+        self.assertLessEqual(len(ctx), n, f"{len(ctx)} queries:\n{sql}")
+
+
+@no_state_cache
+class SubmitQueryBudgetTests(UnmanagedTablesMixin, TestCase):
+    """An MCQ submit must stay within three database round trips."""
+
+    MAX_QUERIES = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        MCQ.objects.create(question=cls.question, choices=["3", "4", "5"], answer_index=1)
+        cls.match = Match.objects.create(
+            player1_id=1, player2_id=2, status="active",
+            begin_at=timezone.now() - timedelta(seconds=1),
+            question_ids=[cls.question.id],
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        # Also warms the question payload cache; a cache miss is not submit's cost.
+        self.submit(1)
+
+    def submit(self, answer_index, user_id=1):
+        return self.client.post(
+            f"/api/match/{self.match.id}/submit/",
+            {"user_id": user_id, "question_id": self.question.id, "answer_index": answer_index},
+            format="json",
+        )
+
+    def test_first_submit_within_budget(self):
+        with self.assertMaxQueries(self.MAX_QUERIES):
+            resp = self.submit(1, user_id=2)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.data["correct"])
+        self.match.refresh_from_db()
+        self.assertEqual((self.match.p1_score, self.match.p2_score), (1, 1))
+
+    def test_resubmit_within_budget_and_not_double_counted(self):
+        with self.assertMaxQueries(self.MAX_QUERIES):
+            self.submit(1)
+        self.match.refresh_from_db()
+        self.assertEqual(self.match.p1_score, 1)
+        self.assertEqual(GameResult.objects.filter(match=self.match, player_id=1).count(), 1)
+        self.assertFalse(EloRating.objects.exists())  # ratings move at finish only
+
+    def test_changing_to_wrong_answer_takes_points_back(self):
+        resp = self.submit(0)
+        self.assertFalse(resp.data["correct"])
+        self.match.refresh_from_db()
+        self.assertEqual(self.match.p1_score, 0)
+
+    def test_reconcile_finds_and_fixes_drifted_scores(self):
+        Match.objects.filter(id=self.match.id).update(p1_score=5)
+        (mismatch,) = reconcile_scores(self.match.id, self.match.id, fix=True)
+        self.assertEqual((mismatch.stored, mismatch.counted), ((5, 0), (1, 0)))
+        self.assertEqual(reconcile_scores(self.match.id, self.match.id), [])
+
+    def test_reconcile_command_batches_the_ids_that_exist(self):
+        far = Match.objects.create(id=self.match.id + 10**9, player1_id=1, player2_id=2, p2_score=3)
+        Match.objects.filter(id=self.match.id).update(p1_score=5)
+        out = io.StringIO()
+        with CaptureQueriesContext(connection) as ctx:
+            call_command("reconcile_scores", "--fix", "--batch", "1", stdout=out)
+        self.assertEqual(len(ctx), 5)  # one id lookup and one check per batch, and the empty lookup
+        self.assertIn(f"2 mismatched scores in match ids {self.match.id}..{far.id} (2 matches)", out.getvalue())
+        self.assertEqual(reconcile_scores(self.match.id, far.id), [])
+
+
+@no_state_cache
+class ConcurrentSubmitTests(UnmanagedTablesMixin, TransactionTestCase):
+    """Submits racing on one answer row must move the score once."""
+
+    available_apps = ["game", "authapp"]  # flush with CASCADE: game_results refers to game_match
+
+    def setUp(self):
+        self.question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        self.match = Match.objects.create(player1_id=1, player2_id=2, status="active",
+                                          begin_at=timezone.now(), question_ids=[self.question.id])
+
+    def submit(self):
+        record_answer(self.match.id, 1, self.question.id, "mcq", {"answer_index": 1}, True, 900)
+
+    def race(self, first, second):
+        """Run second() while first()'s transaction is still open, then commit first()."""
+        opened, release = threading.Event(), threading.Event()
+
+        def hold():
+            try:
+                with transaction.atomic():
+                    first()
+                    opened.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        def run():
+            try:
+                second()
+            finally:
+                connection.close()
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        self.assertTrue(opened.wait(10))
+        racer = threading.Thread(target=run)
+        racer.start()
+        deadline = time.monotonic() + 10
+        with connection.cursor() as cur:
+            while time.monotonic() < deadline:  # until second() waits on first()'s locks
+                cur.execute("SELECT count(*) FROM pg_stat_activity"
+                            " WHERE datname = current_database() AND wait_event_type = 'Lock'")
+                if cur.fetchone()[0]:
+                    break
+                time.sleep(0.01)
+        release.set()
+        holder.join()
+        racer.join()
+
+    def assertScored(self, p1_score):
+        self.match.refresh_from_db()
+        self.assertEqual(self.match.p1_score, p1_score)
+        self.assertEqual(reconcile_scores(self.match.id, self.match.id), [])
+
+    def test_double_submit_counts_once(self):
+        self.race(self.submit, self.submit)
+        self.assertEqual(GameResult.objects.filter(match=self.match).count(), 1)
+        self.assertScored(1)
+
+    def flush(self):
+        record_answers([{
+            "match_id": self.match.id, "player_id": 1, "question_id": self.question.id, "question_kind": "mcq",
+            "answer": {"answer_index": 1}, "is_correct": True, "elapsed_ms": 900, "created_at": timezone.now(),
+        }])
+
+    def test_batches_racing_each_other_or_a_submit_count_once(self):
+        self.race(self.flush, self.flush)
+        self.assertScored(1)
+        GameResult.objects.filter(match=self.match).delete()
+        Match.objects.filter(id=self.match.id).update(p1_score=0)
+        self.race(self.submit, self.flush)
+        self.assertScored(1)
+
+    def test_queued_answers_to_a_match_finished_meanwhile_are_dropped(self):
+        buffer = WriteBehindBuffer(max_delay=3600)
+        buffer.add_result({
+            "match_id": self.match.id, "player_id": 1, "question_id": self.question.id, "question_kind": "mcq",
+            "answer": {"answer_index": 1}, "is_correct": True, "elapsed_ms": 900, "created_at": timezone.now(),
+        })
+        written = []
+        self.race(lambda: Match.objects.filter(id=self.match.id).update(status="finished"),
+                  lambda: written.append(buffer.flush_now()))
+        self.assertEqual(written, [(0, 0)])
+        self.assertFalse(GameResult.objects.filter(match=self.match).exists())
+        self.assertScored(0)
+
+
+@no_state_cache
+class FinishQueryCountTests(UnmanagedTablesMixin, TestCase):
+    """Finishing matches takes the same number of queries whatever the deck size."""
+
+    players = itertools.count(step=10)  # the username cache outlives each test's rollback
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.questions = [Question.objects.create(title=f"q{i}", question_kind="mcq") for i in range(20)]
+
+    def make_matches(self, count, deck_size):
+        deck = [q.id for q in self.questions[:deck_size]]
+        first = 10 + next(self.players)  # fresh players: no username cache hits
+        return [
+            Match.objects.create(
+                player1_id=first + 2 * i, player2_id=first + 1 + 2 * i, status="active",
+                begin_at=timezone.now() - timedelta(minutes=5),
+                question_ids=deck, p1_cursor=deck_size - 1, p2_cursor=deck_size - 1,
+            )
+            for i in range(count)
+        ]
+
+    def finish_query_count(self, count, deck_size):
+        matches = self.make_matches(count, deck_size)
+        with CaptureQueriesContext(connection) as ctx:
+            finish_matches([m.id for m in matches])
+        return len(ctx), matches
+
+    def test_query_count_does_not_grow_with_deck(self):
+        small, _ = self.finish_query_count(3, 2)
+        large, _ = self.finish_query_count(3, 20)
+        self.assertEqual(small, large)
+
+    def test_timeout_rows_fill_gaps_without_touching_answers(self):
+        (m,) = self.make_matches(1, 3)
+        record_answer(m.id, m.player1_id, self.questions[0].id, "mcq", {"answer_index": 0}, True, 900)
+        finish_matches([m.id])
+        self.assertEqual(GameResult.objects.filter(match=m).count(), 6)
+        self.assertEqual(GameResult.objects.filter(match=m, answer__timeout=True).count(), 5)
+        m.refresh_from_db()
+        self.assertEqual((m.status, m.p1_score, m.p2_score), ("finished", 1, 0))
+        self.assertEqual(ensure_unanswered_rows(m), 0)
+
+
+@no_state_cache
+class RatingTests(UnmanagedTablesMixin, TestCase):
+    def finished_match(self, p1, p2, p1_score, p2_score):
+        return Match.objects.create(player1_id=p1, player2_id=p2, status="finished",
+                                    p1_score=p1_score, p2_score=p2_score)
+
+    def elo(self, user_id):
+        return EloRating.objects.get(user_id=user_id).elo
+
+    def test_expected_score_delta(self):
+        self.assertEqual(elo_delta(1000, 1000, 1.0, k=32), 16)
+        self.assertEqual(elo_delta(1000, 1000, 0.5, k=32), 0)
+        # An upset pays more than a win over a weaker player.
+        self.assertGreater(elo_delta(1000, 1400, 1.0, k=32), 16)
+        self.assertLess(elo_delta(1400, 1000, 1.0, k=32), 16)
+
+    @override_settings(RATING={"K_FACTOR": 32, "BASE": 1000})
+    def test_batch_is_rated_once_in_match_order(self):
+        a = self.finished_match(1, 2, 3, 1)
+        b = self.finished_match(1, 3, 0, 2)
+        with self.assertMaxQueries(6):  # four statements + SAVEPOINT/RELEASE
+            self.assertEqual(rate_matches([b.id, a.id]), 2)
+        # 1 beat 2 at 1000-1000 (+16), then lost to 3 at 1016-1000.
+        after_b = elo_delta(1016, 1000, 0.0, k=32)
+        self.assertEqual((self.elo(1), self.elo(2), self.elo(3)), (1016 + after_b, 984, 1000 - after_b))
+        self.assertEqual(rate_matches([a.id, b.id]), 0)
+        self.assertEqual(self.elo(1), 1016 + after_b)
+
+    def test_unfinished_matches_are_not_rated(self):
+        m = Match.objects.create(player1_id=1, player2_id=2, status="active")
+        self.assertEqual(rate_matches([m.id]), 0)
+        self.assertFalse(EloRating.objects.exists())
+
+
+@no_state_cache
+@override_settings(WRITE_BEHIND={**settings.WRITE_BEHIND, "ENABLED": False, "EVENTS": False})
+class MatchReplayTests(UnmanagedTablesMixin, TestCase):
+    def test_lifecycle_is_logged_and_paged_in_order(self):
+        question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        MCQ.objects.create(question=question, choices=["3", "4"], answer_index=1)
+        m = Match.objects.create(player1_id=1, player2_id=2, question_ids=[question.id])
+        duration = timedelta(seconds=MATCH_DURATION_SECONDS)
+        client = APIClient()
+        for user_id in (1, 2):
+            client.post(f"/api/match/{m.id}/ready/", {"user_id": user_id}, format="json")
+        # Pretend the countdown started 8 seconds ago.
+        Match.objects.filter(id=m.id).update(begin_at=timezone.now() - timedelta(seconds=5))
+        MatchEvent.objects.filter(match=m).update(created_at=F("created_at") - timedelta(seconds=8))
+        activate_matches([m.id])
+        client.post(f"/api/match/{m.id}/submit/",
+                    {"user_id": 1, "question_id": question.id, "answer_index": 1}, format="json")
+        with mock.patch("django.utils.timezone.now", return_value=timezone.now() + duration):
+            client.post(f"/api/match/{m.id}/finish/", {"user_id": 2}, format="json")
+
+        seen, params = [], {"limit": 2}
+        while True:
+            data = client.get(f"/api/match/{m.id}/replay/", params).data
+            self.assertLessEqual(data["count"], 2)
+            seen += [(e["event"], e["actor_id"]) for e in data["events"]]
+            if data["next"] is None:
+                break
+            params = {"limit": 2, **data["next"]}
+        self.assertEqual(seen, [
+            ("ready", 1), ("ready", 2), ("countdown_started", None), ("activated", None),
+            ("answer", 1), ("finished", None),
+        ])
+
+
+@no_state_cache
+class MatchFinishTests(UnmanagedTablesMixin, TestCase):
+    def setUp(self):
+        question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        self.match = Match.objects.create(player1_id=1, player2_id=2, status="active", begin_at=timezone.now(),
+                                          question_ids=[question.id])
+        self.client = APIClient()
+
+    def finish(self, **data):
+        return self.client.post(f"/api/match/{self.match.id}/finish/", data, format="json")
+
+    def test_only_players_finish_and_only_once_the_time_is_up(self):
+        self.assertEqual(self.finish().status_code, 400)
+        self.assertEqual(self.finish(user_id=3).status_code, 403)
+        self.assertEqual((self.finish(user_id=1).status_code, self.finish(user_id=1).data),
+                         (409, {"error": "match not over"}))
+        self.match.refresh_from_db()
+        self.assertEqual((self.match.status, self.match.rated), ("active", False))
+
+        Match.objects.filter(id=self.match.id).update(
+            begin_at=timezone.now() - timedelta(seconds=MATCH_DURATION_SECONDS + 1))
+        self.assertEqual(self.finish(user_id=2).data["status"], "finished")
+        self.match.refresh_from_db()
+        self.assertEqual((self.match.status, self.match.rated), ("finished", True))
+        self.assertEqual(GameResult.objects.filter(match=self.match, answer={"timeout": True}).count(), 2)
+        self.assertEqual(self.finish(user_id=1).status_code, 200)
+        self.assertEqual(EloRating.objects.count(), 2)
+
+    def test_unstarted_match_is_not_finished(self):
+        Match.objects.filter(id=self.match.id).update(status="pending", begin_at=None)
+        self.assertEqual(self.finish(user_id=1).status_code, 409)
+        self.assertFalse(EloRating.objects.exists())
+
+
+class PartitionTests(UnmanagedTablesMixin, TestCase):
+    """Runs migration 0019 on the test tables (undone with the test transaction)."""
+
+    def setUp(self):
+        self.question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        self.old = Match.objects.create(player1_id=1, player2_id=2, status="active")
+        record_answer(self.old.id, 1, self.question.id, "mcq", {"answer_index": 1}, True, 900)
+        with connection.cursor() as cur:
+            cur.execute("SET CONSTRAINTS ALL IMMEDIATE")  # no pending FK checks on tables being altered
+
+    def migrate(self):
+        migration = importlib.import_module("game.migrations.0019_partition_results_events")
+        migration.partition_tables(None, SimpleNamespace(connection=connection))
+
+    def partition_of(self, table, match_id):
+        with connection.cursor() as cur:
+            cur.execute(f"SELECT DISTINCT tableoid::regclass::text FROM {table} WHERE match_id = %s", [match_id])
+            return [row[0] for row in cur.fetchall()]
+
+    def test_new_month_gets_next_block_and_upserts_still_conflict(self):
+        self.migrate()
+        block = settings.PARTITIONS["MATCH_ID_BLOCK"]
+        this_month = timezone.now().date().replace(day=1)
+        next_month = (this_month + timedelta(days=32)).replace(day=1)
+        self.assertEqual(ensure_partitions(now=timezone.now(), ahead=0), [])
+        self.assertEqual(ensure_partitions(now=timezone.make_aware(datetime(next_month.year, next_month.month, 1)),
+                                           ahead=0),
+                         [month_suffix(next_month)])
+        self.assertEqual([(p.suffix, p.upper) for p in list_partitions()], [
+            ("legacy", block), (month_suffix(this_month), 2 * block), (month_suffix(next_month), 3 * block),
+        ])
+
+        m = Match.objects.create(player1_id=1, player2_id=2, status="active")
+        self.assertEqual(m.id, 2 * block)
+        record_answer(m.id, 1, self.question.id, "mcq", {"answer_index": 0}, False, 800)
+        outcome = record_answer(m.id, 1, self.question.id, "mcq", {"answer_index": 1}, True, 700)
+        self.assertEqual(outcome.match.p1_score, 1)
+        MatchEvent.objects.create(match=m, event=MatchEvent.Kind.ANSWER, actor_id=1)
+
+        self.assertEqual(GameResult.objects.filter(match=m).count(), 1)
+        self.assertEqual(self.partition_of("game_results", m.id), [f"game_results_{month_suffix(next_month)}"])
+        self.assertEqual(self.partition_of("match_events", m.id), [f"match_events_{month_suffix(next_month)}"])
+        self.assertEqual(self.partition_of("game_results", self.old.id), ["game_results_legacy"])
+
+    def test_serial_ids_and_integer_match_ids_are_converted(self):
+        # game_results as created outside Django: serial id, integer match_id
+        with connection.cursor() as cur:
+            cur.execute("ALTER TABLE game_results ALTER COLUMN id DROP IDENTITY")
+            cur.execute("CREATE SEQUENCE game_results_id_seq OWNED BY game_results.id")
+            cur.execute("SELECT setval('game_results_id_seq', (SELECT MAX(id) FROM game_results))")
+            cur.execute("ALTER TABLE game_results ALTER COLUMN id SET DEFAULT nextval('game_results_id_seq'), "
+                        "ALTER COLUMN match_id TYPE integer")
+        self.migrate()
+
+        m = Match.objects.create(player1_id=1, player2_id=2, status="active")
+        self.assertEqual(m.id % settings.PARTITIONS["MATCH_ID_BLOCK"], 0)  # sequences aren't rolled back
+        self.assertTrue(record_answer(m.id, 1, self.question.id, "mcq", {"answer_index": 1}, True, 700).match)
+        with connection.cursor() as cur:
+            cur.execute("SELECT atttypid::regtype::text FROM pg_attribute "
+                        "WHERE attrelid = 'game_results'::regclass AND attname = 'match_id'")
+            self.assertEqual(cur.fetchone()[0], "bigint")
+            cur.execute("SELECT pg_get_serial_sequence('game_results_legacy', 'id'), "
+                        "pg_get_serial_sequence('game_results', 'id') IS NOT NULL")
+            self.assertEqual(cur.fetchone(), (None, True))  # the parent's identity replaced the serial
+
+
+class JudgeTests(SimpleTestCase):
+    cases = [{"args": [1], "expected": 2}, {"args": [3], "expected": 6}, {"args": [0], "expected": 0}]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pool = cls.make_pool()
+
+    @staticmethod
+    def make_pool():
+        return JudgePool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        super().tearDownClass()
+
+    def judge(self, code, **kwargs):
+        return judge(code, self.cases, pool=self.pool, **kwargs)
+
+    def test_verdict_per_test_case(self):
+        self.assertEqual(self.judge("def solve(x):\n    return x * 2").verdict, Verdict.ACCEPTED)
+        result = self.judge("def solve(x):\n    return 6 // x * x")
+        self.assertEqual(result.verdict, Verdict.WRONG_ANSWER)
+        self.assertEqual([c.verdict for c in result.cases],
+                         [Verdict.WRONG_ANSWER, Verdict.PASSED, Verdict.RUNTIME_ERROR])
+        self.assertIn("ZeroDivisionError", result.cases[2].error)
+        self.assertEqual(self.judge("def solve(x) return").verdict, Verdict.COMPILE_ERROR)
+
+    def test_limits(self):
+        result = self.judge("def solve(x):\n    while True:\n        pass", time_ms=100)
+        self.assertEqual({c.verdict for c in result.cases}, {Verdict.TIME_LIMIT})
+        result = self.judge("def solve(x):\n    return len(bytearray(512 * 2**20))", memory_mb=64)
+        self.assertEqual(result.verdict, Verdict.MEMORY_LIMIT)
+        result = judge("def solve(x):\n    return len(bytearray(x * 2**20))", [{"args": [32], "expected": 32 * 2**20}],
+                       pool=self.pool)
+        self.assertEqual(result.verdict, Verdict.ACCEPTED)
+        self.assertGreater(result.cases[0].memory_kb, 30 * 1024)
+
+    def test_shards_stop_at_first_failure(self):
+        self.assertEqual(shards(20, 4), [list(range(0, 20, 2)), list(range(1, 20, 2))])
+        self.assertEqual(shards(5, 4), [[0, 1, 2, 3, 4]])
+        cases = [{"args": [i], "expected": i * 2} for i in range(24)]
+        # Case 4 is wrong; case 23 never returns.
+        code = "def solve(x):\n    while x == 23:\n        pass\n    return -1 if x == 4 else x * 2"
+        result = judge(code, cases, time_ms=2000, stop_on_failure=True, pool=self.pool)
+        self.assertEqual(result.verdict, Verdict.WRONG_ANSWER)
+        self.assertEqual((result.cases[4].verdict, result.cases[23].verdict), (Verdict.WRONG_ANSWER, Verdict.SKIPPED))
+        self.assertLess(result.elapsed_ms, 2000)
+        result = judge(code, cases[:23], stop_on_failure=False, pool=self.pool)
+        self.assertEqual([c.verdict for c in result.cases if c.verdict != Verdict.PASSED], [Verdict.WRONG_ANSWER])
+
+    def test_no_network_or_files(self):
+        self.assertEqual(self.judge("import socket\ndef solve(x):\n    return x * 2").verdict,
+                         Verdict.COMPILE_ERROR)
+        result = self.judge("def solve(x):\n    return open('/etc/hostname').read()")
+        self.assertIn("Too many open files", result.cases[0].error)
+        result = self.judge("import os\ndef solve(x):\n    os.close(0)\n    return open('/etc/hostname').read()")
+        self.assertIn("Too many open files", result.cases[0].error)
+
+    def test_time_and_memory_measured_outside_the_submission(self):
+        # Result lines written straight to fd 1, then 300 ms of CPU per case.
+        code = ("import json, os, time\n"
+                "def solve(x):\n"
+                "    os.write(1, ''.join(json.dumps({'i': i, 'value': 2 * x, 'ms': 0.01, 'kb': 1}) + '\\n'\n"
+                "                        for i in range(3)).encode())\n"
+                "    started = time.process_time()\n"
+                "    while time.process_time() - started < 0.3:\n"
+                "        pass\n"
+                "    return x * 2")
+        result = self.judge(code, time_ms=100)
+        self.assertNotIn(Verdict.PASSED, [c.verdict for c in result.cases])
+        result = self.judge(code.replace("os.write(1, ", "print("), time_ms=100)
+        self.assertEqual({c.verdict for c in result.cases}, {Verdict.TIME_LIMIT})
+        # Measured by the judge, not the forged 0.01 (the wall-clock kill can land just under 100 ms).
+        self.assertGreater(min(c.elapsed_ms for c in result.cases), 10)
+
+
+class ForkServerJudgeTests(JudgeTests):
+    @staticmethod
+    def make_pool():
+        return ForkServerPool(1, recycle_after=3)
+
+    def test_args_cached_per_key_and_parents_recycled(self):
+        solution = "def solve(x):\n    return x * 2"
+        for _ in range(4):
+            self.assertEqual(self.judge(solution, key="q1").verdict, Verdict.ACCEPTED)
+        result = judge(solution, [{"args": [5], "expected": 10}], key="q2", pool=self.pool)
+        self.assertEqual((result.verdict, len(result.cases)), (Verdict.ACCEPTED, 1))
+        self.assertEqual(self.judge(solution, key="q1").verdict, Verdict.ACCEPTED)
+
+
+class PostgresChannelLayerTests(SimpleTestCase):
+    def run_layers(self, test, n=2):
+        async def main():
+            layers = [PostgresChannelLayer() for _ in range(n)]
+            try:
+                await test(*layers)
+            finally:
+                for layer in layers:
+                    await layer.flush()
+                    await layer.close()
+        asyncio.run(main())
+
+    def test_group_send_reaches_members_in_other_processes(self):
+        async def test(a, b):
+            here, there = await a.new_channel(), await b.new_channel()
+            await a.group_add("match_1", here)
+            await b.group_add("match_1", there)
+            await a.group_send("match_1", {"type": "match.state", "n": 1})
+            got = await asyncio.wait_for(asyncio.gather(a.receive(here), b.receive(there)), 5)
+            self.assertEqual(got, [{"type": "match.state", "n": 1}] * 2)
+            await b.group_discard("match_1", there)
+            await b.send(here, {"type": "direct"})
+            self.assertEqual(await asyncio.wait_for(a.receive(here), 5), {"type": "direct"})
+            with self.assertRaises(ValueError):
+                await a.send("worker.tasks", {"type": "x"})
+        self.run_layers(test)
+
+    def test_connecting_does_not_block_the_loop(self):
+        connect = PostgresChannelLayer._connect
+
+        def slow_connect(layer):
+            time.sleep(0.3)
+            return connect(layer)
+
+        async def test(layer):
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+            ticker = asyncio.create_task(tick())
+            with mock.patch.object(PostgresChannelLayer, "_connect", slow_connect):
+                await layer.group_add("match_2", await layer.new_channel())
+            ticker.cancel()
+            self.assertGreater(ticks, 10)
+        self.run_layers(test, 1)
+
+
+@no_state_cache
+class CodingSubmitTests(UnmanagedTablesMixin, TestCase):
+    def setUp(self):
+        self.question = Question.objects.create(title="double", question_kind="coding")
+        Coding.objects.create(question=self.question, template_code="def solve(x):\n    pass\n", prompt="x * 2",
+                              test_cases=[{"args": [1], "expected": 2}, {"args": [3], "expected": 6}],
+                              time_threshold=500)
+        self.match = Match.objects.create(player1_id=1, player2_id=2, status="active", kind="coding",
+                                          begin_at=timezone.now() - timedelta(seconds=1),
+                                          question_ids=[self.question.id])
+        self.client = APIClient()
+
+    def post(self, code):
+        return self.client.post(f"/api/match/{self.match.id}/submit/",
+                                {"user_id": 1, "question_id": self.question.id, "code": code}, format="json")
+
+    def test_submission_is_judged_and_scored(self):
+        m = self.match
+
+        def submit(code):
+            return self.post(code).data
+
+        data = submit("def solve(x):\n    return x + 1")
+        self.assertEqual((data["correct"], data["verdict"], [t["verdict"] for t in data["tests"]]),
+                         (False, Verdict.WRONG_ANSWER, [Verdict.PASSED, Verdict.WRONG_ANSWER]))
+        data = submit("def solve(x):\n    return x * 2")
+        self.assertEqual((data["correct"], data["verdict"]), (True, Verdict.ACCEPTED))
+        m.refresh_from_db()
+        self.assertEqual(m.p1_score, 1)
+        answer = GameResult.objects.get(match=m).answer
+        self.assertEqual((answer["verdict"], answer["time_ms"]), (Verdict.ACCEPTED, 500))
+        self.assertEqual(set(answer["tests"][0]), {"verdict", "ms", "kb"})
+
+    def test_answer_to_a_match_finished_while_judging_is_not_recorded(self):
+        def judge_slowly(*args, **kwargs):
+            Match.objects.filter(id=self.match.id).update(status="finished", rated=True)
+            return JudgeResult(Verdict.ACCEPTED, (), 1.0)
+
+        with mock.patch("game.views.judge", judge_slowly):
+            resp = self.post("def solve(x):\n    return x * 2")
+        self.assertEqual((resp.status_code, resp.data), (409, {"error": "match finished"}))
+        self.match.refresh_from_db()
+        self.assertEqual(self.match.p1_score, 0)
+        self.assertFalse(GameResult.objects.filter(match=self.match).exists())
+        self.assertTrue(record_answer(self.match.id, 2, self.question.id, "coding", {}, True, None).match_finished)
+
+
+class QueueBackendTests(TestCase):
+    def test_join_leave_and_pop(self):
+        for queue in (InMemoryQueue(), PostgresQueue()):
+            with self.subTest(backend=type(queue).__name__):
+                self.assertTrue(queue.join(1, 1000, "mcq"))
+                self.assertFalse(queue.join(1, 1005, "coding"))  # already queued: keeps the lane
+                self.assertTrue(queue.join(2, 1010, "mcq"))
+                self.assertTrue(queue.join(3, 1000, "coding"))
+                self.assertTrue(queue.is_queued(1))
+                self.assertIn(("mcq", None), queue.lanes())
+                self.assertEqual(queue.pop_pairs(("mcq", None), 10), [(1, 2)])
+                self.assertFalse(queue.is_queued(1) or queue.is_queued(2))
+                self.assertEqual(queue.pop_pairs(("coding", None), 10), [])  # nobody to meet
+                self.assertTrue(queue.leave(3))
+                self.assertFalse(queue.leave(3))
+                self.assertFalse(queue.is_queued(3))
+
+    def test_get_queue_returns_the_configured_backend_once_per_process(self):
+        for path, cls in (("game.matchmaking.InMemoryQueue", InMemoryQueue),
+                          ("game.matchmaking.PostgresQueue", PostgresQueue)):
+            with self.settings(MATCHMAKING={**settings.MATCHMAKING, "QUEUE_BACKEND": path}):
+                self.assertIsInstance(get_queue(), cls)
+                self.assertIs(get_queue(), get_queue())
+
+
+@override_settings(MATCHMAKING={**settings.MATCHMAKING, "ELO_WINDOW": {"BASE": 50, "PER_SECOND": 10, "MAX": 400}})
+class RatingWindowTests(SimpleTestCase):
+    def test_window_widens_with_waiting_and_is_capped(self):
+        self.assertEqual([elo_window(s) for s in (0, 10, 100, -5)], [50, 150, 400, 50])
+
+    def test_nearest_rating_oldest_first(self):
+        players = RatingBuckets()
+        for uid, elo in ((1, 1000), (2, 1000), (3, 1000), (4, 1040), (5, 1100)):
+            players.add(uid, elo)
+        self.assertEqual(players.nearest(1000, 50, exclude=1), 2)
+        players.remove(2)
+        players.remove(3)
+        self.assertEqual(players.nearest(1000, 50, exclude=1), 4)
+        self.assertIsNone(players.nearest(1000, 30, exclude=1))
+        self.assertEqual(players.nearest(1070, 30, exclude=0), 5)  # equally close: the higher rating
+
+    def test_pairs_widen_as_players_wait(self):
+        def pairs(waited):
+            players = RatingBuckets()
+            players.add(1, 1000)
+            players.add(2, 1300)
+            return _greedy_pairs(players, [(1, waited), (2, waited)], 10)
+        self.assertEqual(pairs(0), [])
+        self.assertEqual(pairs(30), [(1, 2)])
+
+
+@override_settings(MATCHMAKING={**settings.MATCHMAKING, "QUEUE_BACKEND": "game.matchmaking.InMemoryQueue"})
+class PairingTickTests(UnmanagedTablesMixin, TestCase):
+    def setUp(self):
+        get_queue().clear()
+        self.client = APIClient()
+
+    def join(self, user_id, kind="mcq", difficulty=None):
+        return self.client.post("/api/queue/join/", {"user_id": user_id, "kind": kind, "difficulty": difficulty},
+                                format="json").data
+
+    def test_one_tick_pairs_each_lane_separately(self):
+        queue = get_queue()
+        for uid, kind, difficulty in ((1, "mcq", None), (2, "coding", "easy"), (3, "mcq", None),
+                                      (4, "coding", "easy"), (5, "mcq", "hard"), (6, "coding", None)):
+            queue.join(uid, 1000, kind, difficulty)
+        with CaptureQueriesContext(connection) as ctx:
+            matches = pair_tick(queue)
+        inserts = [q["sql"] for q in ctx.captured_queries
+                   if q["sql"].startswith(f'INSERT INTO "{Match._meta.db_table}"')]
+        self.assertEqual(len(inserts), 2)  # one bulk_create per lane with a pair
+        self.assertEqual(sorted((m.kind, m.difficulty, m.player1_id, m.player2_id) for m in matches),
+                         [("coding", "easy", 2, 4), ("mcq", None, 1, 3)])
+        self.assertEqual([uid for uid in range(1, 7) if queue.is_queued(uid)], [5, 6])
+
+    def test_failed_match_insert_puts_the_players_back(self):
+        queue = get_queue()
+        for uid, elo in ((1, 1000), (2, 1010), (3, 1400)):
+            queue.join(uid, elo, "mcq")
+        with mock.patch("game.matchmaking.Match.objects.bulk_create", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                pair_tick(queue)
+        self.assertEqual([uid for uid in (1, 2, 3) if queue.is_queued(uid)], [1, 2, 3])
+        with self.captureOnCommitCallbacks(execute=True):
+            (m,) = pair_tick(queue)
+        self.assertEqual((m.player1_id, m.player2_id), (1, 2))
+        queue.restore([(1, 2)])  # committed: nothing to put back
+        self.assertFalse(queue.is_queued(1) or queue.is_queued(2))
+
+    def test_requests_only_queue_unless_pairing_in_request(self):
+        self.assertEqual([self.join(1)["status"], self.join(2)["status"]], ["queued", "queued"])
+        self.assertFalse(Match.objects.exists())
+        get_queue().clear()
+        with self.settings(MATCHMAKING={**settings.MATCHMAKING, "PAIR_IN_REQUEST": True}):
+            self.assertEqual(self.join(3)["status"], "queued")
+            data = self.join(4)
+        self.assertEqual((data["status"], data["opponent_id"]), ("matched", 3))
+
+    def test_check_after_eviction_says_not_queued(self):
+        self.join(1)
+        self.assertEqual(self.client.get("/api/queue/check/", {"user_id": 1}).data, {"status": "waiting"})
+        get_queue().leave(1)  # swept
+        self.assertEqual(self.client.get("/api/queue/check/", {"user_id": 1}).data, {"status": "not_queued"})
+
+
+class HeartbeatEvictionTests(TestCase):
+    def test_in_memory_sweep_evicts_players_not_seen(self):
+        queue = InMemoryQueue()
+        queue.join(1, 1000, "mcq")
+        queue.join(2, 1000, "mcq")
+        queue.join(3, 1000, "mcq")
+        time.sleep(0.05)
+        self.assertTrue(queue.touch(2))
+        self.assertFalse(queue.touch(4))
+        self.assertEqual(queue.sweep(0.03), [1, 3])
+        self.assertEqual(queue.sweep(0.03), [])
+        self.assertEqual([uid for uid in (1, 2, 3) if queue.is_queued(uid)], [2])
+
+    def test_postgres_sweep_and_pairing_skip_stale_rows(self):
+        queue = PostgresQueue()
+        for uid in (1, 2, 3):
+            queue.join(uid, 1000, "mcq")
+        QueueEntry.objects.filter(user_id__in=[1, 3]).update(last_seen=timezone.now() - timedelta(minutes=5))
+        self.assertEqual(queue.pop_pairs(("mcq", None), 10), [])  # 2 has nobody live to meet
+        self.assertTrue(queue.touch(3))
+        self.assertEqual(queue.sweep(settings.MATCHMAKING["HEARTBEAT_TIMEOUT"]), [1])
+        self.assertEqual(queue.pop_pairs(("mcq", None), 10), [(2, 3)])
+
+    def test_rejoining_refreshes_a_stale_entry(self):
+        queue = InMemoryQueue()
+        queue.join(1, 1000, "mcq")
+        time.sleep(0.05)
+        self.assertFalse(queue.join(1, 1100, "mcq"))
+        self.assertEqual(queue.sweep(0.03), [])
+
+        queue = PostgresQueue()
+        queue.join(1, 1000, "mcq")
+        enqueued_at = QueueEntry.objects.get(user_id=1).enqueued_at
+        QueueEntry.objects.filter(user_id=1).update(last_seen=timezone.now() - timedelta(minutes=5))
+        self.assertFalse(queue.join(1, 1100, "coding"))
+        self.assertEqual(queue.sweep(settings.MATCHMAKING["HEARTBEAT_TIMEOUT"]), [])
+        entry = QueueEntry.objects.get(user_id=1)
+        self.assertEqual((entry.elo, entry.kind, entry.enqueued_at), (1100, "mcq", enqueued_at))
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class GameConsumerTests(SimpleTestCase):
+    def test_state_pushed_as_deltas_from_the_players_side(self):
+        async def test():
+            app = URLRouter(websocket_urlpatterns)
+            socket = WebsocketCommunicator(app, "/ws/game/7/?user_id=2")
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            layer = get_channel_layer()
+            state = {"status": "pending", "player1_id": 1, "player2_id": 2, "p1_ready": True, "p2_ready": False}
+            await layer.group_send(match_group(7), {"type": "match.state", "state": state})
+            self.assertEqual(await socket.receive_json_from(), {"type": "state", "delta": {
+                **state, "you_ready": False, "opponent_ready": True}})
+            await layer.group_send(match_group(7), {"type": "match.state", "state": state})
+            self.assertTrue(await socket.receive_nothing())  # nothing changed
+            await layer.group_send(match_group(7), {"type": "match.state", "state": {**state, "status": "active"}})
+            self.assertEqual(await socket.receive_json_from(), {"type": "state", "delta": {"status": "active"}})
+            await socket.send_json_to({"type": "ping"})
+            self.assertEqual(await socket.receive_json_from(), {"type": "pong"})
+            await socket.disconnect()
+
+            socket = WebsocketCommunicator(app, "/ws/game/abc/")
+            connected, code = await socket.connect()
+            self.assertEqual((connected, code), (False, 4400))
+        asyncio.run(test())
+
+
+@no_state_cache
+class MatchClockTests(UnmanagedTablesMixin, TestCase):
+    def test_activates_and_finishes_on_schedule(self):
+        question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        now = timezone.now()
+        duration = timedelta(seconds=MATCH_DURATION_SECONDS)
+
+        def match(status, begin_at):
+            return Match.objects.create(player1_id=1, player2_id=2, status=status, begin_at=begin_at,
+                                        countdown_started_at=begin_at - timedelta(seconds=5),
+                                        question_ids=[question.id])
+        later = match("pending", now + timedelta(seconds=10))
+        due = match("pending", now - timedelta(seconds=1))
+        expired = match("active", now - duration - timedelta(seconds=1))
+
+        clock = MatchClock()
+        self.assertEqual(clock.tick(now), (1, 1))
+        self.assertEqual(Match.objects.get(id=due.id).status, "active")
+        self.assertEqual(Match.objects.get(id=later.id).status, "pending")
+        expired.refresh_from_db()
+        self.assertEqual((expired.status, expired.rated), ("finished", True))
+        self.assertEqual(GameResult.objects.filter(match=expired, answer={"timeout": True}).count(), 2)
+        self.assertAlmostEqual(clock.seconds_until_next(now), 10, delta=0.01)
+
+        self.assertEqual(clock.tick(now + timedelta(seconds=10)), (1, 0))
+        self.assertEqual(clock.tick(now + duration + timedelta(seconds=10)), (0, 2))
+        self.assertEqual(set(Match.objects.values_list("status", flat=True)), {"finished"})
+        self.assertIsNone(clock.seconds_until_next())
+
+    def test_write_behind_answers_flushed_after_the_end_still_count(self):
+        question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        now = timezone.now()
+        begin_at = now - timedelta(seconds=MATCH_DURATION_SECONDS) - timedelta(seconds=0.5)
+        m = Match.objects.create(player1_id=1, player2_id=2, status="active", begin_at=begin_at,
+                                 countdown_started_at=begin_at, question_ids=[question.id])
+        buffer = WriteBehindBuffer(max_delay=3600)
+        buffer.add_result({"match_id": m.id, "player_id": 1, "question_id": question.id, "question_kind": "mcq",
+                           "answer": {}, "is_correct": True, "elapsed_ms": 900, "created_at": now})
+
+        clock = MatchClock()
+        with self.settings(WRITE_BEHIND={**settings.WRITE_BEHIND, "ENABLED": True, "MAX_DELAY": 0.5}):
+            self.assertEqual(clock.tick(now), (0, 0))  # ended, but within the grace period
+            self.assertEqual(finish_matches([m.id], now), [])
+            self.assertEqual(buffer.flush_now(), (1, 0))
+            self.assertEqual(clock.tick(now + timedelta(seconds=1)), (0, 1))
+        m.refresh_from_db()
+        self.assertEqual((m.status, m.rated, m.p1_score), ("finished", True, 1))
+
+
+@no_state_cache
+class MatchStateVersionTests(UnmanagedTablesMixin, TestCase):
+    def test_etag_and_since_version(self):
+        m = Match.objects.create(player1_id=1, player2_id=2, status="pending")
+        client = APIClient()
+        url = f"/api/match/{m.id}/state/?user_id=1"
+        first = client.get(url)
+        self.assertEqual((first.status_code, first.data["state_version"]), (200, 0))
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=first["ETag"]).status_code, 304)
+        self.assertEqual(client.get(f"{url}&since_version=0").data, {"state_version": 0, "unchanged": True})
+        self.assertNotEqual(client.get(url.replace("user_id=1", "user_id=2"))["ETag"], first["ETag"])
+
+        m.p1_ready = True
+        m.save_state(["p1_ready"])
+        changed = client.get(f"{url}&since_version=0", HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual((changed.status_code, changed.data["state_version"], changed.data["you_ready"]), (200, 1, True))
+        self.assertNotEqual(changed["ETag"], first["ETag"])
+
+    def test_status_flip_the_clock_has_not_written_yet_is_not_unchanged(self):
+        m = Match.objects.create(player1_id=1, player2_id=2, status="pending",
+                                 begin_at=timezone.now() - timedelta(seconds=1))
+        data = APIClient().get(f"/api/match/{m.id}/state/?since_version=0").data
+        self.assertEqual((data["state_version"], data["status"]), (0, "active"))
+
+
+class UsernameCacheTests(UnmanagedTablesMixin, TestCase):
+    def test_misses_fetched_in_one_query_and_cached_until_the_ttl(self):
+        for uid in (1, 2):
+            Users.objects.create(user_id=uid, fname="f", lname="l", email=f"u{uid}@x.io", username=f"user{uid}",
+                                 passwordhash="x", role="player")
+        cache = UsernameCache(max_entries=2, ttl=0.05)
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_many([1, 2, 3]), {1: "user1", 2: "user2", 3: None})
+        with self.assertNumQueries(0):  # 1 was the least recently used of three
+            self.assertEqual(cache.get_many([2, 3]), {2: "user2", 3: None})
+        with self.assertNumQueries(1):
+            self.assertEqual(cache.get_many([1]), {1: "user1"})
+        Users.objects.create(user_id=3, fname="f", lname="l", email="u3@x.io", username="user3",
+                             passwordhash="x", role="player")
+        time.sleep(0.06)
+        with self.assertNumQueries(1):  # the miss for 3 expired with the rest
+            self.assertEqual(cache.get_many([1, 3]), {1: "user1", 3: "user3"})
+
+
+class QuestionCacheTests(TestCase):
+    def test_payloads_cached_with_their_answer_until_the_ttl(self):
+        question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        MCQ.objects.create(question=question, choices=["3", "4"], answer_index=1)
+        cache = QuestionCache(max_entries=10, ttl=0.05)
+        with self.assertNumQueries(1):  # the MCQ row comes with the question
+            payload = cache.get_many([question.id, 0])[question.id]
+        self.assertEqual((payload.answer_index, payload.client_data()["choices"]), (1, ["3", "4"]))
+        self.assertNotIn("answer_index", payload.client_data())
+        with self.assertNumQueries(0):
+            self.assertIs(cache.get_many([question.id])[question.id], payload)
+        time.sleep(0.06)
+        with self.assertNumQueries(1):
+            self.assertIsNot(cache.get_many([question.id])[question.id], payload)
+
+    @override_settings(QUESTION_CACHE={**settings.QUESTION_CACHE, "WARM": False})
+    def test_saving_a_question_or_its_answer_invalidates_it(self):
+        question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        mcq = MCQ.objects.create(question=question, choices=["3", "4"], answer_index=1)
+        self.assertEqual(question_payload(question.id).answer_index, 1)
+        mcq.answer_index = 0
+        mcq.save()
+        self.assertEqual(question_payload(question.id).answer_index, 0)
+        question.title = "2 + 1"
+        question.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(question_payload(question.id).data["title"], "2 + 1")
+        with self.assertNumQueries(0):
+            question_payload(question.id)
+
+
+class QuestionPoolTests(SimpleTestCase):
+    def test_sample_per_lane_without_excluded_ids(self):
+        pool = QuestionPool()
+        pool.load([(qid, "mcq", "easy" if qid % 2 else "hard") for qid in range(1, 21)] + [(21, "coding", "easy")])
+        self.assertEqual((pool.size("mcq"), pool.size("mcq", "easy"), pool.size("coding")), (20, 10, 1))
+        for _ in range(20):
+            ids = pool.sample("mcq", 5, "easy", exclude=[1, 3])
+            self.assertEqual(len(set(ids)), 5)
+            self.assertTrue(all(qid % 2 and qid not in (1, 3) for qid in ids))
+        self.assertEqual(sorted(pool.sample("mcq", 5, exclude=range(1, 18))), [18, 19, 20])  # fallback pass
+        self.assertEqual(pool.sample("coding", 3), [21])
+        self.assertEqual(pool.sample("coding", 3, "hard"), [])
+
+    def test_add_moves_and_remove_drops(self):
+        pool = QuestionPool()
+        pool.load([(1, "mcq", "easy"), (2, "mcq", "easy")])
+        pool.add(1, "mcq", "hard")
+        self.assertEqual((pool.size("mcq", "easy"), pool.size("mcq", "hard"), pool.size("mcq")), (1, 1, 2))
+        pool.remove(2)
+        self.assertEqual((len(pool), pool.sample("mcq", 5)), (1, [1]))
+
+
+@no_state_cache
+@override_settings(QUESTION_CACHE={**settings.QUESTION_CACHE, "WARM": False})
+class MatchDeckTests(UnmanagedTablesMixin, TestCase):
+    def setUp(self):
+        self.questions = [Question.objects.create(title=f"q{i}", question_kind="mcq", difficulty="easy").id
+                          for i in range(3)]
+        pool = QuestionPool()
+        pool.load(Question.objects.values_list("id", "question_kind", "difficulty"))
+        patcher = mock.patch("game.questions.question_pool", return_value=pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_deal_deck_is_distinct_and_bounded_by_the_bank(self):
+        deck = deal_deck("mcq", "easy", size=2)
+        self.assertEqual((len(deck), set(deck) <= set(self.questions)), (2, True))
+        self.assertEqual(len(set(deck)), 2)
+        self.assertEqual(sorted(deal_deck("mcq")), self.questions)
+        self.assertEqual(deal_deck("mcq", "hard"), [])
+        self.assertEqual(deal_deck("coding"), [])
+
+    def test_each_player_walks_the_deck_with_their_own_cursor(self):
+        m = Match.objects.create(player1_id=1, player2_id=2, status="active", kind="mcq", difficulty="easy",
+                                 begin_at=timezone.now() - timedelta(seconds=1))
+        client = APIClient()
+
+        def next_question(user_id):
+            data = client.post(f"/api/match/{m.id}/next-question/", {"user_id": user_id}, format="json").data
+            return data.get("id", data.get("no_more_questions"))
+
+        first = client.get(f"/api/match/{m.id}/question/").data["id"]
+        deck = Match.objects.get(id=m.id).question_ids
+        self.assertEqual((sorted(deck), deck[0]), (self.questions, first))
+        self.assertEqual([next_question(1), next_question(1), next_question(1)], [deck[1], deck[2], True])
+        self.assertEqual(next_question(2), deck[1])
+        m.refresh_from_db()
+        self.assertEqual((m.p1_cursor, m.p2_cursor), (2, 1))
+
+
+class MatchStateCacheTests(TestCase):
+    def test_versions_only_move_forward(self):
+        cache = LocalMatchStateCache(max_entries=2)
+        cache.set(Match(id=1, player1_id=1, player2_id=2, state_version=2, status="active"))
+        cache.set(Match(id=1, player1_id=1, player2_id=2, state_version=1, status="pending"))
+        self.assertEqual((cache.get(1).state_version, cache.get(1).status), (2, "active"))
+        cache.invalidate(1, 2)  # the commit we already hold
+        self.assertEqual(cache.get(1).state_version, 2)
+        cache.invalidate(1, 3)
+        self.assertIsNone(cache.get(1))
+        cache.set(Match(id=1, player1_id=1, player2_id=2, state_version=2, status="active"))  # a slow reader
+        self.assertIsNone(cache.get(1))
+        cache.set(Match(id=1, player1_id=1, player2_id=2, state_version=3, status="finished"))
+        self.assertEqual(cache.get(1).status, "finished")
+        cache.set(Match(id=2, player1_id=1, player2_id=2))
+        cache.set(Match(id=3, player1_id=1, player2_id=2))
+        self.assertEqual([cache.get(i) is not None for i in (1, 2, 3)], [False, True, True])
+
+    def test_reads_fill_the_cache_and_writes_go_through_on_commit(self):
+        cache = LocalMatchStateCache()
+        m = Match.objects.create(player1_id=1, player2_id=2, status="pending")
+        with mock.patch("game.state_cache._get_cache", return_value=cache):
+            with self.assertNumQueries(1):
+                cached_match(m.id)
+            with self.assertNumQueries(0):
+                self.assertEqual(cached_match(m.id).state_version, 0)
+            m.p1_ready = True
+            m.save_state(["p1_ready"])
+            with self.captureOnCommitCallbacks(execute=True):
+                write_through(m)
+                self.assertFalse(cached_match(m.id).p1_ready)  # not committed yet
+            with self.assertNumQueries(0):
+                self.assertEqual((cached_match(m.id).state_version, cached_match(m.id).p1_ready), (1, True))
+
+
+class RankIndexTests(SimpleTestCase):
+    def test_rank_and_pages_by_elo_then_user_id(self):
+        index = RankIndex(lo=900, hi=1100)
+        index.load([(5, 1000), (3, 1000), (7, 1050), (1, 950), (9, 1000)])
+        self.assertEqual([index.rank(uid) for uid in (7, 3, 5, 9, 1, 2)], [1, 2, 3, 4, 5, None])
+        self.assertEqual(index.page(2, 3), [(2, 3, 1000), (3, 5, 1000), (4, 9, 1000)])
+        self.assertEqual(index.page(5, 10), [(5, 1, 950)])
+        self.assertEqual(index.position_after(1000, 5), 3)
+        self.assertEqual(index.position_after(1000, 6), 3)  # keys need not exist
+        self.assertEqual(index.position_after(1200, 0), 0)
+
+    def test_rating_changes_move_players(self):
+        index = RankIndex(lo=900, hi=1100)
+        index.load([(1, 1000), (2, 1000)])
+        index.set(2, 3000)  # outside the tree's range: it grows
+        index.set(3, 500)
+        self.assertEqual(index.page(1, 10), [(1, 2, 3000), (2, 1, 1000), (3, 3, 500)])
+        index.remove(2)
+        self.assertEqual((len(index), index.rank(1), index.rank(2)), (2, 1, None))
+
+
+@override_settings(LEADERBOARD={**settings.LEADERBOARD, "MAX_LIMIT": 3})
+class LeaderboardViewTests(UnmanagedTablesMixin, TestCase):
+    def setUp(self):
+        index = RankIndex()
+        index.load([(uid, 1000 + 10 * (uid % 3)) for uid in range(1, 8)])
+        patcher = mock.patch("game.views.rank_index", return_value=index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def test_keyset_pages_walk_the_whole_board(self):
+        # limit is capped at MAX_LIMIT, so this takes three pages
+        seen, params = [], {"limit": 10}
+        while True:
+            data = self.client.get("/api/leaderboard/", params).data
+            seen += [(item["rank"], item["user_id"]) for item in data["items"]]
+            if data["next"] is None:
+                break
+            params = {"limit": 10, **data["next"]}
+        self.assertEqual(seen, [(1, 2), (2, 5), (3, 1), (4, 4), (5, 7), (6, 3), (7, 6)])
+        self.assertEqual(self.client.get("/api/leaderboard/", {"after_elo": 1000}).status_code, 400)
+
+    def test_rank_with_neighbours(self):
+        data = self.client.get("/api/leaderboard/rank/", {"user_id": 4, "around": 5}).data
+        self.assertEqual((data["rank"], data["elo"], data["total"]), (4, 1010, 7))
+        self.assertEqual([item["user_id"] for item in data["around"]], [1, 4, 7])  # around capped at MAX_LIMIT // 2
+        self.assertEqual(self.client.get("/api/leaderboard/rank/", {"user_id": 99}).status_code, 404)
+
+
+@no_state_cache
+class WriteBehindBufferTests(UnmanagedTablesMixin, TestCase):
+    def test_queued_rows_are_readable_and_flushed_in_one_batch(self):
+        question = Question.objects.create(title="2 + 2", question_kind="mcq")
+        m = Match.objects.create(player1_id=1, player2_id=2, status="active", begin_at=timezone.now(),
+                                 question_ids=[question.id])
+        buffer = WriteBehindBuffer(max_delay=3600)
+        first = timezone.now() - timedelta(seconds=5)
+        for uid, correct, at in ((1, False, first), (1, True, timezone.now()), (2, True, timezone.now())):
+            buffer.add_result({"match_id": m.id, "player_id": uid, "question_id": question.id,
+                               "question_kind": "mcq", "answer": {}, "is_correct": correct,
+                               "elapsed_ms": 900, "created_at": at})
+        buffer.add_events([MatchEvent(match_id=m.id, actor_id=1, event=MatchEvent.Kind.ANSWER,
+                                      created_at=timezone.now())])
+        pending = sorted(buffer.pending_results(m.id), key=lambda row: row["player_id"])
+        self.assertEqual([(row["is_correct"], row["created_at"]) for row in pending],
+                         [(True, first), (True, pending[1]["created_at"])])  # a resubmit keeps the first time
+        self.assertEqual((len(buffer.pending_events(m.id)), buffer.pending_results(0)), (1, []))
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(buffer.flush_now(), (2, 1))
+        writes = [q["sql"] for q in ctx.captured_queries if not q["sql"].startswith(("SAVEPOINT", "RELEASE"))]
+        self.assertEqual(len(writes), 2)  # the results statement and the events bulk insert
+        m.refresh_from_db()
+        self.assertEqual((m.p1_score, m.p2_score, len(buffer)), (1, 1, 0))
+        self.assertEqual(buffer.flush_now(), (0, 0))
+
+    def test_failed_flush_is_requeued(self):
+        buffer = WriteBehindBuffer(max_delay=3600)
+        buffer.add_events([MatchEvent(match_id=1, event=MatchEvent.Kind.ANSWER, created_at=timezone.now())])
+        with mock.patch("game.writebehind.MatchEvent.objects.bulk_create", side_effect=RuntimeError), \
+                self.assertLogs("game.writebehind", "ERROR"):
+            self.assertEqual(buffer.flush_now(), (0, 0))
+        self.assertEqual(len(buffer.pending_events(1)), 1)
@@ -2,8 +2,8 @@ from django.urls import path
 from .views import (
     QueueJoinView, QueueCheckView, QueueLeaveView,
     MatchStateView, MatchReadyView, MatchQuestionView, MatchNextQuestionView,
-    MatchSubmitAnswerView, MatchFinishView, MatchResultsView,
-    LeaderboardView,
+    MatchSubmitAnswerView, MatchFinishView, MatchResultsView, MatchReplayView,
+    LeaderboardView, LeaderboardRankView,
 )
 
 urlpatterns = [
@@ -17,5 +17,7 @@ urlpatterns = [
     path("match/<int:match_id>/submit/", MatchSubmitAnswerView.as_view()),
     path("match/<int:match_id>/finish/", MatchFinishView.as_view()),
     path("match/<int:match_id>/results/", MatchResultsView.as_view()),
+    path("match/<int:match_id>/replay/", MatchReplayView.as_view()),
     path("leaderboard/", LeaderboardView.as_view()),
+    path("leaderboard/rank/", LeaderboardRankView.as_view()),
 ]
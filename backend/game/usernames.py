@@ -0,0 +1,74 @@
+# game/usernames.py
+"""
+Per-process username cache for match payloads.
+
+Usernames never change once an account exists, so lookups are cached in a
+bounded LRU. Every entry, found or not, expires after the TTL: that bounds
+how long a miss (an id with no user row yet) or a deleted account is
+remembered, at the cost of refetching live names that often. Misses are
+fetched for several ids at once, in one query.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+import threading
+import time
+from typing import Iterable
+
+try:
+    from authapp.models import Users  # optional, for usernames
+except Exception:
+    Users = None
+
+MAX_ENTRIES = 10_000
+TTL_SECONDS = 600.0
+
+
+class UsernameCache:
+    def __init__(self, max_entries: int = MAX_ENTRIES, ttl: float = TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[float, str | None]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, user_ids: Iterable[int]) -> dict[int, str | None]:
+        """Username (or None if there is no such user) for each id."""
+        found: dict[int, str | None] = {}
+        missing: list[int] = []
+        now = time.monotonic()
+        with self._lock:
+            for uid in user_ids:
+                entry = self._entries.get(uid)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(uid)
+                    found[uid] = entry[1]
+                elif uid not in found:
+                    missing.append(uid)
+        if missing:
+            fetched = dict(Users.objects.filter(user_id__in=missing).values_list("user_id", "username"))
+            expires = time.monotonic() + self.ttl
+            with self._lock:
+                for uid in missing:
+                    found[uid] = fetched.get(uid)
+                    self._entries[uid] = (expires, found[uid])
+                    self._entries.move_to_end(uid)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return found
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = UsernameCache()
+
+
+def resolve_usernames(user_ids: Iterable[int]) -> dict[int, str | None]:
+    if not Users:
+        return {}
+    return _cache.get_many(user_ids)
+
+
+def username(uid: int, fallback: str) -> str:
+    return resolve_usernames([uid]).get(uid) or fallback
@@ -2,12 +2,11 @@
 from __future__ import annotations
 
 from datetime import timedelta
-import threading
 import logging
 
-from django.db import transaction, IntegrityError
-from django.db.models import Q, F
-from django.db.models.functions import Random
+from django.db import connection, transaction
+from django.db.models import Q, Subquery
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 
@@ -15,231 +14,110 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-from .models import Match, Question, MCQ, Coding, GameResult, EloRating
-
-try:
-    from authapp.models import Users  # optional, for usernames
-except Exception:
-    Users = None
+from .answers import record_answer
+from .judge import judge
+from .leaderboard import rank_index
+from .lifecycle import match_state, publish, ensure_question_assigned, finalize_scores, finish_matches
+from .matchmaking import get_queue, pair_tick
+from . import writebehind
+from .models import Match, Question, GameResult, EloRating, MatchEvent
+from .questions import question_payload
+from .state_cache import cached_match
+from .usernames import username, resolve_usernames
 
 logger = logging.getLogger(__name__)
 
-# ---- DEMO-ONLY in-memory queue (single process)
-_queue: list[int] = []
-_queue_lock = threading.Lock()
-
-
 def _no_store(resp: Response) -> Response:
     resp["Cache-Control"] = "no-store, no-cache, must-revalidate"
     resp["Pragma"] = "no-cache"
     return resp
 
 
-def _username(uid: int, fallback: str) -> str:
-    if not Users:
-        return fallback
-    u = Users.objects.filter(user_id=uid).first()
-    return u.username if u else fallback
+def _advance_cursor(m: Match, user_id: int) -> int | None:
+    """
+    Move this player to the next question of the match's deck and return its
+    id, or None at the end of the deck. A single UPDATE ... RETURNING on the
+    player's own cursor: no transaction or row lock held across queries.
+    """
+    deck = m.question_ids or []
+    field = "p1_cursor" if m.player1_id == user_id else "p2_cursor"
+    with connection.cursor() as cur:
+        cur.execute(
+            f'UPDATE "{Match._meta.db_table}" SET {field} = {field} + 1 '
+            f"WHERE id = %s AND {field} + 1 < %s RETURNING {field}",
+            [m.id, len(deck)],
+        )
+        row = cur.fetchone()
+    return deck[row[0]] if row else None
 
 
-def _pick_first_question(kind: str) -> Question | None:
-    kind = (kind or "mcq").lower()
-    qs = Question.objects.filter(question_kind=kind)
-    return qs.order_by(Random()).first() if qs.exists() else None
+def _elo_of(uid: int) -> int:
+    elo = EloRating.objects.filter(user_id=uid).values_list("elo", flat=True).first()
+    return elo if elo is not None else 1000
 
 
-def _ensure_question_assigned(m: Match, kind: str | None = None) -> bool:
-    """
-    Ensure match has at least one question in question_ids.
-    Returns True if we assigned one now.
-    """
-    if (m.question_ids or []):
-        return False
-    k = (kind or m.kind or "mcq").lower()
-    q = _pick_first_question(k)
-    if not q:
-        logger.warning("No questions available for kind=%s; match=%s", k, m.id)
-        return False
-    m.question_ids = [q.id]
-    m.save(update_fields=["question_ids"])
-    logger.info("Assigned question %s to match %s", q.id, m.id)
-    return True
-
-
-def _append_next_question(m: Match) -> Question | None:
-    """
-    Atomically pick a new random question of the match kind that is NOT already in
-    m.question_ids, append it, and return the Question (or None if none left).
-    """
-    with transaction.atomic():
-        m = Match.objects.select_for_update().get(id=m.id)
-        used = list(m.question_ids or [])
-        qs = (
-            Question.objects
-            .filter(question_kind=m.kind)
-            .exclude(id__in=used)
-            .order_by(Random())
-            .only("id", "title", "descriptor", "question_kind")
-        )
-        q = qs.first()
-        if not q:
-            return None
-        if q.id not in used:
-            used.append(q.id)
-            m.question_ids = used
-            m.save(update_fields=["question_ids"])
-        return q
-
-
-def _finalize_scores(match: Match) -> None:
-    """Compute p1/p2 scores from game_results and store on Match."""
-    p1 = GameResult.objects.filter(match_id=match.id, player_id=match.player1_id, is_correct=True).count()
-    p2 = GameResult.objects.filter(match_id=match.id, player_id=match.player2_id, is_correct=True).count()
-    if match.p1_score != p1 or match.p2_score != p2 or match.status != "finished":
-        match.p1_score = p1
-        match.p2_score = p2
-        match.status = "finished"
-        match.save(update_fields=["p1_score", "p2_score", "status"])
-        logger.info("Match %s finalized: p1_score=%s p2_score=%s", match.id, p1, p2)
-
-
-def _ensure_unanswered_rows(match: Match) -> None:
-    """
-    For every question in match.question_ids, ensure both players have a row.
-    If missing, insert a 'timeout' incorrect row so game_results reflects the game.
-    """
-    qids = (match.question_ids or [])[:]
-    if not qids:
-        logger.info("Match %s has no questions; no unanswered rows to insert", match.id)
-        return
-    for pid in (match.player1_id, match.player2_id):
-        existing = set(
-            GameResult.objects.filter(match_id=match.id, player_id=pid)
-            .values_list("question_id", flat=True)
-        )
-        missing = [qid for qid in qids if qid not in existing]
-        for qid in missing:
-            q = Question.objects.filter(id=qid).only("id", "question_kind").first()
-            if not q:
-                continue
-            try:
-                GameResult.objects.create(
-                    match=match,
-                    player_id=pid,
-                    question=q,
-                    question_kind=q.question_kind,
-                    answer={"timeout": True},
-                    is_correct=False,
-                    elapsed_ms=None,
-                    created_at=timezone.now(),  # managed=False: set explicitly
-                )
-                logger.info("Inserted timeout row: match=%s player=%s q=%s", match.id, pid, qid)
-            except IntegrityError:
-                pass
-            except Exception as e:
-                logger.exception("Failed inserting timeout row for match=%s player=%s q=%s: %s",
-                                 match.id, pid, qid, e)
-
-
-def _state(m: Match, user_id: int | None = None) -> dict:
-    now = timezone.now()
-    countdown_seconds: int | None = None
-    if m.begin_at:
-        delta = (m.begin_at - now).total_seconds()
-        countdown_seconds = int(delta) if delta > 0 else 0
-
-    you_ready = None
-    opponent_ready = None
-    if user_id is not None:
-        if m.player1_id == user_id:
-            you_ready, opponent_ready = m.p1_ready, m.p2_ready
-        elif m.player2_id == user_id:
-            you_ready, opponent_ready = m.p2_ready, m.p1_ready
+def _active_match_for(user_id: int) -> Match | None:
+    return Match.objects.only(
+        "id", "player1_id", "player2_id", "status", "created_at", "kind",
+        "p1_ready", "p2_ready", "begin_at", "question_ids"
+    ).filter(
+        Q(player1_id=user_id) | Q(player2_id=user_id),
+        status__in=["pending", "active"],
+    ).order_by("-created_at").first()
+
 
+def _matched_payload(m: Match, user_id: int) -> dict:
+    opp = m.player2_id if m.player1_id == user_id else m.player1_id
     return {
-        "id": m.id,
-        "status": m.status,
+        "status": "matched",
+        "match_id": m.id,
+        "opponent_id": opp,
+        "opponent_username": username(opp, "Opponent"),
         "kind": m.kind,
-        "player1_id": m.player1_id,
-        "player2_id": m.player2_id,
-        "player1_username": _username(m.player1_id, "Player1"),
-        "player2_username": _username(m.player2_id, "Player2"),
-        "p1_ready": m.p1_ready,
-        "p2_ready": m.p2_ready,
-        "you_ready": you_ready,
-        "opponent_ready": opponent_ready,
-        "countdown_started_at": m.countdown_started_at.isoformat() if m.countdown_started_at else None,
-        "begin_at": m.begin_at.isoformat() if m.begin_at else None,
-        "countdown_seconds": countdown_seconds,
-        "time_left_seconds": m.time_left_seconds() if hasattr(m, "time_left_seconds") else None,
         "question_id": m.first_question_id,
-        "p1_score": m.p1_score,
-        "p2_score": m.p2_score,
-        "now": now.isoformat(),
     }
 
 
+def _pair_in_request(user_id: int) -> Match | None:
+    """
+    With MATCHMAKING["PAIR_IN_REQUEST"] (development, no `run_matchmaker`
+    process), run the pairing tick here and return the match it made for
+    user_id, if any.
+    """
+    if not settings.MATCHMAKING["PAIR_IN_REQUEST"]:
+        return None
+    for m in pair_tick():
+        if user_id in (m.player1_id, m.player2_id):
+            return m
+    return None
+
+
 class QueueJoinView(APIView):
+    """
+    POST /api/queue/join/
+    Body: { user_id: int, kind: "mcq"|"coding", difficulty?: "easy"|"medium"|"hard" }
+    Players only meet others queued for the same kind (and difficulty).
+    """
     def post(self, request):
         user_id = request.data.get("user_id")
         kind = (request.data.get("kind") or "mcq").lower()
+        difficulty = (request.data.get("difficulty") or "").lower() or None
         if not user_id:
             return _no_store(Response({"error": "user_id required"}, status=400))
+        if kind not in Question.Kind.values:
+            return _no_store(Response({"error": f"unknown kind '{kind}'"}, status=400))
+        if difficulty and difficulty not in Question.Difficulty.values:
+            return _no_store(Response({"error": f"unknown difficulty '{difficulty}'"}, status=400))
         user_id = int(user_id)
 
-        existing = Match.objects.only(
-            "id", "player1_id", "player2_id", "status", "created_at", "kind",
-            "p1_ready", "p2_ready", "begin_at"
-        ).filter(
-            Q(player1_id=user_id) | Q(player2_id=user_id),
-            status__in=["pending", "active"],
-        ).order_by("-created_at").first()
-
+        existing = _active_match_for(user_id)
         if existing:
-            opp = existing.player2_id if existing.player1_id == user_id else existing.player1_id
-            return _no_store(Response({
-                "status": "matched",
-                "match_id": existing.id,
-                "opponent_id": opp,
-                "opponent_username": _username(opp, "Opponent"),
-                "kind": existing.kind,
-                "question_id": existing.first_question_id,
-            }))
-
-        with _queue_lock:
-            if user_id in _queue:
-                return _no_store(Response({"status": "queued"}))
-            _queue.append(user_id)
-
-            if len(_queue) >= 2:
-                a = _queue.pop(0)
-                b = _queue.pop(0)
-                q = _pick_first_question(kind)
-                question_ids = [q.id] if q else []
-                m = Match.objects.create(
-                    player1_id=a,
-                    player2_id=b,
-                    kind=kind,
-                    status="pending",
-                    p1_ready=False,
-                    p2_ready=False,
-                    countdown_started_at=None,
-                    begin_at=None,
-                    question_ids=question_ids,
-                )
-                logger.info("Match %s created: players=%s vs %s kind=%s qids=%s", m.id, a, b, kind, question_ids)
-
-                payload = {
-                    "status": "matched",
-                    "match_id": m.id,
-                    "kind": m.kind,
-                    "question_id": m.first_question_id,
-                }
-                if user_id == a:
-                    payload.update({"opponent_id": b, "opponent_username": _username(b, "PlayerB")})
-                else:
-                    payload.update({"opponent_id": a, "opponent_username": _username(a, "PlayerA")})
-                return _no_store(Response(payload))
+            return _no_store(Response(_matched_payload(existing, user_id)))
+
+        if get_queue().join(user_id, _elo_of(user_id), kind, difficulty):
+            m = _pair_in_request(user_id)
+            if m:
+                return _no_store(Response(_matched_payload(m, user_id)))
 
         return _no_store(Response({"status": "queued"}))
 
@@ -251,26 +129,18 @@ class QueueCheckView(APIView):
             return _no_store(Response({"error": "user_id required"}, status=400))
         user_id = int(user_id)
 
-        m = Match.objects.only(
-            "id", "player1_id", "player2_id", "status", "created_at", "kind",
-            "p1_ready", "p2_ready", "begin_at"
-        ).filter(
-            Q(player1_id=user_id) | Q(player2_id=user_id),
-            status__in=["pending", "active"],
-        ).order_by("-created_at").first()
+        m = _active_match_for(user_id)
+        if not m:
+            if not get_queue().touch(user_id):
+                # Swept for missed heartbeats (or never joined): the client joins again.
+                return _no_store(Response({"status": "not_queued"}))
+            # Still queued (and now heartbeated). ELO windows widen while we
+            # wait, so a retry can pair us now.
+            m = _pair_in_request(user_id)
 
         if not m:
             return _no_store(Response({"status": "waiting"}))
-
-        opp = m.player2_id if m.player1_id == user_id else m.player1_id
-        return _no_store(Response({
-            "status": "matched",
-            "match_id": m.id,
-            "opponent_id": opp,
-            "opponent_username": _username(opp, "Opponent"),
-            "kind": m.kind,
-            "question_id": m.first_question_id,
-        }))
+        return _no_store(Response(_matched_payload(m, user_id)))
 
 
 class QueueLeaveView(APIView):
@@ -280,32 +150,46 @@ class QueueLeaveView(APIView):
             return _no_store(Response({"error": "user_id required"}, status=400))
         user_id = int(user_id)
 
-        with _queue_lock:
-            if user_id in _queue:
-                _queue.remove(user_id)
-                return _no_store(Response({"removed": True}))
-        return _no_store(Response({"removed": False}))
+        return _no_store(Response({"removed": get_queue().leave(user_id)}))
 
 
 class MatchStateView(APIView):
+    """
+    GET /api/match/<match_id>/state/?user_id=&since_version=
+
+    Pure read: activation and expiry are written by the match clock
+    (run_match_clock); status here is Match.effective_status().
+
+    The row comes from the per-process state cache (state_cache.cached_match),
+    so steady-state polls don't query the database at all.
+    Clients that are up to date get a short answer:
+      * If-None-Match with the last ETag -> 304
+      * ?since_version=<state_version>   -> {"state_version": n, "unchanged": true}
+    The clock fields (countdown_seconds, time_left_seconds, now) are derived
+    from begin_at and are not part of the version; clients tick them locally.
+    """
     def get(self, request, match_id: int):
         user_id = request.GET.get("user_id")
         user_id = int(user_id) if user_id else None
-        m = get_object_or_404(Match, id=match_id)
-
-        changed = m.maybe_promote_to_active()
-        if changed:
-            logger.info("Match %s promoted to active", m.id)
-            _ensure_question_assigned(m)
-
-        # If the minute expired, finish + fill unanswered + finalize scores.
-        if m.maybe_finish_if_expired():
-            logger.info("Match %s expired; finalizing", m.id)
-            _ensure_question_assigned(m)
-            _ensure_unanswered_rows(m)
-            _finalize_scores(m)
-
-        return _no_store(Response(_state(m, user_id)))
+        since = request.GET.get("since_version")
+
+        m = cached_match(match_id)
+        if m is None:
+            return _no_store(Response({"detail": "Not found."}, status=404))
+        status_now = m.effective_status()
+        # Version alone misses a pending->active/finished flip the clock hasn't written yet.
+        etag = f'W/"{match_id}.{m.state_version}.{status_now}.{user_id or 0}"'
+        current = status_now == m.status and since is not None and since == str(m.state_version)
+
+        if request.headers.get("If-None-Match") == etag:
+            resp = Response(status=304)
+        elif current:
+            resp = Response({"state_version": m.state_version, "unchanged": True})
+        else:
+            resp = Response(match_state(m, user_id))
+        resp = _no_store(resp)
+        resp["ETag"] = etag
+        return resp
 
 
 class MatchReadyView(APIView):
@@ -329,19 +213,29 @@ class MatchReadyView(APIView):
             if m.player2_id == user_id and m.p2_ready != ready:
                 m.p2_ready = ready; fields.append("p2_ready")
 
+            now = timezone.now()
             if m.both_ready() and not m.begin_at:
-                now = timezone.now()
                 m.countdown_started_at = now
                 m.begin_at = now + timedelta(seconds=3)
                 fields += ["countdown_started_at", "begin_at"]
 
             if fields:
-                m.save(update_fields=fields)
+                m.state_version += 1  # row is locked
+                m.save(update_fields=[*fields, "state_version"])
                 logger.info("Match %s ready update by user %s -> p1=%s p2=%s",
                             m.id, user_id, m.p1_ready, m.p2_ready)
+                events = []
+                if "p1_ready" in fields or "p2_ready" in fields:
+                    events.append(MatchEvent(match_id=m.id, actor_id=user_id, event=MatchEvent.Kind.READY,
+                                             created_at=now, payload={"ready": ready}))
+                if "begin_at" in fields:
+                    events.append(MatchEvent(match_id=m.id, event=MatchEvent.Kind.COUNTDOWN,
+                                             created_at=now, payload={"begin_at": m.begin_at.isoformat()}))
+                writebehind.add_events(events)
 
-        m.maybe_promote_to_active()
-        return _no_store(Response(_state(m, user_id)))
+        if fields:
+            publish(m)
+        return _no_store(Response(match_state(m, user_id)))
 
 
 class MatchQuestionView(APIView):
@@ -350,41 +244,22 @@ class MatchQuestionView(APIView):
 
         # Assign on-demand if missing
         if not m.first_question_id:
-            _ensure_question_assigned(m)
+            ensure_question_assigned(m)
         qid = m.first_question_id
         if not qid:
             return _no_store(Response({"error": "no question available"}, status=503))
 
-        q = get_object_or_404(Question, id=qid)
-
-        data = {
-            "id": q.id,
-            "title": q.title,
-            "descriptor": q.descriptor,
-            "kind": q.question_kind,
-        }
-
-        if q.question_kind == "mcq":
-            try:
-                data["choices"] = q.mcq.choices
-            except MCQ.DoesNotExist:
-                data["choices"] = []
-        else:
-            try:
-                data["prompt"] = q.coding.prompt
-                data["template_code"] = q.coding.template_code
-            except Coding.DoesNotExist:
-                data["prompt"] = ""
-                data["template_code"] = ""
-
-        return _no_store(Response(data))
+        payload = question_payload(qid)
+        if payload is None:
+            return _no_store(Response({"detail": "Not found."}, status=404))
+        return _no_store(Response(payload.client_data()))
 
 
 class MatchNextQuestionView(APIView):
     """
     POST /api/match/<match_id>/next-question
     Body: { user_id: int }
-    Returns next random question for this match (no repeats).
+    Returns the player's next question from the match's deck (no repeats).
     """
     def post(self, request, match_id: int):
         user_id = request.data.get("user_id")
@@ -397,192 +272,194 @@ class MatchNextQuestionView(APIView):
         if user_id not in (m.player1_id, m.player2_id):
             return _no_store(Response({"error": "not a participant"}, status=403))
 
-        m.maybe_promote_to_active()
-        if m.status != "active":
-            return _no_store(Response({"error": "match not active"}, status=409))
-        if hasattr(m, "time_left_seconds") and m.time_left_seconds() is not None and m.time_left_seconds() <= 0:
+        effective = m.effective_status()
+        if effective == "finished" and m.status != "finished":
             return _no_store(Response({"error": "time expired"}, status=409))
+        if effective != "active":
+            return _no_store(Response({"error": "match not active"}, status=409))
 
-        if not m.first_question_id:
-            _ensure_question_assigned(m)
-            q = Question.objects.only("id", "title", "descriptor", "question_kind").get(id=m.first_question_id)
-        else:
-            q = _append_next_question(m)
+        # The first question comes from /question/; this walks the rest of the deck.
+        ensure_question_assigned(m)
+        qid = _advance_cursor(m, user_id)
 
-        if not q:
+        payload = question_payload(qid) if qid else None
+        if not payload:
             return _no_store(Response({"no_more_questions": True}, status=200))
-
-        data = {
-            "id": q.id,
-            "title": q.title,
-            "descriptor": q.descriptor,
-            "kind": q.question_kind,
-        }
-        if q.question_kind == "mcq":
-            try:
-                data["choices"] = q.mcq.choices
-            except MCQ.DoesNotExist:
-                data["choices"] = []
-        else:
-            try:
-                data["prompt"] = q.coding.prompt
-                data["template_code"] = q.coding.template_code
-            except Coding.DoesNotExist:
-                data["prompt"] = ""
-                data["template_code"] = ""
-        return _no_store(Response(data, status=200))
+        return _no_store(Response(payload.client_data(), status=200))
 
 
 class MatchSubmitAnswerView(APIView):
+    """
+    POST {"user_id", "question_id", "answer_index"} for an MCQ question, or
+    {"user_id", "question_id", "code"} for a coding one: judged in a sandbox
+    (game/judge.py), correct when every test case passes.
+    """
     def post(self, request, match_id: int):
         user_id = request.data.get("user_id")
         question_id = request.data.get("question_id")
         answer_index = request.data.get("answer_index")
+        code = request.data.get("code")
         elapsed_ms = request.data.get("elapsed_ms")
 
-        if user_id is None or question_id is None or answer_index is None:
-            return _no_store(Response({"error": "user_id, question_id, answer_index required"}, status=400))
+        if user_id is None or question_id is None or (answer_index is None and code is None):
+            return _no_store(Response({"error": "user_id, question_id, answer_index (or code) required"}, status=400))
 
         user_id = int(user_id)
         question_id = int(question_id)
-        answer_index = int(answer_index)
         elapsed_ms = int(elapsed_ms) if elapsed_ms is not None else None
 
         m = get_object_or_404(Match, id=match_id)
         if user_id not in (m.player1_id, m.player2_id):
             return _no_store(Response({"error": "not a participant"}, status=403))
 
-        # If match time is over, finish and block further answers.
-        if m.maybe_finish_if_expired() or m.status == "finished":
+        # Block answers once the match is over (the clock finalizes it).
+        if m.effective_status() == "finished":
             logger.info("Reject submit: match %s finished", m.id)
             return _no_store(Response({"error": "match finished"}, status=409))
 
-        q = get_object_or_404(Question, id=question_id)
-        if q.question_kind != "mcq":
-            return _no_store(Response({"error": "only mcq supported here"}, status=400))
-
-        try:
-            mcq = q.mcq
-        except MCQ.DoesNotExist:
-            return _no_store(Response({"error": "mcq not found"}, status=404))
-
-        correct = (answer_index == mcq.answer_index)
+        q = question_payload(question_id)
+        if q is None:
+            return _no_store(Response({"detail": "Not found."}, status=404))
+
+        # Only questions this player has been dealt so far can be answered.
+        if question_id not in m.served_question_ids(user_id):
+            return _no_store(Response({"error": "question not dealt to this player"}, status=400))
+
+        extra = {}
+        if q.kind == "mcq":
+            if answer_index is None:
+                return _no_store(Response({"error": "answer_index required"}, status=400))
+            if q.answer_index is None:
+                return _no_store(Response({"error": "mcq not found"}, status=404))
+            answer_index = int(answer_index)
+            correct = (answer_index == q.answer_index)
+            answer = {"answer_index": answer_index}
+        else:
+            if not isinstance(code, str):
+                return _no_store(Response({"error": "code required"}, status=400))
+            if len(code.encode()) > settings.JUDGE["MAX_CODE_BYTES"]:
+                return _no_store(Response({"error": "code too long"}, status=400))
+            if q.coding is None or not q.coding.test_cases:
+                return _no_store(Response({"error": "coding tests not found"}, status=404))
+            result = judge(code, list(q.coding.test_cases), q.coding.time_threshold, q.coding.space_threshold,
+                           key=q.coding.key, stop_on_failure=q.coding.stop_on_failure)
+            correct = result.passed
+            answer = {
+                "code": code,
+                "verdict": result.verdict,
+                "time_ms": result.time_ms,
+                "memory_mb": result.memory_mb,
+                "tests": [c.as_json() for c in result.cases],  # {"verdict", "ms", "kb"} per test case
+            }
+            extra = {"verdict": result.verdict, "tests": answer["tests"], "error": result.error}
+            # Judging takes a while; the clock may have run out meanwhile.
+            if m.effective_status() == "finished":
+                logger.info("Reject submit: match %s finished while judging", m.id)
+                return _no_store(Response({"error": "match finished"}, status=409))
 
         logger.info("Submit: match=%s user=%s q=%s ans=%s correct=%s elapsed_ms=%s",
-                    m.id, user_id, question_id, answer_index, correct, elapsed_ms)
-
-        # Ensure the used-list includes this q
-        if question_id not in (m.question_ids or []):
-            with transaction.atomic():
-                m = Match.objects.select_for_update().get(id=m.id)
-                used = list(m.question_ids or [])
-                if question_id not in used:
-                    used.append(question_id)
-                    m.question_ids = used
-                    m.save(update_fields=["question_ids"])
-
-        # Insert/update result, preserving created_at on updates
+                    m.id, user_id, question_id, answer.get("answer_index", answer.get("verdict")),
+                    correct, elapsed_ms)
+
+        # One statement: upsert the result row and apply the rating and score
+        # changes (or queue all of it, with write-behind on).
+        record = writebehind.queue_answer if writebehind.enabled() else record_answer
         try:
-            with transaction.atomic():
-                obj, created = GameResult.objects.get_or_create(
-                    match=m,
-                    player_id=user_id,
-                    question=q,
-                    defaults={
-                        "question_kind": q.question_kind,
-                        "answer": {"answer_index": answer_index},
-                        "is_correct": bool(correct),
-                        "elapsed_ms": elapsed_ms,
-                        "created_at": timezone.now(),  # guarantees NOT NULL
-                    },
-                )
-                if not created:
-                    GameResult.objects.filter(pk=obj.pk).update(
-                        question_kind=q.question_kind,
-                        answer={"answer_index": answer_index},
-                        is_correct=bool(correct),
-                        elapsed_ms=elapsed_ms,
-                    )
-        except IntegrityError as e:
-            logger.warning("IntegrityError writing game_results (match=%s user=%s q=%s): %s",
-                           m.id, user_id, question_id, e)
+            outcome = record(m.id, user_id, question_id, q.kind, answer, correct, elapsed_ms)
+            if not outcome.match_finished:
+                writebehind.add_event(m.id, MatchEvent.Kind.ANSWER, user_id,
+                                      {"question_id": question_id, "correct": correct, "elapsed_ms": elapsed_ms})
         except Exception as e:
             logger.exception("Unexpected error writing game_results: %s", e)
             return _no_store(Response({"error": "write failed"}, status=500))
-
-        # ---- ELO bump stored in elo_ratings (not Users)
-        elo_delta = 10 if correct else 0
-        new_elo = None
-        try:
-            rating, _ = EloRating.objects.get_or_create(user_id=user_id, defaults={"elo": 1000})
-            if elo_delta:
-                EloRating.objects.filter(pk=rating.pk).update(elo=F("elo") + elo_delta)
-                rating.refresh_from_db(fields=["elo"])
-            new_elo = rating.elo
-        except Exception:
-            pass
-
-        # If the 60s window just expired, finish the match now: fill unanswered + finalize scores.
-        if m.maybe_finish_if_expired():
-            _ensure_question_assigned(m)
-            _ensure_unanswered_rows(m)
-            _finalize_scores(m)
+        if outcome.match_finished:
+            logger.info("Reject submit: match %s was finished before the answer was recorded", m.id)
+            return _no_store(Response({"error": "match finished"}, status=409))
+        if outcome.match is not None:
+            publish(outcome.match, notified=True)  # live score
 
         return _no_store(Response({
             "correct": correct,
-            "elo_delta": elo_delta,
-            "new_elo": new_elo,
-            "time_left_seconds": m.time_left_seconds() if hasattr(m, "time_left_seconds") else None,
+            # Ratings move once per match, when it finishes (game/rating.py).
+            "elo_delta": 0,
+            "new_elo": None,
+            "time_left_seconds": m.time_left_seconds(),
+            **extra,
         }, status=status.HTTP_200_OK))
 
 
 class MatchFinishView(APIView):
     """
-    Force finish — idempotent. Ensures unanswered rows exist, then finalizes scores.
+    POST {"user_id"} — a player's client saying the time is up. Idempotent.
+
+    Only finishes (and rates) a match whose clock has run out, the same way
+    the match clock does (lifecycle.finish_matches), so it just saves waiting
+    for the next tick; earlier it answers 409. A match finished before but
+    not rated yet gets rated.
     """
     def post(self, request, match_id: int):
-        m = get_object_or_404(Match, id=match_id)
+        user_id = request.data.get("user_id")
+        if user_id is None:
+            return _no_store(Response({"error": "user_id required"}, status=400))
+        user_id = int(user_id)
 
-        _ensure_question_assigned(m)
-        m.maybe_promote_to_active()
-        m.maybe_finish_if_expired()
+        m = get_object_or_404(Match, id=match_id)
+        if user_id not in (m.player1_id, m.player2_id):
+            return _no_store(Response({"error": "not a participant"}, status=403))
 
-        _ensure_unanswered_rows(m)
-        _finalize_scores(m)
+        if m.status != "finished":
+            writebehind.flush_now()
+            finished = finish_matches([m.id], source="finish")
+            if finished:
+                m = finished[0]
+            else:
+                # Not over yet (or locked by the clock finishing it right now).
+                m.refresh_from_db()
+                if m.status != "finished":
+                    return _no_store(Response({"error": "match not over"}, status=409))
+        if not m.rated:
+            finalize_scores(m)
+            publish(m)
 
-        return _no_store(Response(_state(m)))
+        return _no_store(Response(match_state(m)))
 
 
 class MatchResultsView(APIView):
     def get(self, request, match_id: int):
         m = get_object_or_404(Match, id=match_id)
 
-        # Ensure we’re finished (and scores reflect rows)
-        if m.maybe_finish_if_expired():
-            _ensure_question_assigned(m)
-            _ensure_unanswered_rows(m)
-            _finalize_scores(m)
+        pending = writebehind.pending_results(m.id)
 
         def _rows(pid: int):
-            rows = (GameResult.objects
-                    .filter(match_id=m.id, player_id=pid)
-                    .order_by("created_at")
-                    .values("question_id", "question_kind", "answer", "is_correct", "elapsed_ms", "created_at"))
-            return list(rows)
-
+            rows = {
+                r["question_id"]: r for r in
+                GameResult.objects
+                .filter(match_id=m.id, player_id=pid)
+                .values("question_id", "question_kind", "answer", "is_correct", "elapsed_ms", "created_at")
+            }
+            # Read-your-writes: answers still queued in this worker's write-behind buffer.
+            for row in pending:
+                if row["player_id"] == pid:
+                    created = rows.get(row["question_id"], row)["created_at"]
+                    rows[row["question_id"]] = {
+                        k: row[k] for k in ("question_id", "question_kind", "answer", "is_correct", "elapsed_ms")
+                    } | {"created_at": created}
+            return sorted(rows.values(), key=lambda r: r["created_at"])
+
+        names = resolve_usernames([m.player1_id, m.player2_id])
         data = {
             "match_id": m.id,
             "status": m.status,
             "kind": m.kind,
             "p1": {
                 "player_id": m.player1_id,
-                "username": _username(m.player1_id, "Player1"),
+                "username": names.get(m.player1_id) or "Player1",
                 "score": m.p1_score,
                 "answers": _rows(m.player1_id),
             },
             "p2": {
                 "player_id": m.player2_id,
-                "username": _username(m.player2_id, "Player2"),
+                "username": names.get(m.player2_id) or "Player2",
                 "score": m.p2_score,
                 "answers": _rows(m.player2_id),
             },
@@ -590,39 +467,131 @@ class MatchResultsView(APIView):
         return _no_store(Response(data))
 
 
-class LeaderboardView(APIView):
+class MatchReplayView(APIView):
     """
-    GET /api/leaderboard/?limit=50&offset=0
-    Returns top players by ELO with usernames.
+    GET /api/match/<id>/replay/?limit=100&after=<event id>
+    The match's event log (matched, ready, countdown, activated, answers,
+    finished) in the order things happened. Keyset-paginated on
+    (created_at, id): pass `next` back as `after` for the following page.
     """
-    def get(self, request):
-        limit = int(request.GET.get("limit", 50))
-        offset = int(request.GET.get("offset", 0))
+    MAX_LIMIT = 500
 
+    def get(self, request, match_id: int):
+        try:
+            limit = max(1, min(_int_param(request, "limit", 100), self.MAX_LIMIT))
+            after = _int_param(request, "after")
+        except ValueError:
+            return _no_store(Response({"error": "limit and after must be integers"}, status=400))
+        if cached_match(match_id) is None:
+            return _no_store(Response({"detail": "Not found."}, status=404))
+
+        writebehind.flush_now()  # so this worker's queued events have ids
+        events = MatchEvent.objects.filter(match_id=match_id)
+        if after is not None:
+            anchor = Subquery(MatchEvent.objects.filter(id=after, match_id=match_id).values("created_at")[:1])
+            events = events.filter(Q(created_at__gt=anchor) | Q(created_at=anchor, id__gt=after))
         rows = list(
-            EloRating.objects
-            .order_by("-elo", "user_id")
-            .values("user_id", "elo")[offset:offset+limit]
+            events.order_by("created_at", "id")
+            .values("id", "event", "actor_id", "payload", "created_at")[: limit + 1]
         )
+        more = len(rows) > limit
+        rows = rows[:limit]
 
-        # Resolve usernames from authapp.Users if available
-        usernames = {}
-        if Users and rows:
-            uids = [r["user_id"] for r in rows]
-            for u in Users.objects.filter(user_id__in=uids).values("user_id", "username"):
-                usernames[u["user_id"]] = u["username"]
-
-        items = []
-        for i, r in enumerate(rows, start=1+offset):
-            items.append({
-                "rank": i,
-                "user_id": r["user_id"],
-                "username": usernames.get(r["user_id"], f"user{r['user_id']}"),
-                "elo": r["elo"],
-            })
+        usernames = resolve_usernames({r["actor_id"] for r in rows if r["actor_id"] is not None})
+        return _no_store(Response({
+            "match_id": match_id,
+            "count": len(rows),
+            "events": [
+                {
+                    "id": r["id"],
+                    "event": r["event"],
+                    "actor_id": r["actor_id"],
+                    "actor_username": usernames.get(r["actor_id"]),
+                    "payload": r["payload"],
+                    "at": r["created_at"].isoformat(),
+                }
+                for r in rows
+            ],
+            "next": {"after": rows[-1]["id"]} if more else None,
+        }))
+
+
+def _int_param(request, name: str, default: int | None = None) -> int | None:
+    raw = request.GET.get(name)
+    if raw in (None, ""):
+        return default
+    return int(raw)
+
+
+def _leaderboard_items(rows: list[tuple[int, int, int]]) -> list[dict]:
+    usernames = resolve_usernames([user_id for _, user_id, _ in rows])
+    return [
+        {
+            "rank": rank,
+            "user_id": user_id,
+            "username": usernames.get(user_id) or f"user{user_id}",
+            "elo": elo,
+        }
+        for rank, user_id, elo in rows
+    ]
 
+
+class LeaderboardView(APIView):
+    """
+    GET /api/leaderboard/?limit=50&after_elo=1210&after_user_id=42
+    GET /api/leaderboard/?limit=50&offset=0
+    Returns top players by ELO with usernames and their rank. Pages come from
+    the in-memory rank index (game.leaderboard), so deep pages cost the same as
+    the first. Pass `next` back as after_elo/after_user_id to get the next page.
+    """
+    def get(self, request):
+        try:
+            limit = min(_int_param(request, "limit", 50), settings.LEADERBOARD["MAX_LIMIT"])
+            offset = _int_param(request, "offset", 0)
+            after_elo = _int_param(request, "after_elo")
+            after_user_id = _int_param(request, "after_user_id")
+        except ValueError:
+            return _no_store(Response({"error": "limit, offset, after_elo and after_user_id must be integers"}, status=400))
+        if (after_elo is None) != (after_user_id is None):
+            return _no_store(Response({"error": "after_elo and after_user_id go together"}, status=400))
+
+        index = rank_index()
+        if after_elo is not None:
+            offset = index.position_after(after_elo, after_user_id)
+        rows = index.page(offset + 1, max(0, limit))
+
+        last = rows[-1] if rows and rows[-1][0] < len(index) else None
         return _no_store(Response({
-            "count": len(items),
+            "count": len(rows),
             "offset": offset,
-            "items": items,
+            "total": len(index),
+            "items": _leaderboard_items(rows),
+            "next": {"after_elo": last[2], "after_user_id": last[1]} if last else None,
         }))
+
+
+class LeaderboardRankView(APIView):
+    """
+    GET /api/leaderboard/rank/?user_id=42&around=5
+    A player's rank (O(log n) from the rank index) and, with `around`, the
+    players ranked up to that many places above and below them.
+    """
+    def get(self, request):
+        try:
+            user_id = _int_param(request, "user_id")
+            around = min(_int_param(request, "around", 0), settings.LEADERBOARD["MAX_LIMIT"] // 2)
+        except ValueError:
+            return _no_store(Response({"error": "user_id and around must be integers"}, status=400))
+        if user_id is None:
+            return _no_store(Response({"error": "user_id required"}, status=400))
+
+        index = rank_index()
+        rank = index.rank(user_id)
+        if rank is None:
+            return _no_store(Response({"error": "player has no rating"}, status=404))
+
+        data = {"user_id": user_id, "elo": index.elo_of(user_id), "rank": rank, "total": len(index)}
+        if around > 0:
+            start = max(1, rank - around)
+            data["around"] = _leaderboard_items(index.page(start, rank + around - start + 1))
+        return _no_store(Response(data))
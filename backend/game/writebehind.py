@@ -0,0 +1,249 @@
+# game/writebehind.py
+"""
+Write-behind buffer for match_events and, opt-in, game_results.
+
+Match events (the append-only match log) go through it with
+WRITE_BEHIND["EVENTS"]: recording one is an append to a list, queued when
+the surrounding transaction commits. Answers are queued too with
+WRITE_BEHIND["ENABLED"] (which batches the events as well). Both are off by
+default.
+
+Queued rows live in memory per worker process and are written by a
+background thread in batches, once MAX_ROWS rows are waiting or the oldest
+has waited MAX_DELAY seconds. Each flush is at most two statements, whatever
+the batch size:
+  * results: answers.record_answers(), one INSERT ... ON CONFLICT that also
+    applies the match score changes (polls see new scores at once
+    through the state cache NOTIFY; sockets get them with the next push);
+  * events: MatchEvent.objects.bulk_create().
+
+Guarantees:
+  * Read-your-writes inside the worker: pending_results()/pending_events()
+    expose queued rows. Other workers see them within MAX_DELAY.
+  * Answers to a match may still be queued in any worker when its time is
+    up, so with ENABLED a match is only finished finish_grace() seconds
+    after its end (the clock and finish requests both wait for it). By then
+    every answer accepted before the end has been flushed, unless its
+    flush kept failing. Rows flushed after the match was finished anyway
+    are dropped (answers.record_answers() skips finished or rated
+    matches), so scores never change after ratings moved.
+  * The buffer is flushed at interpreter exit (atexit: a normal shutdown or
+    SIGTERM handled by the server). A batch that fails to write is put back
+    and retried. Rows still queued when a process is killed outright are lost.
+    That is the trade-off of enabling this.
+
+With both settings off, add_events() inserts synchronously and submits go
+through answers.record_answer().
+"""
+from __future__ import annotations
+
+import atexit
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .answers import AnswerOutcome, record_answers
+from .models import MatchEvent
+
+logger = logging.getLogger(__name__)
+
+ResultKey = tuple[int, int, int]  # (match_id, player_id, question_id)
+
+
+class WriteBehindBuffer:
+    def __init__(self, max_rows: int = 500, max_delay: float = 0.5):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self._results: dict[ResultKey, dict] = {}
+        self._events: list[MatchEvent] = []
+        self._oldest: float | None = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # one flush at a time, in order
+        self._thread: threading.Thread | None = None
+        self._pid: int | None = None
+
+    def __len__(self) -> int:
+        return len(self._results) + len(self._events)
+
+    # Producers -----------------------------------------------------------------
+
+    def add_result(self, row: dict) -> None:
+        """Queue a game_results row; a later row for the same key replaces it."""
+        key = (row["match_id"], row["player_id"], row["question_id"])
+        with self._cond:
+            pending = self._results.get(key)
+            if pending is not None:
+                row = {**row, "created_at": pending["created_at"]}  # keep the first submit's time
+            self._results[key] = row
+            self._queued()
+
+    def add_events(self, events: list[MatchEvent]) -> None:
+        with self._cond:
+            self._events.extend(events)
+            self._queued()
+
+    def _queued(self) -> None:
+        self._ensure_thread()
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+            self._cond.notify()  # start the MAX_DELAY timer
+        elif len(self) >= self.max_rows:
+            self._cond.notify()
+
+    # Read-your-writes ------------------------------------------------------------
+
+    def pending_results(self, match_id: int) -> list[dict]:
+        with self._cond:
+            return [row for key, row in self._results.items() if key[0] == match_id]
+
+    def pending_events(self, match_id: int) -> list[MatchEvent]:
+        with self._cond:
+            return [e for e in self._events if e.match_id == match_id]
+
+    # Flushing ------------------------------------------------------------------
+
+    def flush_now(self) -> tuple[int, int]:
+        """Write everything queued so far. Returns (results, events) written."""
+        with self._flush_lock:
+            with self._cond:
+                results, self._results = list(self._results.values()), {}
+                events, self._events = self._events, []
+                self._oldest = None
+            if not results and not events:
+                return 0, 0
+            try:
+                with transaction.atomic():
+                    written = record_answers(results)
+                    MatchEvent.objects.bulk_create(events, batch_size=self.max_rows)
+            except Exception:
+                logger.exception("Write-behind flush of %s results / %s events failed; requeued",
+                                 len(results), len(events))
+                self._requeue(results, events)
+                return 0, 0
+            if written < len(results):
+                logger.warning("Write-behind: dropped %s results for matches finished meanwhile",
+                               len(results) - written)
+            return written, len(events)
+
+    def _requeue(self, results: list[dict], events: list[MatchEvent]) -> None:
+        with self._cond:
+            for row in results:
+                # Newer rows queued meanwhile win.
+                self._results.setdefault((row["match_id"], row["player_id"], row["question_id"]), row)
+            self._events[:0] = events
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def _ensure_thread(self) -> None:
+        # Called with self._cond held. Re-start after fork: threads don't survive it.
+        if self._pid != os.getpid() or self._thread is None or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._due():
+                    timeout = None if self._oldest is None else max(
+                        0.0, self.max_delay - (time.monotonic() - self._oldest))
+                    self._cond.wait(timeout)
+            self.flush_now()
+            close_old_connections()
+            if self._oldest is not None:
+                time.sleep(0.05)  # a failed flush: don't spin
+
+    def _due(self) -> bool:
+        if self._oldest is None:
+            return False
+        return len(self) >= self.max_rows or time.monotonic() - self._oldest >= self.max_delay
+
+
+_buffer: WriteBehindBuffer | None = None
+_buffer_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return settings.WRITE_BEHIND["ENABLED"]
+
+
+def events_batched() -> bool:
+    return settings.WRITE_BEHIND["EVENTS"] or enabled()
+
+
+def finish_grace() -> float:
+    """
+    Seconds a match stays open past its end: an answer queued just before
+    the end waits up to MAX_DELAY, and as long again to be written.
+    """
+    return 2 * settings.WRITE_BEHIND["MAX_DELAY"] if enabled() else 0.0
+
+
+def get_buffer() -> WriteBehindBuffer:
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = WriteBehindBuffer(settings.WRITE_BEHIND["MAX_ROWS"], settings.WRITE_BEHIND["MAX_DELAY"])
+                atexit.register(_flush_at_exit)
+    return _buffer
+
+
+def _flush_at_exit() -> None:
+    if _buffer is not None and len(_buffer):
+        written = _buffer.flush_now()
+        logger.info("Write-behind: flushed %s results / %s events at exit", *written)
+
+
+def add_event(match_id: int, event: str, actor_id: int | None = None, payload: dict | None = None,
+              created_at: datetime | None = None) -> None:
+    """Record one MatchEvent (created_at defaults to now); see add_events()."""
+    add_events([MatchEvent(match_id=match_id, actor_id=actor_id, event=event, payload=payload,
+                           created_at=created_at or timezone.now())])
+
+
+def add_events(events: list[MatchEvent]) -> None:
+    """
+    Record MatchEvents (created_at defaults to when they were built). Batched: queued
+    once the current transaction commits, so rolled-back transitions leave
+    no trace. Inserted right away when events_batched() is off.
+    """
+    if not events:
+        return
+    if events_batched():
+        buffer = get_buffer()
+        transaction.on_commit(lambda: buffer.add_events(events))
+    else:
+        MatchEvent.objects.bulk_create(events)
+
+
+def queue_answer(match_id: int, player_id: int, question_id: int, question_kind: str,
+                 answer: dict, is_correct: bool, elapsed_ms: int | None) -> AnswerOutcome:
+    """Queue an answer instead of answers.record_answer(); the score moves at flush."""
+    get_buffer().add_result({
+        "match_id": match_id,
+        "player_id": player_id,
+        "question_id": question_id,
+        "question_kind": question_kind,
+        "answer": answer,
+        "is_correct": bool(is_correct),
+        "elapsed_ms": elapsed_ms,
+        "created_at": timezone.now(),
+    })
+    return AnswerOutcome()
+
+
+def pending_results(match_id: int) -> list[dict]:
+    return get_buffer().pending_results(match_id) if enabled() else []
+
+
+def flush_now() -> None:
+    """Flush this worker's queued rows (before reading a match back in full)."""
+    if _buffer is not None and len(_buffer):
+        _buffer.flush_now()
@@ -38,17 +38,32 @@ export default function MCQPage() {
   const fetchedQuestionRef = useRef(false);
   const finishedRef = useRef(false);
   const questionStartRef = useRef(null); // for elapsed_ms
+  const wsRef = useRef(null);
+  const stateRef = useRef(null);         // last known server state (merged ws deltas)
+  const clockOffsetRef = useRef(0);      // server clock - local clock, in ms
 
   const stopAllPolling = () => {
     if (statePollRef.current) { clearInterval(statePollRef.current); statePollRef.current = null; }
     if (queuePollRef.current) { clearInterval(queuePollRef.current); queuePollRef.current = null; }
+    if (wsRef.current) { wsRef.current.close(); wsRef.current = null; }
   };
 
   const finishAndFetchResults = async (mid) => {
     if (finishedRef.current) return;
     finishedRef.current = true;
     stopAllPolling();
-    try { await fetch(`${API_BASE}/api/match/${mid}/finish/`, { method: 'POST' }); } catch {}
+    // 409 until the server's clock agrees the time is up; retry a few times.
+    for (let attempt = 0; attempt < 5; attempt++) {
+      try {
+        const r = await fetch(`${API_BASE}/api/match/${mid}/finish/`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ user_id: userId }),
+        });
+        if (r.status !== 409) break;
+      } catch { break; }
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
     try {
       const r = await fetch(`${API_BASE}/api/match/${mid}/results/`);
       const data = await r.json();
@@ -82,6 +97,11 @@ export default function MCQPage() {
             setOpponentId(data.opponent_id);
             setOpponentUsername(data.opponent_username);
             setMsg(`Matched with @${data.opponent_username}. Hit Ready!`);
+          } else if (data.status === 'not_queued') {
+            // Evicted for missed heartbeats (e.g. a backgrounded tab): join again.
+            clearInterval(queuePollRef.current);
+            queuePollRef.current = null;
+            if (!cancelled) joinQueue();
           }
         } catch {}
       }, 1200);
@@ -129,56 +149,100 @@ export default function MCQPage() {
     // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [userId]);
 
-  // poll /state while matched/active for ready flags + countdown + time_left + finish
+  // Live match state. The server pushes changes over ws/game/<id>/ (deltas merged
+  // into stateRef); countdown and match clock are ticked locally from begin_at /
+  // ends_at. HTTP polling only runs while the socket is down, plus a slow resync.
   useEffect(() => {
     if (!matchId) return;
+    let disposed = false;
+
+    const tick = () => {
+      const s = stateRef.current;
+      if (!s || !s.status || finishedRef.current) return;
+      const now = Date.now() + clockOffsetRef.current;
+      const countdownS = s.begin_at ? Math.max(0, Math.ceil((Date.parse(s.begin_at) - now) / 1000)) : null;
+      const timeLeft = s.ends_at ? Math.max(0, Math.floor((Date.parse(s.ends_at) - now) / 1000)) : null;
+
+      setYouReady(!!s.you_ready);
+      setOpponentReady(!!s.opponent_ready);
+      setMatchTimeLeft(timeLeft);
+      setCountdown(countdownS);
+
+      if (s.status === 'finished' || (typeof timeLeft === 'number' && timeLeft <= 0)) {
+        finishAndFetchResults(matchId);
+        return;
+      }
 
-    const pollOnce = async () => {
-      try {
-        const res = await fetch(`${API_BASE}/api/match/${matchId}/state/?user_id=${userId}`);
-        const s = await res.json();
-
-        setYouReady(!!s.you_ready);
-        setOpponentReady(!!s.opponent_ready);
-        setMatchTimeLeft(typeof s.time_left_seconds === 'number' ? s.time_left_seconds : null);
-
-        setCountdown(typeof s.countdown_seconds === 'number' ? s.countdown_seconds : null);
-
-        if (s.status === 'finished' || (typeof s.time_left_seconds === 'number' && s.time_left_seconds <= 0)) {
-          await finishAndFetchResults(matchId);
-          return;
+      if (s.status === 'active' || countdownS === 0) {
+        setStatus('active');
+        if (!fetchedQuestionRef.current) {
+          fetchedQuestionRef.current = true;
+          fetch(`${API_BASE}/api/match/${matchId}/question/`)
+            .then(r => r.json())
+            .then(q => {
+              setQuestion(q);
+              setSelected(null);
+              setResult(null);
+              setLocked(false);
+              questionStartRef.current = Date.now();
+            })
+            .catch(() => {});
         }
+      } else {
+        setStatus('matched');
+      }
+    };
 
-        if (s.status === 'active' || s.countdown_seconds === 0) {
-          setStatus('active');
-          if (!fetchedQuestionRef.current) {
-            fetchedQuestionRef.current = true;
-            fetch(`${API_BASE}/api/match/${matchId}/question/`)
-              .then(r => r.json())
-              .then(q => {
-                setQuestion(q);
-                setSelected(null);
-                setResult(null);
-                setLocked(false);
-                questionStartRef.current = Date.now();
-              })
-              .catch(() => {});
-          }
-        } else {
-          setStatus('matched');
-        }
+    const applyState = (s) => {
+      stateRef.current = s;
+      if (s.now) clockOffsetRef.current = Date.parse(s.now) - Date.now();
+      tick();
+    };
+
+    const pollOnce = async () => {
+      try {
+        const known = stateRef.current?.state_version;
+        const since = typeof known === 'number' ? `&since_version=${known}` : '';
+        const res = await fetch(`${API_BASE}/api/match/${matchId}/state/?user_id=${userId}${since}`);
+        const data = await res.json();
+        if (!data.unchanged) applyState(data);
       } catch {
         // ignore transient errors
       }
     };
 
-    if (statePollRef.current) clearInterval(statePollRef.current);
+    const setPollInterval = (ms) => {
+      if (statePollRef.current) clearInterval(statePollRef.current);
+      statePollRef.current = setInterval(pollOnce, ms);
+    };
+
+    const connect = () => {
+      const ws = new WebSocket(`${API_BASE.replace(/^http/, 'ws')}/ws/game/${matchId}/?user_id=${userId}`);
+      wsRef.current = ws;
+      ws.onopen = () => setPollInterval(15000);
+      ws.onmessage = (e) => {
+        const msg = JSON.parse(e.data);
+        if (msg.type === 'state') applyState({ ...stateRef.current, ...msg.delta });
+      };
+      ws.onclose = () => {
+        if (disposed || finishedRef.current) return;
+        setPollInterval(800);
+        setTimeout(() => { if (!disposed && !finishedRef.current) connect(); }, 2000);
+      };
+    };
+
     pollOnce(); // immediate
-    statePollRef.current = setInterval(pollOnce, 800);
+    setPollInterval(800);
+    connect();
+    const ticker = setInterval(tick, 250);
 
     return () => {
+      disposed = true;
+      clearInterval(ticker);
       if (statePollRef.current) { clearInterval(statePollRef.current); statePollRef.current = null; }
+      if (wsRef.current) { wsRef.current.close(); wsRef.current = null; }
     };
+    // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [matchId, userId]);
 
   const toggleReady = async () => {